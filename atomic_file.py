@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+
+import os
+from contextlib import contextmanager
+
+# Replacing a file in one go: everything is written to path + ".tmp" and
+# renamed over the file at the end, so readers (and a crash half way) only
+# ever see the old or the new file. If writing fails the temp file is
+# removed and the old file is left as it was.
+#
+#   with atomic_file.open_atomic(path) as f:
+#       json.dump(data, f)
+#
+# With sync the data is flushed to disk before the rename, for the files
+# that would be expensive to lose (the database, the snapshot).
+
+@contextmanager
+def open_atomic(path, mode = "w", sync = False, **kwargs):
+    tmp_path = path + ".tmp"
+    try:
+        with open(tmp_path, mode, **kwargs) as f:
+            yield f
+            if sync:
+                f.flush()
+                os.fsync(f.fileno())
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    os.replace(tmp_path, path)
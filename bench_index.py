@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+
+import re
+
+# Token index over benchmark lists (the "body" of bench_data/cpus.json and cuda.json).
+#
+# Every benchmark name is split into normalized tokens and each token maps to the
+# entries that contain it. A lookup intersects the entry lists of the query tokens,
+# starting with the shortest one, so it doesn't need to look at the whole list.
+
+# Tokens that don't tell models apart
+ignored_tokens = {"cpu", "processor"}
+
+def tokenize(name):
+    # Strip parentheses like (R) and (TM), otherwise Intel CPUs won't match with the benchmark strings.
+    name = re.sub(r'\([^)]*\)', ' ', name).lower()
+    tokens = re.findall(r'[a-z0-9]+(?:[-.+][a-z0-9]+)*', name)
+    return [token for token in tokens if token not in ignored_tokens]
+
+def build_index(bench_data):
+    tokens = dict()
+    entry_tokens = []
+    for idx, entry in enumerate(bench_data):
+        entry_token_set = set(tokenize(entry[0]))
+        entry_tokens.append(entry_token_set)
+        for token in entry_token_set:
+            tokens.setdefault(token, []).append(idx)
+
+    return {"entries": bench_data, "entry_tokens": entry_tokens, "tokens": tokens, "cache": dict()}
+
+def find_match(index, name):
+    query = set(tokenize(name))
+    if len(query) == 0:
+        return None
+
+    postings = []
+    for token in query:
+        if token not in index["tokens"]:
+            return None
+        postings.append(index["tokens"][token])
+    postings.sort(key=len)
+
+    candidates = set(postings[0])
+    for posting in postings[1:]:
+        candidates.intersection_update(posting)
+        if len(candidates) == 0:
+            return None
+
+    # The best match is the entry with the fewest extra tokens,
+    # ties go to the entry that comes first in the benchmark list.
+    entry_tokens = index["entry_tokens"]
+    best = min(candidates, key=lambda idx: (len(entry_tokens[idx]), idx))
+    return index["entries"][best]
+
+def lookup(index, name):
+    # Memoized, most machines share the same handful of models
+    cache = index["cache"]
+    if name not in cache:
+        cache[name] = find_match(index, name)
+    return cache[name]
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+
+import os
+import json
+import math
+import hashlib
+from collections import Counter
+
+import numpy as np
+
+import atomic_file
+import bench_index
+
+# Fuzzy matching of CPU/GPU names against a benchmark list, for the names
+# the token index in bench_index.py can't find (extra or missing words,
+# different spelling of the model number, ...).
+#
+# Names are turned into character trigram count vectors (after the same
+# normalization as the token index) and compared with the cosine similarity.
+# All names are matched in one batch: a single matrix product of the name
+# vectors with the benchmark vectors. The best similarity is the confidence.
+#
+# The results are cached in a json file next to the benchmark list, so later
+# runs only have to match names they haven't seen before.
+
+default_min_confidence = 0.6
+
+def normalize(name):
+    return " ".join(bench_index.tokenize(name))
+
+def ngram_counts(name, n = 3):
+    text = " " + normalize(name) + " "
+    return Counter(text[i:i + n] for i in range(len(text) - n + 1))
+
+def vectorize(count_list, vocabulary):
+    # Rows of unit length, only the n-grams in vocabulary are kept as
+    # the others can't add anything to the similarities
+    matrix = np.zeros((len(count_list), len(vocabulary)), dtype=np.float32)
+    for row, counts in enumerate(count_list):
+        norm = math.sqrt(sum(count * count for count in counts.values()))
+        if norm == 0:
+            continue
+        for gram, count in counts.items():
+            col = vocabulary.get(gram)
+            if col is not None:
+                matrix[row, col] = count / norm
+    return matrix
+
+def match_names(names, bench_names):
+    # Returns the index of the best bench name and the similarity for every name
+    if len(names) == 0 or len(bench_names) == 0:
+        return [(None, 0.0) for name in names]
+
+    name_counts = [ngram_counts(name) for name in names]
+    vocabulary = dict()
+    for counts in name_counts:
+        for gram in counts:
+            vocabulary.setdefault(gram, len(vocabulary))
+
+    name_matrix = vectorize(name_counts, vocabulary)
+    bench_matrix = vectorize([ngram_counts(name) for name in bench_names], vocabulary)
+
+    similarity = name_matrix @ bench_matrix.T
+    # argmax takes the first of equal scores, the same tie break as the token index
+    best = np.argmax(similarity, axis=1)
+    confidence = similarity[np.arange(len(names)), best]
+    return [(int(idx), float(conf)) for idx, conf in zip(best, confidence)]
+
+def cache_path(bench_file):
+    return os.path.splitext(bench_file)[0] + ".matches.json"
+
+def bench_hash(index):
+    # The cache is only valid for the benchmark list it was made with
+    digest = hashlib.sha256()
+    for entry in index["entries"]:
+        digest.update(entry[0].encode("utf-8") + b"\0")
+    return digest.hexdigest()
+
+def load_cache(path, bench_id):
+    try:
+        with open(path, "r") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return dict()
+    if cache.get("bench") != bench_id:
+        return dict()
+    return cache["matches"]
+
+def save_cache(path, bench_id, matches):
+    with atomic_file.open_atomic(path) as f:
+        json.dump({"bench": bench_id, "matches": matches}, f, indent=4)
+
+def resolve(index, names, cache_file = None, min_confidence = default_min_confidence):
+    # Fuzzy match the names the token index can't find, the matches go into the
+    # lookup cache of the index, so bench_index.lookup() returns them from then on.
+    # Returns {name: (bench name or None, confidence)} for the fuzzy matched names.
+    missing = sorted(name for name in set(names) if bench_index.lookup(index, name) is None)
+    if len(missing) == 0:
+        return dict()
+
+    bench_id = bench_hash(index)
+    matches = load_cache(cache_file, bench_id) if cache_file is not None else dict()
+
+    todo = [name for name in missing if name not in matches]
+    if len(todo) != 0:
+        bench_names = [entry[0] for entry in index["entries"]]
+        for name, (idx, confidence) in zip(todo, match_names(todo, bench_names)):
+            matches[name] = [bench_names[idx] if idx is not None else None, confidence]
+        if cache_file is not None:
+            save_cache(cache_file, bench_id, matches)
+
+    by_name = {entry[0]: entry for entry in index["entries"]}
+    results = dict()
+    for name in missing:
+        bench_name, confidence = matches[name]
+        if bench_name is not None and confidence >= min_confidence:
+            index["cache"][name] = by_name.get(bench_name)
+            results[name] = (bench_name, confidence)
+        else:
+            results[name] = (None, confidence)
+    return results
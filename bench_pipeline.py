@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import subprocess
+
+import gen_fleet
+
+# End to end benchmark of the parse -> merge -> rank pipeline on a synthetic fleet.
+#
+# Every stage runs the real script in a child process. The wall time and the
+# peak memory (max RSS) of that child are recorded. Results can be saved and
+# compared with an earlier run to catch regressions.
+
+script_dir = os.path.dirname(os.path.realpath(__file__))
+
+def run_stage(name, cmd, cwd):
+    start = time.perf_counter()
+    proc = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.DEVNULL)
+    pid, status, rusage = os.wait4(proc.pid, 0)
+    elapsed = time.perf_counter() - start
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if proc.returncode != 0:
+        print("Stage " + name + " failed with exit code " + str(proc.returncode))
+        sys.exit(1)
+    # ru_maxrss is in kilobytes on Linux
+    return {"seconds": elapsed, "max_rss_kb": rusage.ru_maxrss}
+
+def script(name):
+    return [sys.executable, os.path.join(script_dir, name)]
+
+def run_benchmark(work_dir, args):
+    results = dict()
+
+    gen_args = gen_fleet.make_parser().parse_args(["unused",
+        "--machines", str(args.machines), "--ram", str(args.ram), "--gpus", str(args.gpus),
+        "--sata", str(args.sata), "--nvme", str(args.nvme), "--monitors", str(args.monitors),
+        "--churn", str(args.churn), "--drop", str(args.drop), "--seed", args.seed])
+
+    start = time.perf_counter()
+    gen_fleet.write_bench_data(os.path.join(work_dir, "bench_data"))
+    runs = []
+    for run in range(2):
+        gen_args.run = run
+        dump_dir = os.path.join(work_dir, "dumps%d" % run)
+        runs.append((dump_dir, gen_fleet.generate(dump_dir, gen_args)))
+    results["generate"] = {"seconds": time.perf_counter() - start}
+
+    db_path = os.path.join(work_dir, "data" + args.db_ext)
+
+    for run, (dump_dir, dumps) in enumerate(runs):
+        json_dir = os.path.join(work_dir, "json%d" % run) + "/"
+        os.makedirs(json_dir)
+
+        results["parse run%d" % run] = run_stage("parse", script("parse_output.py") +
+                ["--jobs", str(args.jobs)] + dumps + [json_dir], work_dir)
+
+        results["merge run%d" % run] = run_stage("merge", script("process_json_data.py") +
+                ["--db", db_path, "--jobs", str(args.jobs), json_dir], work_dir)
+
+        json_files = sorted(os.path.join(json_dir, name) for name in os.listdir(json_dir))
+        results["rank run%d" % run] = run_stage("rank", script("create_bench_rank_list.py") +
+                json_files + [os.path.join(work_dir, "rank%d.txt" % run)], work_dir)
+
+    results["database bytes"] = os.path.getsize(db_path)
+    return results
+
+def compare(results, baseline, threshold):
+    # Returns the stages that got slower or bigger than the threshold allows
+    regressions = []
+    for stage, value in results.items():
+        if not isinstance(value, dict) or stage not in baseline:
+            continue
+        for metric in ["seconds", "max_rss_kb"]:
+            if metric not in value or metric not in baseline[stage]:
+                continue
+            old = baseline[stage][metric]
+            if old > 0 and value[metric] > old * (1 + threshold):
+                regressions.append((stage, metric, old, value[metric]))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the parse -> merge -> rank pipeline on a synthetic fleet.")
+    parser.add_argument("-n", "--machines", type=int, default=1000, help="number of machines (default: %(default)s)")
+    parser.add_argument("--ram", type=int, default=4, help="RAM sticks per machine (default: %(default)s)")
+    parser.add_argument("--gpus", type=int, default=1, help="GPUs per machine (default: %(default)s)")
+    parser.add_argument("--sata", type=int, default=2, help="SATA drives per machine (default: %(default)s)")
+    parser.add_argument("--nvme", type=int, default=1, help="NVMe drives per machine (default: %(default)s)")
+    parser.add_argument("--monitors", type=int, default=2, help="monitors per machine (default: %(default)s)")
+    parser.add_argument("--churn", type=float, default=0.05, help="chance for a component to be swapped between runs (default: %(default)s)")
+    parser.add_argument("--drop", type=float, default=0.01, help="chance for a machine to disappear between runs (default: %(default)s)")
+    parser.add_argument("--seed", default="0", help="random seed (default: %(default)s)")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="parse_output.py and process_json_data.py worker processes (default: %(default)s)")
+    parser.add_argument("--db-ext", choices=[".json", ".db"], default=".json", help="database backend to merge into (default: %(default)s)")
+    parser.add_argument("--work-dir", help="keep the generated files in this directory instead of a temp dir")
+    parser.add_argument("-o", "--output", help="write the results as json to this file")
+    parser.add_argument("--baseline", help="results file of an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed slowdown/growth against the baseline (default: %(default)s)")
+    args = parser.parse_args()
+
+    if args.work_dir is not None:
+        if os.path.exists(args.work_dir):
+            print("The work directory " + args.work_dir + " already exists")
+            sys.exit(1)
+        os.makedirs(args.work_dir)
+        work_dir = args.work_dir
+    else:
+        work_dir = tempfile.mkdtemp(prefix="hw_bench_")
+
+    try:
+        results = run_benchmark(work_dir, args)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir)
+
+    results["machines"] = args.machines
+
+    for stage, value in results.items():
+        if not isinstance(value, dict):
+            print("%-16s %s" % (stage, value))
+        elif "max_rss_kb" in value:
+            print("%-16s %8.3f s %10d kB" % (stage, value["seconds"], value["max_rss_kb"]))
+        else:
+            print("%-16s %8.3f s" % (stage, value["seconds"]))
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+
+    if args.baseline is not None:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        for stage, metric, old, new in regressions:
+            print("Regression in " + stage + " " + metric + ": " + str(old) + " -> " + str(new))
+        if len(regressions) != 0:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
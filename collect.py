@@ -0,0 +1,505 @@
+#!/usr/bin/env python
+
+import os
+import re
+import json
+import glob
+import struct
+import socket
+import argparse
+
+import atomic_file
+import edid
+import hw_records
+import parse_output
+
+# Native collector, reads sysfs/procfs directly instead of running hw_script.sh.
+#
+# The data is turned into the same (section, block, key, value) records that
+# parse_output.tokenize() gives for a dump, and fed to the parse_output section
+# handlers. So the result has the same json layout as parse_output.py output.
+#
+# All paths are relative to a root directory, so it can run against a fake sysfs tree.
+
+pci_ids_paths = ["usr/share/hwdata/pci.ids", "usr/share/misc/pci.ids", "usr/share/pci.ids"]
+
+def root_path(root, path):
+    return os.path.join(root, path.lstrip("/"))
+
+def root_glob(root, pattern):
+    # Sorted matches of pattern, as paths relative to root
+    prefix = len(root_path(root, "/")) - 1
+    return sorted(path[prefix:] for path in glob.glob(root_path(root, pattern)))
+
+def read_file(root, path, default = None):
+    try:
+        with open(root_path(root, path), "r", errors="replace") as f:
+            return f.read().strip()
+    except OSError:
+        return default
+
+def read_bytes(root, path):
+    try:
+        with open(root_path(root, path), "rb") as f:
+            return f.read()
+    except OSError:
+        return None
+
+def section_records(section, lines):
+    # Records for "raw" sections, like parse_output.tokenize would give them
+    records = [(section, 0, None, None)]
+    block = 0
+    for line in lines:
+        if len(line.strip()) == 0:
+            block += 1
+            records.append((section, block, None, None))
+        else:
+            records.append((section, block, None, line))
+    return records
+
+# --- PCI ---
+
+def load_pci_ids(root, vendors, classes):
+    # Only keeps the names of the given vendors and classes from pci.ids
+    names = {"vendors": dict(), "devices": dict(), "classes": dict(), "subclasses": dict()}
+    for path in pci_ids_paths:
+        try:
+            f = open(root_path(root, path), "r", errors="replace")
+        except OSError:
+            continue
+        with f:
+            vendor = None
+            pci_class = None
+            for line in f:
+                if line.startswith("#") or len(line.strip()) == 0:
+                    continue
+                if line.startswith("C "):
+                    vendor = None
+                    pci_class = line[2:4].lower()
+                    if pci_class in classes:
+                        names["classes"][pci_class] = line[4:].strip()
+                elif line[0] != "\t":
+                    pci_class = None
+                    vendor = line[0:4].lower()
+                    if vendor in vendors:
+                        names["vendors"][vendor] = line[4:].strip()
+                elif line[1] != "\t":
+                    if vendor in vendors:
+                        names["devices"][(vendor, line[1:5].lower())] = line[5:].strip()
+                    elif pci_class in classes:
+                        names["subclasses"][(pci_class, line[1:3].lower())] = line[3:].strip()
+        break
+    return names
+
+def pci_devices(root):
+    devices = []
+    for path in root_glob(root, "/sys/bus/pci/devices/*"):
+        slot = os.path.basename(path)
+        vendor = read_file(root, path + "/vendor", "0x0000")[2:].lower()
+        device = read_file(root, path + "/device", "0x0000")[2:].lower()
+        pci_class = read_file(root, path + "/class", "0x000000")[2:].lower()
+        devices.append({"slot": slot, "vendor": vendor, "device": device, "class": pci_class, "path": path})
+    return devices
+
+def pci_names(names, dev):
+    # The names as "lspci -mm" prints them
+    if dev["slot"].startswith("0000:"):
+        slot = dev["slot"][5:]
+    else:
+        slot = dev["slot"]
+    class_name = names["subclasses"].get((dev["class"][0:2], dev["class"][2:4]))
+    if class_name is None:
+        class_name = names["classes"].get(dev["class"][0:2], "Class " + dev["class"][0:4])
+    vendor_name = names["vendors"].get(dev["vendor"], "Vendor " + dev["vendor"])
+    device_name = names["devices"].get((dev["vendor"], dev["device"]), "Device " + dev["device"])
+    return slot, class_name, vendor_name, device_name
+
+# --- SMBIOS ---
+
+def smbios_structures(table):
+    # Yields (type, handle, formatted area, strings) for every SMBIOS structure
+    idx = 0
+    while idx + 4 <= len(table):
+        struct_type, length, handle = struct.unpack_from("<BBH", table, idx)
+        if length < 4:
+            break
+        formatted = table[idx:idx + length]
+        end = table.find(b"\0\0", idx + length)
+        if end == -1:
+            break
+        strings = table[idx + length:end].split(b"\0")
+        yield struct_type, handle, formatted, strings
+        if struct_type == 127:
+            break
+        idx = end + 2
+
+def dmi_string(formatted, strings, offset):
+    if offset >= len(formatted):
+        return None
+    idx = formatted[offset]
+    if idx == 0:
+        return "Not Specified"
+    if idx > len(strings):
+        return "<BAD INDEX>"
+    return strings[idx - 1].decode("ascii", errors="replace").strip()
+
+def dmi_enum(names, value):
+    # names starts at value 0x01
+    if 1 <= value <= len(names):
+        return names[value - 1]
+    return "<OUT OF SPEC>"
+
+def dmi_memory_size(code, shift):
+    # Same formatting as dmidecode, code is in units of 1024^shift bytes
+    units = ["bytes", "kB", "MB", "GB", "TB", "PB", "EB", "ZB"]
+    split = [(code >> (10 * i)) & 0x3FF for i in range(7)]
+    i = 6
+    while i > 0 and split[i] == 0:
+        i -= 1
+    if i > 0 and split[i - 1] != 0:
+        i -= 1
+        capacity = split[i] + (split[i + 1] << 10)
+    else:
+        capacity = split[i]
+    return "%d %s" % (capacity, units[i + shift])
+
+processor_types = ["Other", "Unknown", "Central Processor", "Math Processor", "DSP Processor", "Video Processor"]
+
+processor_upgrades = ["Other", "Unknown", "Daughter Board", "ZIF Socket", "Replaceable Piggy Back", "None",
+        "LIF Socket", "Slot 1", "Slot 2", "370-pin Socket", "Slot A", "Slot M", "Socket 423",
+        "Socket A (Socket 462)", "Socket 478", "Socket 754", "Socket 940", "Socket 939", "Socket mPGA604",
+        "Socket LGA771", "Socket LGA775", "Socket S1", "Socket AM2", "Socket F (1207)", "Socket LGA1366",
+        "Socket G34", "Socket AM3", "Socket C32", "Socket LGA1156", "Socket LGA1567", "Socket PGA988A",
+        "Socket BGA1288", "Socket rPGA988B", "Socket BGA1023", "Socket BGA1224", "Socket BGA1155",
+        "Socket LGA1356", "Socket LGA2011", "Socket FS1", "Socket FS2", "Socket FM1", "Socket FM2",
+        "Socket LGA2011-3", "Socket LGA1356-3", "Socket LGA1150", "Socket BGA1168", "Socket BGA1234",
+        "Socket BGA1364", "Socket AM4", "Socket LGA1151", "Socket BGA1356", "Socket BGA1440",
+        "Socket BGA1515", "Socket LGA3647-1", "Socket SP3", "Socket SP3r2", "Socket LGA2066",
+        "Socket BGA1392", "Socket BGA1510", "Socket BGA1528", "Socket LGA4189", "Socket LGA1200",
+        "Socket LGA4677", "Socket LGA1700", "Socket BGA1744", "Socket BGA1781", "Socket BGA1211",
+        "Socket BGA2422", "Socket LGA1211", "Socket LGA2422", "Socket LGA5773", "Socket BGA5773"]
+
+memory_types = ["Other", "Unknown", "DRAM", "EDRAM", "VRAM", "SRAM", "RAM", "ROM", "Flash", "EEPROM",
+        "FEPROM", "EPROM", "CDRAM", "3DRAM", "SDRAM", "SGRAM", "RDRAM", "DDR", "DDR2", "DDR2 FB-DIMM",
+        "Reserved", "Reserved", "Reserved", "DDR3", "FBD2", "DDR4", "LPDDR", "LPDDR2", "LPDDR3", "LPDDR4",
+        "Logical non-volatile device", "HBM", "HBM2", "DDR5", "LPDDR5", "HBM3"]
+
+def baseboard_fields(f, s):
+    return [("Manufacturer", dmi_string(f, s, 0x04)),
+            ("Product Name", dmi_string(f, s, 0x05)),
+            ("Version", dmi_string(f, s, 0x06)),
+            ("Serial Number", dmi_string(f, s, 0x07))]
+
+def processor_fields(f, s):
+    fields = [("Socket Designation", dmi_string(f, s, 0x04)),
+            ("Type", dmi_enum(processor_types, f[0x05])),
+            ("Manufacturer", dmi_string(f, s, 0x07)),
+            ("ID", " ".join("%02X" % b for b in f[0x08:0x10])),
+            ("Version", dmi_string(f, s, 0x10))]
+
+    speed = struct.unpack_from("<H", f, 0x16)[0]
+    fields.append(("Current Speed", "%d MHz" % speed if speed != 0 else "Unknown"))
+    fields.append(("Upgrade", dmi_enum(processor_upgrades, f[0x19])))
+
+    if len(f) >= 0x28:
+        threads = f[0x25]
+        if threads == 0xFF and len(f) >= 0x30:
+            threads = struct.unpack_from("<H", f, 0x2E)[0]
+        if threads != 0:
+            fields.append(("Thread Count", str(threads)))
+    return fields
+
+def memory_array_fields(f, s):
+    capacity = struct.unpack_from("<I", f, 0x07)[0]
+    if capacity == 0x80000000 and len(f) >= 0x17:
+        # Extended capacity in bytes
+        capacity = dmi_memory_size(struct.unpack_from("<Q", f, 0x0F)[0], 0)
+    else:
+        capacity = dmi_memory_size(capacity, 1)
+    return [("Maximum Capacity", capacity),
+            ("Number Of Devices", str(struct.unpack_from("<H", f, 0x0D)[0]))]
+
+def memory_device_fields(f, s):
+    size = struct.unpack_from("<H", f, 0x0C)[0]
+    if size == 0:
+        size = "No Module Installed"
+    elif size == 0xFFFF:
+        size = "Unknown"
+    elif size == 0x7FFF and len(f) >= 0x20:
+        size = dmi_memory_size(struct.unpack_from("<I", f, 0x1C)[0] & 0x7FFFFFFF, 2)
+    elif size & 0x8000:
+        size = dmi_memory_size(size & 0x7FFF, 1)
+    else:
+        size = dmi_memory_size(size, 2)
+
+    fields = [("Size", size),
+            ("Type", dmi_enum(memory_types, f[0x12])),
+            ("Manufacturer", dmi_string(f, s, 0x17)),
+            ("Serial Number", dmi_string(f, s, 0x18)),
+            ("Part Number", dmi_string(f, s, 0x1A))]
+
+    if len(f) >= 0x22:
+        speed = struct.unpack_from("<H", f, 0x20)[0]
+        if speed == 0xFFFF and len(f) >= 0x5C:
+            speed = struct.unpack_from("<I", f, 0x58)[0]
+        fields.append(("Configured Memory Speed", "%d MT/s" % speed if speed != 0 else "Unknown"))
+    return fields
+
+# SMBIOS type: (section, decoder)
+dmi_decoders = {
+        2: ("Motherboard", baseboard_fields),
+        4: ("CPU", processor_fields),
+        16: ("RAM", memory_array_fields),
+        17: ("RAM", memory_device_fields),
+        }
+
+def dmi_records(table):
+    records = {"Motherboard": [], "CPU": [], "RAM": []}
+    for section in records:
+        records[section].append((section, 0, None, None))
+
+    block = 0
+    for struct_type, handle, formatted, strings in smbios_structures(table):
+        if struct_type not in dmi_decoders:
+            continue
+        section, decoder = dmi_decoders[struct_type]
+        block += 1
+        add = records[section].append
+        add((section, block, "DMI type", struct_type))
+        for key, value in decoder(formatted, strings):
+            if value is not None:
+                add((section, block, key, " " + value))
+        add((section, block, None, None))
+    return records
+
+# --- Sections ---
+
+def interface_ip(name):
+    # SIOCGIFADDR, the IPv4 address of the interface
+    import fcntl
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        try:
+            data = fcntl.ioctl(s.fileno(), 0x8915, struct.pack("256s", name[:15].encode()))
+        except OSError:
+            return None
+    return socket.inet_ntoa(data[20:24])
+
+def net_lines(root, names):
+    lines = []
+    for iface in root_glob(root, "/sys/class/net/*"):
+        uevent = read_file(root, iface + "/device/uevent")
+        if uevent is None:
+            # Virtual device
+            continue
+        name = os.path.basename(iface)
+        lines.append(name)
+        lines.append(read_file(root, iface + "/address", ""))
+        if "up" in read_file(root, iface + "/operstate", ""):
+            ip = None
+            if root == "/":
+                ip = interface_ip(name)
+            if ip is not None:
+                lines.append(ip)
+        else:
+            lines.append("DOWN")
+        slot = None
+        for line in uevent.splitlines():
+            if line.startswith("PCI_SLOT_NAME="):
+                slot = line.split("=", 1)[1]
+        dev = names["by_slot"].get(slot)
+        if dev is not None:
+            lines += pci_names(names, dev)
+        lines.append("")
+    lines.append("")
+    return lines
+
+def gpu_records(root, names):
+    records = [("GPU", 0, None, None)]
+    add = records.append
+    for dev in names["gpus"]:
+        slot, class_name, vendor_name, device_name = pci_names(names, dev)
+        add(("GPU", 0, "On pci bus", " " + slot))
+        add(("GPU", 0, "Vendor", " " + vendor_name))
+        if "NVIDIA" in vendor_name:
+            info = read_file(root, "/proc/driver/nvidia/gpus/" + dev["slot"] + "/information", "")
+            for line in info.splitlines():
+                if "Model:" in line or "UUID:" in line:
+                    key, sep, value = line.partition(":")
+                    add(("GPU", 0, key.strip(), value))
+        else:
+            # lspci -mm names, cut at the first parenthesis like hw_script.sh does
+            add(("GPU", 0, "Model", " " + " ".join(device_name.split("(")[0].split())))
+            uuid = read_file(root, dev["path"] + "/unique_id")
+            if uuid is not None:
+                add(("GPU", 0, "UUID", " " + uuid))
+        add(("GPU", 0, None, "---"))
+    return records
+
+def udev_properties(root, block_dev):
+    props = dict()
+    dev = read_file(root, "/sys/block/" + block_dev + "/dev")
+    if dev is None:
+        return props
+    data = read_file(root, "/run/udev/data/b" + dev, "")
+    for line in data.splitlines():
+        if line.startswith("E:"):
+            key, sep, value = line[2:].partition("=")
+            props[key] = value
+    return props
+
+def udev_decode(value):
+    return re.sub(r'\\x([0-9a-fA-F]{2})', lambda m: chr(int(m.group(1), 16)), value).strip()
+
+def drive_serial(root, path, props):
+    # Without a udev database (containers, chroots) the serial number comes from
+    # the SCSI unit serial number page, or the wwid if the drive has no such page
+    if "ID_SERIAL_SHORT" in props:
+        return props["ID_SERIAL_SHORT"]
+    page = read_bytes(root, path + "/device/vpd_pg80")
+    if page is not None and len(page) > 4:
+        serial = page[4:4 + page[3]].decode("ascii", "replace").strip()
+        if len(serial) != 0:
+            return serial
+    return read_file(root, path + "/device/wwid", "")
+
+def hdd_records(root):
+    records = [("HDD", 0, None, None)]
+    add = records.append
+    for path in root_glob(root, "/sys/block/sd*"):
+        block_dev = os.path.basename(path)
+        props = udev_properties(root, block_dev)
+
+        add(("HDD", 0, None, "/dev/" + block_dev))
+        if "ID_MODEL_ENC" in props:
+            model = udev_decode(props["ID_MODEL_ENC"])
+        else:
+            model = read_file(root, path + "/device/model", "")
+        add(("HDD", 0, "Model Number", " " + model))
+        add(("HDD", 0, "Serial Number", " " + drive_serial(root, path, props)))
+        firmware = props.get("ID_REVISION", read_file(root, path + "/device/rev"))
+        if firmware is not None:
+            add(("HDD", 0, "Firmware Revision", " " + firmware))
+        sectors = int(read_file(root, path + "/size", "0"))
+        add(("HDD", 0, "device size with M = 1000*1000", " %d MBytes (%d GB)" % (sectors * 512 // 1000000, sectors * 512 // 1000000000)))
+        rpm = props.get("ID_ATA_ROTATION_RATE_RPM")
+        if rpm is None and read_file(root, path + "/queue/rotational") == "0":
+            rpm = "0"
+        if rpm is not None:
+            add(("HDD", 0, "Nominal Media Rotation Rate", " " + ("Solid State Device" if rpm == "0" else rpm)))
+    return records
+
+def nvme_drives(root):
+    drives = []
+    for ctrl in root_glob(root, "/sys/class/nvme/nvme*"):
+        for ns in root_glob(root, ctrl + "/nvme*n*"):
+            name = os.path.basename(ns)
+            sectors = int(read_file(root, ns + "/size", "0"))
+            block_size = read_file(root, ns + "/queue/logical_block_size", "512")
+            nsid = read_file(root, ns + "/nsid", name.rsplit("n", 1)[1])
+            info = dict()
+            info["Type"] = "NVME"
+            info["Node"] = "/dev/" + name
+            info["SN"] = read_file(root, ctrl + "/serial", "")
+            info["Model"] = read_file(root, ctrl + "/model", "")
+            info["Namespace"] = nsid
+            info["Usage"] = "%.2f GB" % (sectors * 512 / 1e9)
+            info["Format"] = block_size + " B + 0 B"
+            info["FW"] = read_file(root, ctrl + "/firmware_rev", "")
+            drives.append(info)
+    return drives
+
+def monitor_records(root):
+    records = [("Monitor info", 0, None, None)]
+    for output in root_glob(root, "/sys/class/drm/card*-*"):
+        if read_file(root, output + "/status") != "connected":
+            continue
+        blob = read_bytes(root, output + "/edid")
+        if not blob:
+            # Connected, but the monitor didn't give us an EDID
+            continue
+        try:
+            lines = edid.edid_lines(blob)
+        except edid.EdidError:
+            continue
+        records.append(("Monitor info", 0, None, os.path.basename(output)))
+        records.append(("Monitor info", 0, None, "Section"))
+        for line in lines:
+            # Split like the "kv" lines of parse_output.tokenize
+            key, sep, value = line.partition(":")
+            records.append(("Monitor info", 0, key.strip(), value))
+        records.append(("Monitor info", 0, None, "EndSection"))
+    return records
+
+def collect(root = "/", user = None, extra_id = None):
+    # With parse_output.brief_output set, only the brief subset is collected,
+    # the same sections parse_output.py skips are left out here.
+    brief = parse_output.brief_output
+    output_data = dict()
+
+    hostname = read_file(root, "/proc/sys/kernel/hostname", "")
+    if extra_id is not None:
+        hostname += " (" + extra_id + ")"
+    if user is None:
+        user = hostname
+
+    output_data["Schema version"] = parse_output.schema_version
+    output_data["User"] = user
+    output_data["Hostname"] = hostname
+
+    os_release = read_file(root, "/etc/os-release", "")
+    os_name = ""
+    for line in os_release.splitlines():
+        if line.startswith("PRETTY_NAME="):
+            os_name = line.split("=", 1)[1].strip('"')
+    if not brief:
+        parse_output.os_parse(section_records("OS", [os_name]), output_data)
+
+    devices = pci_devices(root)
+    gpus = [dev for dev in devices if dev["class"].startswith("03")]
+    names = load_pci_ids(root, {dev["vendor"] for dev in devices}, {dev["class"][0:2] for dev in devices})
+    names["by_slot"] = {dev["slot"]: dev for dev in devices}
+    names["gpus"] = gpus
+
+    parse_output.net_parse(section_records("Network", net_lines(root, names)), output_data)
+
+    table = read_bytes(root, "/sys/firmware/dmi/tables/DMI")
+    records = dmi_records(table if table is not None else b"")
+    if not brief:
+        parse_output.mobo_parse(records["Motherboard"], output_data)
+    parse_output.cpu_parse(records["CPU"], output_data)
+    parse_output.ram_parse(records["RAM"], output_data)
+
+    parse_output.gpu_parse(gpu_records(root, names), output_data)
+    if not brief:
+        parse_output.disk_parse(hdd_records(root), output_data)
+        output_data["HDDs"] += hw_records.pack_entries("HDDs", nvme_drives(root))
+
+        devices_list = read_file(root, "/proc/bus/input/devices", "")
+        parse_output.input_parse(section_records("Input devices", devices_list.splitlines() + ["", ""]), output_data)
+
+    parse_output.monitor_parse(monitor_records(root), output_data)
+
+    return output_data
+
+def main():
+    parser = argparse.ArgumentParser(description="Collect HW info from sysfs/procfs as json, without hw_script.sh.")
+    parser.add_argument("--root", default="/", help="root of the file system to read from (default: %(default)s)")
+    parser.add_argument("--user", help="value of the User field (default: the hostname)")
+    parser.add_argument("--id", dest="extra_id", help="extra ID data to add to the hostname")
+    parser.add_argument("-o", "--output", help="write the json to this file instead of stdout")
+    parser.add_argument("-b", "--brief", action="store_true", help="only collect the brief subset of the info")
+    args = parser.parse_args()
+
+    parse_output.brief_output = args.brief
+
+    output_data = collect(args.root, args.user, args.extra_id)
+
+    out_json = json.dumps(output_data, default=hw_records.json_default)
+    if args.output is None:
+        print(out_json)
+    else:
+        with atomic_file.open_atomic(args.output) as f_out:
+            f_out.write(out_json)
+
+if __name__ == "__main__":
+    main()
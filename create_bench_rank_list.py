@@ -1,113 +1,224 @@
 #!/usr/bin/env python
-import sys
+import os
+import csv
 import json
-import re
-from operator import attrgetter, itemgetter
+import heapq
+import argparse
 
-if len(sys.argv) < 3:
-    print("You need to provide a file to parse and an output file!")
-    sys.exit()
+import atomic_file
+import bench_index
+import metrics
 
-out_file = sys.argv[-1]
+cpu_bench_file = "./bench_data/cpus.json"
+gpu_bench_file = "./bench_data/cuda.json"
 
-with open("./bench_data/cpus.json", "r") as read_file:
-    data_cpu = json.load(read_file)
+def load_bench(bench_file):
+    with open(bench_file, "r") as read_file:
+        bench_data = json.load(read_file)
 
-with open("./bench_data/cuda.json", "r") as read_file:
-    data_gpu = json.load(read_file)
-
-cpu_bench_data = data_cpu["body"]
-gpu_bench_data = data_gpu["body"]
-
-comp_list = []
-
-for input_file in sys.argv[1:-1]:
-    print(input_file)
-    with open(input_file, "r") as read_file:
-        input_data = json.load(read_file)
-
-    comp_list.append(input_data)
-
-    file_name = input_file.split("/")[-1].split(".")[0]
-    input_data["file_name"] = file_name
+    return bench_index.build_index(bench_data["body"])
 
+def score_computer(input_data, cpu_index, gpu_index):
     #Get the average score
 
     cpu_str = input_data["CPUs"][0]["Version"]
     cpu_nr = len(input_data["CPUs"])
 
-    #Strip parentheses from CPU string, otherwise Intel CPUs won't match with the benchmark strings.
-    cpu_str = re.sub(r'\([^)]*\)', '', cpu_str)
+    cpu_result = bench_index.lookup(cpu_index, cpu_str)
 
-    cpu_result = []
-
-    for cpu_data in cpu_bench_data:
-        if cpu_str in cpu_data[0]:
-            cpu_result = cpu_data
-
-    if len(cpu_result) == 0:
+    if cpu_result is None:
         cpu_result = "N/A"
     else:
         cpu_result = cpu_result[1] / cpu_nr
 
     input_data["CPU score"] = cpu_result
 
-    if not "NVIDIA" in input_data["GPUs"][0]["Vendor"]:
+    # Machines without a GPU have no GPU score either
+    if len(input_data["GPUs"]) == 0 or not "NVIDIA" in input_data["GPUs"][0]["Vendor"]:
         gpu_result = "N/A"
         input_data["GPU score"] = gpu_result
-        continue
+        return
 
     gpu_str = input_data["GPUs"][0]["Model"]
-    gpu_nr = len(input_data["GPUs"])
 
-    gpu_result = []
+    gpu_result = bench_index.lookup(gpu_index, gpu_str)
 
-    for gpu_data in gpu_bench_data:
-        if gpu_str in gpu_data[0]:
-            gpu_result = gpu_data
-
-    if len(gpu_result) == 0:
+    if gpu_result is None:
         gpu_result = "N/A"
     else:
         gpu_result = gpu_result[1]
 
     input_data["GPU score"] = gpu_result
-    print(gpu_result)
-
-#print(str(comp_list))
-comp_list = sorted(comp_list, key=itemgetter('CPU score'))
 
-out = open(out_file,"w")
-
-for comp in comp_list:
-    out.write("file_name: ")
-    out.write(comp["file_name"])
-    out.write("\n")
-
-    out.write("CPU score: ")
-    out.write(str(comp["CPU score"]))
-    out.write("\n")
-
-    out.write("GPU score: ")
-    out.write(str(comp["GPU score"]))
-    out.write("\n")
-
-    out.write("CPUs:\n")
-    for cpu in comp["CPUs"]:
-        out.write("\t")
-        out.write(cpu["Version"])
+# Sort keys that can be combined with --key, in priority order
+rank_keys = {"cpu": "CPU score", "gpu": "GPU score", "ram": "RAM (GB)"}
+
+def report_entry(input_data, file_name):
+    # Only what the report needs, so the full machine data can be dropped right away
+    return {"file_name": file_name,
+            "CPU score": input_data["CPU score"],
+            "GPU score": input_data["GPU score"],
+            "CPUs": [cpu["Version"] for cpu in input_data["CPUs"]],
+            "RAM (GB)": input_data["RAM"]["Total RAM (GB)"],
+            "GPUs": [gpu["Model"] for gpu in input_data["GPUs"]]}
+
+def make_sort_key(keys, unknown_high):
+    # Scores that are not numbers ("N/A") sort above or below all known scores
+    unknown_flag = 1 if unknown_high else -1
+
+    def sort_key(entry):
+        key = []
+        for name in keys:
+            value = entry[name]
+            if isinstance(value, (int, float)):
+                key.append((0, value))
+            else:
+                key.append((unknown_flag, 0))
+        return key
+
+    return sort_key
+
+def rank(entries, keys, top = None, bottom = None, unknown = "last"):
+    # Lowest scores first, or the highest first with top.
+    # With top or bottom only a heap of that many entries is kept.
+    ascending = top is None
+    sort_key = make_sort_key(keys, (unknown == "last") == ascending)
+
+    if top is not None:
+        return heapq.nlargest(top, entries, key=sort_key)
+    if bottom is not None:
+        return heapq.nsmallest(bottom, entries, key=sort_key)
+    return sorted(entries, key=sort_key)
+
+def write_text(comp_list, out):
+    lines = []
+    for comp in comp_list:
+        lines.append("file_name: " + comp["file_name"])
+        lines.append("CPU score: " + str(comp["CPU score"]))
+        lines.append("GPU score: " + str(comp["GPU score"]))
+        lines.append("CPUs:")
+        for cpu in comp["CPUs"]:
+            lines.append("\t" + cpu)
+        lines.append("RAM: " + str(comp["RAM (GB)"]) + " GB")
+        lines.append("GPUs:")
+        for gpu in comp["GPUs"]:
+            lines.append("\t" + gpu)
+        lines.append("")
+    out.write("\n".join(lines))
+    if len(lines) != 0:
         out.write("\n")
 
-    out.write("RAM: ")
-    out.write(str(comp["RAM"]["Total RAM (GB)"]))
-    out.write(" GB\n")
-
-    out.write("GPUs:\n")
-    for gpu in comp["GPUs"]:
-        out.write("\t")
-        out.write(gpu["Model"])
-        out.write("\n")
+def write_csv(comp_list, out):
+    writer = csv.writer(out)
+    writer.writerow(["file_name", "CPU score", "GPU score", "RAM (GB)", "CPUs", "GPUs"])
+    for comp in comp_list:
+        writer.writerow([comp["file_name"], comp["CPU score"], comp["GPU score"], comp["RAM (GB)"],
+            "; ".join(comp["CPUs"]), "; ".join(comp["GPUs"])])
 
+def write_json(comp_list, out):
+    json.dump(comp_list, out, indent=4)
     out.write("\n")
 
-out.close()
+report_writers = {"text": write_text, "csv": write_csv, "json": write_json}
+
+def write_report(comp_list, out_file, report_format = "text"):
+    with metrics.timer("stage/write"):
+        # Renamed into place, the report can be read while it is rewritten
+        with atomic_file.open_atomic(out_file, newline="" if report_format == "csv" else None) as out:
+            report_writers[report_format](comp_list, out)
+    metrics.count("bytes/written", os.path.getsize(out_file))
+
+def machine_summary(input_data):
+    # The part of the machine data the scoring and the report need
+    return {"CPUs": input_data["CPUs"], "GPUs": input_data["GPUs"],
+            "RAM": {"Total RAM (GB)": input_data["RAM"]["Total RAM (GB)"]}}
+
+def read_machines(input_files):
+    # Yields the file name and the part of the machine data the scoring and the report need
+    for input_file in input_files:
+        print(input_file)
+        with metrics.timer("stage/load"):
+            with open(input_file, "r") as read_file:
+                input_data = json.load(read_file)
+                metrics.count("bytes/read", read_file.tell())
+
+        file_name = input_file.split("/")[-1].split(".")[0]
+        yield file_name, machine_summary(input_data)
+
+def score_machines(machines, cpu_index, gpu_index):
+    for file_name, machine in machines:
+        with metrics.timer("stage/score"):
+            score_computer(machine, cpu_index, gpu_index)
+        if metrics.enabled:
+            for kind in ["CPU", "GPU"]:
+                known = isinstance(machine[kind + " score"], (int, float))
+                metrics.count(("matches/" if known else "unknown/") + kind)
+        yield report_entry(machine, file_name)
+
+def fuzzy_resolve(machines, cpu_index, gpu_index, min_confidence):
+    # Only imported here, numpy is not needed without --fuzzy
+    import bench_match
+
+    cpu_names = {machine["CPUs"][0]["Version"] for file_name, machine in machines}
+    gpu_names = {machine["GPUs"][0]["Model"] for file_name, machine in machines
+            if len(machine["GPUs"]) != 0 and "NVIDIA" in machine["GPUs"][0]["Vendor"]}
+
+    for index, names, bench_file in [(cpu_index, cpu_names, cpu_bench_file), (gpu_index, gpu_names, gpu_bench_file)]:
+        results = bench_match.resolve(index, names, bench_match.cache_path(bench_file), min_confidence)
+        for name, (bench_name, confidence) in sorted(results.items()):
+            print("Fuzzy match: " + name + " -> " + str(bench_name) + " (confidence %.2f)" % confidence)
+
+def parse_keys(text):
+    keys = []
+    for key in text.split(","):
+        key = key.strip().lower()
+        if key not in rank_keys:
+            raise argparse.ArgumentTypeError("unknown key " + key + ", use a comma separated list of " + ", ".join(rank_keys))
+        keys.append(rank_keys[key])
+    return keys
+
+def main():
+    parser = argparse.ArgumentParser(description="Rank computers by their CPU/GPU benchmark scores.")
+    parser.add_argument("--key", type=parse_keys, default=[rank_keys["cpu"]],
+            help="comma separated sort keys out of " + ", ".join(rank_keys) + " (default: cpu)")
+    limit = parser.add_mutually_exclusive_group()
+    limit.add_argument("--top", type=int, metavar="N", help="only the N highest ranked computers, highest first")
+    limit.add_argument("--bottom", type=int, metavar="N", help="only the N lowest ranked computers, lowest first")
+    parser.add_argument("--unknown", choices=["first", "last"], default="last",
+            help="where computers with unknown (N/A) scores go in the report (default: %(default)s)")
+    parser.add_argument("--format", choices=list(report_writers), default="text",
+            help="report format (default: %(default)s)")
+    parser.add_argument("--fuzzy", action="store_true",
+            help="fuzzy match the CPU/GPU names the benchmark lists don't have exactly (needs numpy)")
+    parser.add_argument("--min-confidence", type=float, default=0.6,
+            help="lowest similarity (0-1) a fuzzy match is used with (default: %(default)s)")
+    parser.add_argument("input_files", nargs="+", help="json files from parse_output.py")
+    parser.add_argument("out_file", help="report file to write")
+    metrics.add_arguments(parser)
+
+    args = parser.parse_args()
+    metrics.setup(args)
+
+    with metrics.timer("stage/load bench"):
+        cpu_index = load_bench(cpu_bench_file)
+        gpu_index = load_bench(gpu_bench_file)
+
+    machines = read_machines(args.input_files)
+    if args.fuzzy:
+        # All names have to be known up front to match them in one batch
+        machines = list(machines)
+        with metrics.timer("stage/fuzzy match"):
+            fuzzy_resolve(machines, cpu_index, gpu_index, args.min_confidence)
+
+    # The machines are read and scored as the ranking pulls them in,
+    # so this includes the load and score stages.
+    with metrics.timer("stage/rank"):
+        entries = score_machines(machines, cpu_index, gpu_index)
+        comp_list = rank(entries, args.key, args.top, args.bottom, args.unknown)
+
+    write_report(comp_list, args.out_file, args.format)
+
+    metrics.finish(args, "create_bench_rank_list")
+
+if __name__ == "__main__":
+    main()
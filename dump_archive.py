@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+import os
+import gzip
+import tarfile
+
+# Reading dumps straight out of archives, without unpacking them first.
+#
+# Tarballs (.tar, .tar.gz/.tgz, .tar.zst) are read as a stream, one member
+# at a time in archive order, so only the member being read is held in
+# memory. A single .gz file is one dump.
+#
+# A member is named as if the archive was a directory, for example
+# "dumps.tar.gz/hw_data/alice". So os.path.basename() gives the same user
+# name and output file name as for the extracted file.
+#
+# .tar.zst needs Python 3.14 (compression.zstd) or the zstandard package.
+
+tar_suffixes = (".tar", ".tar.gz", ".tgz", ".tar.zst", ".tar.zstd")
+
+class ArchiveError(Exception):
+    pass
+
+def is_archive(path):
+    return path.endswith(tar_suffixes) or path.endswith(".gz")
+
+def open_zstd(path):
+    # Only imported here, the other archives don't need it
+    try:
+        from compression import zstd
+        return zstd.open(path, "rb")
+    except ImportError:
+        pass
+    try:
+        import zstandard
+    except ImportError:
+        raise ArchiveError("Reading " + path + " needs the zstandard package (pip install zstandard)")
+    return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), read_across_frames=True)
+
+def iter_members(path, suffix = None):
+    # Yield (name, content bytes) for the files in an archive.
+    # Hidden files are skipped, and with suffix only the files ending with it.
+    if not path.endswith(tar_suffixes):
+        # A single gzipped file
+        try:
+            with gzip.open(path, "rb") as f:
+                data = f.read()
+        except (EOFError, OSError) as e:
+            raise ArchiveError("Couldn't read " + path + ": " + str(e))
+        yield path[:-len(".gz")], data
+        return
+
+    fileobj = None
+    tar = None
+    try:
+        if path.endswith((".tar.zst", ".tar.zstd")):
+            fileobj = open_zstd(path)
+            tar = tarfile.open(fileobj=fileobj, mode="r|")
+        else:
+            # Stream mode, compression is detected from the content
+            tar = tarfile.open(path, mode="r|*")
+
+        for member in tar:
+            if not member.isfile():
+                continue
+            name = os.path.normpath(member.name)
+            if os.path.basename(name).startswith(".") or (suffix is not None and not name.endswith(suffix)):
+                continue
+            yield path + "/" + name, tar.extractfile(member).read()
+    except (tarfile.TarError, EOFError, OSError) as e:
+        raise ArchiveError("Couldn't read " + path + ": " + str(e))
+    finally:
+        if tar is not None:
+            tar.close()
+        if fileobj is not None:
+            fileobj.close()
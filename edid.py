@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+
+import sys
+import struct
+
+# Decoder for binary EDID blobs, like /sys/class/drm/card0-DP-1/edid.
+#
+# Only the base block (the first 128 bytes) is decoded, it has everything
+# the monitor section needs. edid_lines() prints the same lines as the
+# "Monitor info" section of hw_script.sh, so parse_output.py can read them.
+
+edid_header = b"\x00\xff\xff\xff\xff\xff\xff\x00"
+
+bit_depths = {1: 6, 2: 8, 3: 10, 4: 12, 5: 14, 6: 16}
+
+color_encodings = [
+        ["RGB 4:4:4"],
+        ["RGB 4:4:4", "YCrCb 4:4:4"],
+        ["RGB 4:4:4", "YCrCb 4:2:2"],
+        ["RGB 4:4:4", "YCrCb 4:4:4", "YCrCb 4:2:2"],
+        ]
+
+class EdidError(Exception):
+    pass
+
+def descriptor_text(desc):
+    # Text descriptors end with a newline and are padded with spaces
+    text = bytes(desc[5:18]).split(b"\x0a")[0]
+    return text.decode("cp437").strip()
+
+def detailed_timing(desc):
+    pixel_clock = struct.unpack_from("<H", desc, 0)[0] * 10000
+    h_active = desc[2] | (desc[4] & 0xF0) << 4
+    h_blank = desc[3] | (desc[4] & 0x0F) << 8
+    v_active = desc[5] | (desc[7] & 0xF0) << 4
+    v_blank = desc[6] | (desc[7] & 0x0F) << 8
+    interlaced = (desc[17] & 0x80) != 0
+
+    total = (h_active + h_blank) * (v_active + v_blank)
+    refresh = pixel_clock / total if total != 0 else 0
+    if interlaced:
+        v_active *= 2
+        refresh *= 2
+
+    return {"width": h_active, "height": v_active, "refresh": refresh, "interlaced": interlaced}
+
+def range_limits(desc):
+    # The offset flags of EDID 1.4 add 255 to the rates
+    flags = desc[4]
+    limits = {
+            "min_v": desc[5] + (255 if flags & 0x01 else 0),
+            "max_v": desc[6] + (255 if flags & 0x02 else 0),
+            "min_h": desc[7] + (255 if flags & 0x04 else 0),
+            "max_h": desc[8] + (255 if flags & 0x08 else 0),
+            "max_clock": desc[9] * 10,
+            }
+    return limits
+
+def decode_edid(blob):
+    data = memoryview(blob)
+    if len(data) < 128 or bytes(data[0:8]) != edid_header:
+        raise EdidError("Not an EDID blob")
+
+    edid = dict()
+
+    vendor = struct.unpack_from(">H", data, 8)[0]
+    edid["vendor"] = "".join(chr(((vendor >> shift) & 0x1F) + 64) for shift in (10, 5, 0))
+    edid["product"], edid["serial"] = struct.unpack_from("<HI", data, 10)
+    edid["week"] = data[16]
+    edid["year"] = data[17] + 1990
+    edid["version"] = (data[18], data[19])
+
+    digital = (data[20] & 0x80) != 0
+    edid["digital"] = digital
+    edid["bits"] = None
+    edid["color_formats"] = None
+    if digital and edid["version"] >= (1, 4):
+        edid["bits"] = bit_depths.get((data[20] >> 4) & 0x07)
+        edid["color_formats"] = color_encodings[(data[24] >> 3) & 0x03]
+
+    edid["size_cm"] = (data[21], data[22])
+
+    edid["name"] = None
+    edid["serial_string"] = None
+    edid["range_limits"] = None
+    edid["native"] = None
+
+    for offset in range(54, 126, 18):
+        desc = data[offset:offset + 18]
+        if desc[0] != 0 or desc[1] != 0:
+            # The first detailed timing is the preferred (native) one
+            if edid["native"] is None:
+                edid["native"] = detailed_timing(desc)
+            continue
+        tag = desc[3]
+        if tag == 0xFC:
+            edid["name"] = descriptor_text(desc)
+        elif tag == 0xFF:
+            edid["serial_string"] = descriptor_text(desc)
+        elif tag == 0xFD:
+            edid["range_limits"] = range_limits(desc)
+
+    return edid
+
+def edid_lines(blob):
+    # The monitor lines as hw_script.sh writes them, between "Section" and "EndSection"
+    edid = decode_edid(blob)
+    lines = []
+
+    if edid["name"] is not None:
+        lines.append("Display Product Name: '" + edid["name"] + "'")
+    # Not every monitor has a serial number descriptor, the serial number in
+    # the header is used then, the merge needs a serial for every monitor
+    serial = edid["serial_string"] if edid["serial_string"] is not None else str(edid["serial"])
+    lines.append("Display Product Serial Number: '" + serial + "'")
+    lines.append("Manufacturer: " + edid["vendor"])
+
+    if edid["week"] == 0xFF:
+        lines.append("Model year: %d" % edid["year"])
+    elif edid["week"] == 0:
+        lines.append("Made in: %d" % edid["year"])
+    else:
+        lines.append("Made in: week %d of %d" % (edid["week"], edid["year"]))
+
+    width, height = edid["size_cm"]
+    if width != 0 and height != 0:
+        lines.append("Maximum image size: %d cm x %d cm" % (width, height))
+
+    if edid["bits"] is not None:
+        lines.append("Bits per primary color channel: %d" % edid["bits"])
+    if edid["color_formats"] is not None:
+        lines.append("Supported color formats: " + ", ".join(edid["color_formats"]))
+
+    limits = edid["range_limits"]
+    if limits is not None:
+        lines.append("Monitor ranges (Bare Limits): %d-%d Hz V, %d-%d kHz H, max dotclock %d MHz" %
+                (limits["min_v"], limits["max_v"], limits["min_h"], limits["max_h"], limits["max_clock"]))
+
+    native = edid["native"]
+    if native is not None:
+        lines.append("Native Video Resolution: %dx%d%s %.3f Hz" %
+                (native["width"], native["height"], "i" if native["interlaced"] else "", native["refresh"]))
+
+    return lines
+
+def main():
+    if len(sys.argv) < 2:
+        print("You need to provide an EDID file to decode!")
+        sys.exit(1)
+
+    for edid_file in sys.argv[1:]:
+        with open(edid_file, "rb") as f:
+            blob = f.read()
+        if len(blob) == 0:
+            # Connected, but the monitor didn't give us an EDID
+            continue
+        try:
+            lines = edid_lines(blob)
+        except EdidError as e:
+            print(edid_file + ": " + str(e), file=sys.stderr)
+            continue
+        for line in lines:
+            print(line)
+
+if __name__ == "__main__":
+    main()
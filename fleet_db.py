@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+
+import sys
+import json
+import os
+import sqlite3
+
+import atomic_file
+import hw_ledger
+import hw_records
+
+# Storage for the HW database used by process_json_data.py.
+#
+# Two backends are supported, picked by the file extension:
+#  - .json: the whole database in one json file (rewritten atomically on save)
+#  - .db/.sqlite: a SQLite database where only the changed computers and HW entries are written
+#
+# Both load into the same layout:
+# {"Computers": {serial: data}, "HW": {"used": {category: [...]}, "unused": {category: [...]}}}
+#
+# In SQLite every HW entry is a row, found by its state, category, match key
+# and computer. pos keeps the order of the lists: the rows are read back in
+# pos order, and the entries added by a merge get positions in front of the
+# others, the same place they have in the lists.
+
+sqlite_extensions = (".db", ".sqlite")
+
+schema = """
+CREATE TABLE IF NOT EXISTS computers (
+    serial TEXT PRIMARY KEY,
+    pos INTEGER NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS hw_entries (
+    id INTEGER PRIMARY KEY,
+    state TEXT NOT NULL,
+    category TEXT NOT NULL,
+    match_key TEXT NOT NULL,
+    comp_serial TEXT,
+    pos INTEGER NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS hw_entries_key ON hw_entries (state, category, match_key, comp_serial);
+"""
+
+def empty_database():
+    return {"Computers": {}, "HW": {"used": {}, "unused": {}}}
+
+def is_sqlite(path):
+    return path.endswith(sqlite_extensions)
+
+def open_sqlite(path):
+    conn = sqlite3.connect(path)
+    conn.executescript(schema)
+    migrate_hw(conn)
+    return conn
+
+def migrate_hw(conn):
+    # Databases written before hw_entries keep each HW list as one json blob in hw
+    if conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'hw'").fetchone() is None:
+        return
+    with conn:
+        rows = []
+        for state, category, data in conn.execute("SELECT state, category, data FROM hw ORDER BY pos"):
+            rows += [(state, category, entry) for entry in json.loads(data)]
+        insert_hw(conn, rows, 0)
+        conn.execute("DROP TABLE hw")
+
+def hw_row(state, category, entry):
+    key = json.dumps(hw_ledger.match_key(entry, category))
+    return (state, category, key, entry.get("Comp Serial"), json.dumps(entry, default=hw_records.json_default))
+
+def insert_hw(conn, rows, first_pos):
+    # rows are (state, category, entry), they get the positions from first_pos on
+    conn.executemany("INSERT INTO hw_entries (state, category, match_key, comp_serial, data, pos) VALUES (?, ?, ?, ?, ?, ?)",
+            (hw_row(state, category, entry) + (first_pos + i,) for i, (state, category, entry) in enumerate(rows)))
+
+def load_json(path):
+    if not os.path.isfile(path):
+        return empty_database()
+
+    with open(path, 'r') as data_file:
+        data = data_file.read()
+
+    return json.loads(data)
+
+def save_json(path, database):
+    # Write to a temp file and rename it over the old one,
+    # so a crash never leaves a half written database behind.
+    with atomic_file.open_atomic(path, sync=True) as data_file:
+        json.dump(database, data_file, default=hw_records.json_default)
+
+def load_sqlite(conn):
+    database = empty_database()
+
+    for serial, data in conn.execute("SELECT serial, data FROM computers ORDER BY pos"):
+        database["Computers"][serial] = json.loads(data)
+
+    hw = database["HW"]
+    for state, category, data in conn.execute("SELECT state, category, data FROM hw_entries ORDER BY pos, id"):
+        hw[state].setdefault(category, []).append(json.loads(data))
+
+    return database
+
+def save_sqlite(conn, database, changed_serials, hw_changes = None):
+    # hw_changes is hw_ledger.changes() of the merge, without it all of the HW is rewritten
+    computers = database["Computers"]
+
+    # Everything is written in one transaction, so the update is atomic
+    with conn:
+        next_pos = conn.execute("SELECT COALESCE(MAX(pos), -1) + 1 FROM computers").fetchone()[0]
+        for serial in changed_serials:
+            # Updated computers are moved to the end, the same as in the json layout
+            conn.execute("INSERT OR REPLACE INTO computers (serial, pos, data) VALUES (?, ?, ?)",
+                    (serial, next_pos, json.dumps(computers[serial], default=hw_records.json_default)))
+            next_pos += 1
+
+        if hw_changes is None:
+            conn.execute("DELETE FROM hw_entries")
+            insert_hw(conn, [(state, category, entry) for state in ["used", "unused"]
+                    for category, entries in database["HW"][state].items() for entry in entries], 0)
+            return
+
+        for state, category, entry in hw_changes["removed"]:
+            # Entries of the same part in the same computer are alike, the one with the
+            # same data (and the last one of those, as the ledger takes) is deleted
+            state, category, key, comp_serial, data = hw_row(state, category, entry)
+            conn.execute("""DELETE FROM hw_entries WHERE id = (SELECT id FROM hw_entries
+                    WHERE state = ? AND category = ? AND match_key = ? AND comp_serial IS ?
+                    ORDER BY data = ? DESC, pos DESC LIMIT 1)""", (state, category, key, comp_serial, data))
+
+        # The new entries go in front of the others
+        first_pos = conn.execute("SELECT COALESCE(MIN(pos), 0) FROM hw_entries").fetchone()[0]
+        insert_hw(conn, hw_changes["added"], first_pos - len(hw_changes["added"]))
+
+def load_database(path):
+    # The RAM sticks, drives, GPUs and monitors are loaded as hw_records records
+    if not is_sqlite(path):
+        return hw_records.pack_database(load_json(path))
+
+    conn = open_sqlite(path)
+    try:
+        return hw_records.pack_database(load_sqlite(conn))
+    finally:
+        conn.close()
+
+def save_database(path, database, changed_serials, hw_changes = None):
+    if not is_sqlite(path):
+        save_json(path, database)
+        return
+
+    conn = open_sqlite(path)
+    try:
+        save_sqlite(conn, database, changed_serials, hw_changes)
+    finally:
+        conn.close()
+
+def main():
+    if len(sys.argv) != 4 or sys.argv[1] not in ["export", "import"]:
+        print("Usage: fleet_db.py export <database.db> <output.json>")
+        print("       fleet_db.py import <data.json> <database.db>")
+        sys.exit(1)
+
+    command, in_path, out_path = sys.argv[1:]
+
+    if command == "export":
+        save_json(out_path, load_database(in_path))
+    else:
+        database = load_json(in_path)
+        if not is_sqlite(out_path):
+            print("The import target must be a .db or .sqlite file")
+            sys.exit(1)
+        if os.path.exists(out_path):
+            print("The import target " + out_path + " already exists")
+            sys.exit(1)
+        save_database(out_path, database, database["Computers"])
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import json
+import time
+import bisect
+import argparse
+import datetime
+
+import atomic_file
+import hw_records
+
+# History of the computers in the HW database, one entry per merge.
+#
+# The history is a json lines file next to the database. Every merge starts with a header line:
+#   {"merge": <seq>, "time": <unix time>, "checkpoint": <bool>}
+# followed by one line per computer:
+#   {"serial": <serial>, "full": <data>}                 in checkpoints and for new computers
+#   {"serial": <serial>, "set": {key: value}, "del": [key]}   the changed top level keys otherwise
+# Computers that didn't change are not written, so the file grows with the churn.
+# Every checkpoint_interval merges all computers are written in full, so a
+# lookup only has to replay the merges since the last checkpoint.
+#
+# A sidecar file has one line per merge: [seq, time, offset of the header line, checkpoint].
+
+checkpoint_interval = 20
+
+def history_path(db_path):
+    return db_path + ".history"
+
+def offsets_path(path):
+    return path + ".offsets"
+
+def scan_offsets(path):
+    # Rebuild the sidecar data from the history file itself
+    offsets = []
+    if not os.path.isfile(path):
+        return offsets
+    with open(path, "rb") as f:
+        offset = 0
+        for line in f:
+            if line.startswith(b'{"merge": '):
+                header = json.loads(line)
+                offsets.append([header["merge"], header["time"], offset, header["checkpoint"]])
+            offset += len(line)
+    return offsets
+
+def load_offsets(path):
+    sidecar = offsets_path(path)
+    if not os.path.isfile(sidecar):
+        offsets = scan_offsets(path)
+        write_offsets(path, offsets)
+        return offsets
+    with open(sidecar, "r") as f:
+        offsets = [json.loads(line) for line in f if len(line.strip()) != 0]
+
+    # A crash between writing the history and the sidecar leaves the last merge out
+    # of the sidecar, look for merge headers after the last one it knows about.
+    if os.path.isfile(path):
+        with open(path, "rb") as f:
+            if len(offsets) != 0:
+                f.seek(offsets[-1][2])
+                f.readline()
+            for line in f:
+                if line.startswith(b'{"merge": '):
+                    offsets = scan_offsets(path)
+                    write_offsets(path, offsets)
+                    break
+    return offsets
+
+def write_offsets(path, offsets):
+    with atomic_file.open_atomic(offsets_path(path)) as f:
+        for entry in offsets:
+            f.write(json.dumps(entry) + "\n")
+
+def diff(old, new):
+    changed = {key: value for key, value in new.items() if key not in old or old[key] != value}
+    removed = [key for key in old if key not in new]
+    return changed, removed
+
+def record_merge(path, previous, database, changed_serials, when = None):
+    # previous is the Computers dict from before the merge (a shallow copy is enough,
+    # the merge replaces the computer data instead of changing it)
+    offsets = load_offsets(path)
+    seq = offsets[-1][0] + 1 if len(offsets) != 0 else 0
+    when = time.time() if when is None else when
+
+    since_checkpoint = 0
+    for entry in reversed(offsets):
+        if entry[3]:
+            break
+        since_checkpoint += 1
+    checkpoint = len(offsets) == 0 or since_checkpoint + 1 >= checkpoint_interval
+
+    lines = [json.dumps({"merge": seq, "time": when, "checkpoint": checkpoint})]
+    computers = database["Computers"]
+    if checkpoint:
+        for serial, data in computers.items():
+            lines.append(json.dumps({"serial": serial, "full": data}, default=hw_records.json_default))
+    else:
+        for serial in changed_serials:
+            data = computers[serial]
+            if serial not in previous:
+                lines.append(json.dumps({"serial": serial, "full": data}, default=hw_records.json_default))
+                continue
+            changed, removed = diff(previous[serial], data)
+            if len(changed) != 0 or len(removed) != 0:
+                lines.append(json.dumps({"serial": serial, "set": changed, "del": removed}, default=hw_records.json_default))
+
+    with open(path, "ab") as f:
+        offset = f.tell()
+        f.write(("\n".join(lines) + "\n").encode("utf-8"))
+        f.flush()
+        os.fsync(f.fileno())
+
+    with open(offsets_path(path), "a") as f:
+        f.write(json.dumps([seq, when, offset, checkpoint]) + "\n")
+
+    return seq
+
+def apply_record(computers, record):
+    serial = record["serial"]
+    if "full" in record:
+        computers[serial] = record["full"]
+        return
+    data = dict(computers.get(serial, {}))
+    data.update(record["set"])
+    for key in record["del"]:
+        data.pop(key, None)
+    computers[serial] = data
+
+def replay_range(path, offsets, when):
+    # The byte range to replay for the state at time when: from the last
+    # checkpoint before it to the end of the last merge before it.
+    times = [entry[1] for entry in offsets]
+    last = bisect.bisect_right(times, when) - 1
+    if last < 0:
+        return None
+    first = last
+    while first > 0 and not offsets[first][3]:
+        first -= 1
+    end = offsets[last + 1][2] if last + 1 < len(offsets) else os.path.getsize(path)
+    return offsets[first][2], end
+
+def fleet_at(path, when):
+    # All computers as they were at time when
+    computers = dict()
+    span = replay_range(path, load_offsets(path), when)
+    if span is None:
+        return computers
+    with open(path, "rb") as f:
+        f.seek(span[0])
+        data = f.read(span[1] - span[0])
+    for line in data.splitlines():
+        record = json.loads(line)
+        if "merge" in record:
+            if record["checkpoint"]:
+                computers = dict()
+            continue
+        apply_record(computers, record)
+    return computers
+
+def computer_at(path, serial, when):
+    # One computer as it was at time when, None if it wasn't known yet
+    span = replay_range(path, load_offsets(path), when)
+    if span is None:
+        return None
+    # Only the lines of this computer are parsed
+    prefix = ('{"serial": ' + json.dumps(serial) + ',').encode("utf-8")
+    computers = dict()
+    with open(path, "rb") as f:
+        f.seek(span[0])
+        data = f.read(span[1] - span[0])
+    for line in data.splitlines():
+        if line.startswith(prefix):
+            apply_record(computers, json.loads(line))
+        elif line.startswith(b'{"merge": ') and b'"checkpoint": true' in line:
+            computers = dict()
+    return computers.get(serial)
+
+def parse_time(text):
+    # A unix time, an ISO date (the end of that day) or an ISO date and time
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    moment = datetime.datetime.fromisoformat(text)
+    if len(text) == 10:
+        moment += datetime.timedelta(days=1)
+        return moment.timestamp() - 1e-6
+    return moment.timestamp()
+
+def format_time(when):
+    return datetime.datetime.fromtimestamp(when).isoformat(sep=" ", timespec="seconds")
+
+def print_log(path, serial):
+    offsets = load_offsets(path)
+    prefix = None if serial is None else ('{"serial": ' + json.dumps(serial) + ',').encode("utf-8")
+    with open(path, "rb") as f:
+        for idx, (seq, when, offset, checkpoint) in enumerate(offsets):
+            end = offsets[idx + 1][2] if idx + 1 < len(offsets) else os.path.getsize(path)
+            f.seek(offset)
+            lines = f.read(end - offset).splitlines()[1:]
+            kind = "checkpoint" if checkpoint else "delta"
+            if prefix is None:
+                print("%5d  %s  %-10s  %d computers" % (seq, format_time(when), kind, len(lines)))
+                continue
+            for line in lines:
+                if line.startswith(prefix):
+                    record = json.loads(line)
+                    if "full" in record:
+                        keys = "full" if checkpoint else "new"
+                    else:
+                        keys = ", ".join(list(record["set"]) + ["-" + key for key in record["del"]])
+                    print("%5d  %s  %-10s  %s" % (seq, format_time(when), kind, keys))
+
+def main():
+    parser = argparse.ArgumentParser(description="Look at the merge history of the HW database.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    show = commands.add_parser("show", help="print a computer as it was at a point in time")
+    show.add_argument("history", help="history file (the database path + .history)")
+    show.add_argument("serial", help="motherboard serial of the computer")
+    show.add_argument("--at", default=None, help="unix time or ISO date/time (default: now)")
+
+    fleet = commands.add_parser("fleet", help="write all computers as they were at a point in time as json")
+    fleet.add_argument("history", help="history file (the database path + .history)")
+    fleet.add_argument("--at", default=None, help="unix time or ISO date/time (default: now)")
+    fleet.add_argument("-o", "--output", help="write to this file instead of stdout")
+
+    log = commands.add_parser("log", help="list the merges, or the changes of one computer")
+    log.add_argument("history", help="history file (the database path + .history)")
+    log.add_argument("serial", nargs="?", help="only list the merges that changed this computer")
+
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.history):
+        print("The history file " + args.history + " doesn't exist")
+        sys.exit(1)
+
+    if args.command == "log":
+        print_log(args.history, args.serial)
+        return
+
+    when = time.time() if args.at is None else parse_time(args.at)
+
+    if args.command == "show":
+        data = computer_at(args.history, args.serial, when)
+        if data is None:
+            print("No history for " + args.serial + " at " + format_time(when))
+            sys.exit(1)
+        print(json.dumps(data, indent=4))
+        return
+
+    out_json = json.dumps(fleet_at(args.history, when))
+    if args.output is None:
+        print(out_json)
+    else:
+        with open(args.output, "w") as f:
+            f.write(out_json)
+
+if __name__ == "__main__":
+    main()
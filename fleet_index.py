@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+
+import sys
+import json
+import os
+import argparse
+import sqlite3
+
+import fleet_db
+import hw_records
+
+# Secondary indexes over the HW database, to find where a component lives
+# without loading and scanning the whole database.
+#
+# The index is a SQLite file next to the database. Every computer and every
+# HW used/unused entry is stored once, and its lookup values are stored in
+# an indexed key table:
+#  - "serial": Serial Number, SN, UUID and Part Number of the HW entries
+#  - "model": Model, Model Number, Product Name and Version of the HW entries
+#  - "comp": the serial of the computer the entry is in (Comp Serial)
+#  - "user": the User of the computer
+# Lookups are case insensitive.
+#
+# process_json_data.py keeps it up to date: after a merge only the merged
+# computers and the HW entries the merge added or removed are written.
+
+fields = ["serial", "model", "comp", "user"]
+
+field_keys = {
+        "serial": ["Serial Number", "SN", "UUID", "Part Number"],
+        "model": ["Model", "Model Number", "Product Name", "Version"],
+        }
+
+schema = """
+CREATE TABLE IF NOT EXISTS entries (
+    id INTEGER PRIMARY KEY,
+    state TEXT NOT NULL,
+    category TEXT NOT NULL,
+    comp_serial TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_comp ON entries(state, comp_serial);
+CREATE TABLE IF NOT EXISTS keys (
+    field TEXT NOT NULL,
+    value TEXT NOT NULL COLLATE NOCASE,
+    entry INTEGER NOT NULL REFERENCES entries(id) ON DELETE CASCADE
+);
+CREATE INDEX IF NOT EXISTS keys_value ON keys(field, value);
+CREATE INDEX IF NOT EXISTS keys_entry ON keys(entry);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+def index_path(db_path):
+    return db_path + ".index"
+
+def open_index(path):
+    # Returns the connection and if the index was just created (and has to be built)
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA foreign_keys = ON")
+    conn.executescript(schema)
+    built = conn.execute("SELECT value FROM meta WHERE key = 'entries'").fetchone() is not None
+    return conn, not built
+
+def computer_summary(serial, data):
+    return {"Serial": serial, "User": data.get("User"), "Hostname": data.get("Hostname")}
+
+def entry_keys(state, comp_serial, entry):
+    keys = []
+    if state == "computer":
+        keys.append(("user", entry["User"]))
+    else:
+        for field, names in field_keys.items():
+            for name in names:
+                value = entry.get(name)
+                if isinstance(value, str) and len(value.strip()) != 0:
+                    keys.append((field, value.strip()))
+    if comp_serial is not None:
+        keys.append(("comp", comp_serial))
+    return [(field, value) for field, value in keys if value is not None]
+
+def insert_entry(conn, state, category, comp_serial, entry):
+    cur = conn.execute("INSERT INTO entries (state, category, comp_serial, data) VALUES (?, ?, ?, ?)",
+            (state, category, comp_serial, json.dumps(entry, default=hw_records.json_default)))
+    entry_id = cur.lastrowid
+
+    conn.executemany("INSERT INTO keys (field, value, entry) VALUES (?, ?, ?)",
+            [(field, value, entry_id) for field, value in entry_keys(state, comp_serial, entry)])
+
+def insert_computer(conn, serial, data):
+    insert_entry(conn, "computer", "Computer", serial, computer_summary(serial, data))
+
+def insert_hw(conn, state, category, entry):
+    insert_entry(conn, state, category, entry.get("Comp Serial"), entry)
+
+def delete_hw(conn, state, category, entry):
+    # One row of the entry is deleted (its keys go with it). It is found through
+    # its first lookup key, so the unused HW isn't scanned.
+    comp_serial = entry.get("Comp Serial")
+    data = json.dumps(entry, default=hw_records.json_default)
+    keys = entry_keys(state, comp_serial, entry)
+    if len(keys) != 0:
+        conn.execute("""DELETE FROM entries WHERE id = (SELECT e.id FROM keys k JOIN entries e ON e.id = k.entry
+                WHERE k.field = ? AND k.value = ? AND e.state = ? AND e.category = ? AND e.comp_serial IS ? AND e.data = ?
+                ORDER BY e.id DESC LIMIT 1)""", keys[0] + (state, category, comp_serial, data))
+    else:
+        conn.execute("""DELETE FROM entries WHERE id = (SELECT id FROM entries
+                WHERE state = ? AND category = ? AND comp_serial IS ? AND data = ?
+                ORDER BY id DESC LIMIT 1)""", (state, category, comp_serial, data))
+
+def entry_count(database):
+    count = len(database["Computers"])
+    for state in ["used", "unused"]:
+        for entries in database["HW"][state].values():
+            count += len(entries)
+    return count
+
+def rebuild(conn, database):
+    with conn:
+        conn.execute("DELETE FROM keys")
+        conn.execute("DELETE FROM entries")
+        for serial, data in database["Computers"].items():
+            insert_computer(conn, serial, data)
+        for state in ["used", "unused"]:
+            for category, entries in database["HW"][state].items():
+                for entry in entries:
+                    insert_hw(conn, state, category, entry)
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('entries', ?)", (str(entry_count(database)),))
+
+def update(conn, database, changed_serials, hw_changes):
+    # Rewrite the changed computers and apply the HW changes of the merge (hw_ledger.changes())
+    with conn:
+        for serial in changed_serials:
+            conn.execute("DELETE FROM entries WHERE state = 'computer' AND comp_serial = ?", (serial,))
+            if serial in database["Computers"]:
+                insert_computer(conn, serial, database["Computers"][serial])
+        for state, category, entry in hw_changes["removed"]:
+            delete_hw(conn, state, category, entry)
+        for state, category, entry in hw_changes["added"]:
+            insert_hw(conn, state, category, entry)
+
+        expected = entry_count(database)
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('entries', ?)", (str(expected),))
+        count = conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    if count != expected:
+        # The index doesn't match the database it was updated from, start over
+        rebuild(conn, database)
+
+def sync(path, database, changed_serials, hw_changes = None):
+    # Update the index at path after a merge. A new index, or one without the
+    # HW changes of the merge, is built from scratch.
+    conn, new = open_index(path)
+    if new or hw_changes is None:
+        rebuild(conn, database)
+    else:
+        update(conn, database, changed_serials, hw_changes)
+    conn.close()
+
+def lookup(conn, field, value):
+    # The entries with the given field value, with the User of the computer they are in
+    results = []
+    rows = conn.execute("""
+        SELECT e.state, e.category, e.comp_serial, e.data, c.data
+        FROM keys k
+        JOIN entries e ON e.id = k.entry
+        LEFT JOIN entries c ON c.state = 'computer' AND c.comp_serial = e.comp_serial
+        WHERE k.field = ? AND k.value = ?
+        ORDER BY e.id""", (field, value))
+    for state, category, comp_serial, data, comp_data in rows:
+        user = json.loads(comp_data)["User"] if comp_data is not None else None
+        results.append({"state": state, "category": category, "comp_serial": comp_serial,
+            "user": user, "entry": json.loads(data)})
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Look up components and computers in the HW database index.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    find = commands.add_parser("lookup", help="find the entries with a serial, model, computer serial or user")
+    find.add_argument("index", help="index file (the database path + .index)")
+    find.add_argument("field", choices=fields)
+    find.add_argument("value")
+    find.add_argument("--json", action="store_true", help="print the results as json")
+
+    build = commands.add_parser("rebuild", help="build the index of a database from scratch")
+    build.add_argument("database", help="a .json or .db/.sqlite database")
+    build.add_argument("index", nargs="?", help="index file (default: the database path + .index)")
+
+    args = parser.parse_args()
+
+    if args.command == "rebuild":
+        conn, new = open_index(args.index if args.index is not None else index_path(args.database))
+        rebuild(conn, fleet_db.load_database(args.database))
+        conn.close()
+        return
+
+    if not os.path.isfile(args.index):
+        print("The index " + args.index + " doesn't exist")
+        sys.exit(1)
+
+    conn, new = open_index(args.index)
+    results = lookup(conn, args.field, args.value)
+    conn.close()
+
+    if args.json:
+        print(json.dumps(results, indent=4))
+        return
+
+    for result in results:
+        if result["state"] == "computer":
+            print("Computer " + result["comp_serial"] + " (user " + str(result["user"]) + ")")
+        elif result["comp_serial"] is not None:
+            print(result["category"] + ", " + result["state"] + " in computer " + result["comp_serial"] +
+                    " (user " + str(result["user"]) + ")")
+        else:
+            print(result["category"] + ", " + result["state"])
+        print("    " + json.dumps(result["entry"]))
+
+    if len(results) == 0:
+        print("No match")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
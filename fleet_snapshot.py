@@ -0,0 +1,379 @@
+#!/usr/bin/env python
+
+import sys
+import re
+import json
+import mmap
+import time
+import array
+import struct
+import argparse
+
+import atomic_file
+import fleet_db
+
+# Columnar snapshot of the HW database, for aggregate queries without loading data.json.
+#
+# There is one table for the computers and one per HW category (the HW used/unused lists).
+# Every column is stored as a flat array:
+#  - "float": float64 values, missing values are NaN
+#  - "string": uint32 codes into a dictionary of the distinct values, missing values are missing_code
+# Values that are not strings or numbers (lists) are stored as their json text.
+#
+# File layout: header (magic, offset and length of the table of contents), the column
+# data (8 byte aligned), then the table of contents as json. The file is memory-mapped
+# on open and the columns are used in place.
+
+magic = b"HWSNAP01"
+header = struct.Struct("<8sQQ")
+format_version = 1
+
+missing_code = 0xFFFFFFFF
+
+# Extra numeric columns, computed from the text fields of the entries
+def size_gb(text, base):
+    # The last "<number> <unit>" in the text, in GB
+    sizes = re.findall(r'(\d+(?:\.\d+)?)\s*([MGT])B', text)
+    if len(sizes) == 0:
+        return None
+    number, unit = sizes[-1]
+    return float(number) * {"M": 1 / base, "G": 1, "T": base}[unit]
+
+def drive_size(entry):
+    if entry.get("Type") == "NVME":
+        return size_gb(entry.get("Usage", ""), 1000)
+    return size_gb(entry.get("device size with M = 1000*1000", ""), 1000)
+
+derived_columns = {
+        "RAM": {"Size (GB)": lambda entry: size_gb(entry.get("Size", ""), 1024)},
+        "HDDs": {"Size (GB)": drive_size},
+        }
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def computer_row(serial, data):
+    # Scalar values are kept, dicts are flattened to "Parent/Key" and lists are counted
+    row = {"Serial": serial}
+    for key, value in data.items():
+        if isinstance(value, dict):
+            for sub_key, sub_value in value.items():
+                if isinstance(sub_value, list):
+                    row[key + "/" + sub_key + " count"] = len(sub_value)
+                else:
+                    row[key + "/" + sub_key] = sub_value
+        elif isinstance(value, list):
+            row[key + " count"] = len(value)
+        else:
+            row[key] = value
+    return row
+
+def snapshot_tables(database):
+    tables = dict()
+    tables["Computers"] = [computer_row(serial, data) for serial, data in database["Computers"].items()]
+
+    for state in ["used", "unused"]:
+        for category, entries in database["HW"][state].items():
+            rows = tables.setdefault(category, [])
+            derived = derived_columns.get(category, {})
+            for entry in entries:
+                row = dict(entry)
+                row["State"] = state
+                for name, func in derived.items():
+                    row[name] = func(entry)
+                rows.append(row)
+
+    return tables
+
+def encode_column(values):
+    # Returns the column type, the data array and the dictionary (for strings)
+    present = [value for value in values if value is not None]
+    if all(is_number(value) for value in present):
+        data = array.array("d", (float("nan") if value is None else value for value in values))
+        return "float", data, None
+
+    dictionary = dict()
+    data = array.array("I")
+    for value in values:
+        if value is None:
+            data.append(missing_code)
+            continue
+        if not isinstance(value, str):
+            value = json.dumps(value)
+        data.append(dictionary.setdefault(value, len(dictionary)))
+    return "string", data, list(dictionary)
+
+def encode_dictionary(strings):
+    # uint32 end offsets followed by the utf-8 text
+    blob = bytearray()
+    offsets = array.array("I")
+    for string in strings:
+        blob += string.encode("utf-8")
+        offsets.append(len(blob))
+    return offsets.tobytes() + bytes(blob)
+
+def write_snapshot(path, database):
+    tables = snapshot_tables(database)
+    toc = {"format": format_version, "byteorder": sys.byteorder, "tables": dict()}
+
+    with atomic_file.open_atomic(path, "wb", sync=True) as f:
+        f.write(header.pack(magic, 0, 0))
+
+        def write_blob(blob):
+            offset = f.tell()
+            f.write(blob)
+            # Keep the next blob 8 byte aligned
+            f.write(b"\0" * (-len(blob) % 8))
+            return offset, len(blob)
+
+        for table, rows in tables.items():
+            columns = dict()
+            names = list()
+            for row in rows:
+                for name in row:
+                    if name not in columns:
+                        columns[name] = None
+                        names.append(name)
+
+            toc_columns = dict()
+            for name in names:
+                col_type, data, dictionary = encode_column([row.get(name) for row in rows])
+                offset, length = write_blob(data.tobytes())
+                column = {"type": col_type, "offset": offset, "length": length}
+                if dictionary is not None:
+                    column["dict_offset"], column["dict_length"] = write_blob(encode_dictionary(dictionary))
+                    column["dict_size"] = len(dictionary)
+                toc_columns[name] = column
+
+            toc["tables"][table] = {"rows": len(rows), "columns": toc_columns}
+
+        toc_offset, toc_length = write_blob(json.dumps(toc).encode("utf-8"))
+        f.seek(0)
+        f.write(header.pack(magic, toc_offset, toc_length))
+
+def open_snapshot(path):
+    with open(path, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    file_magic, toc_offset, toc_length = header.unpack_from(mm, 0)
+    if file_magic != magic:
+        raise ValueError(path + " is not a fleet snapshot")
+    toc = json.loads(mm[toc_offset:toc_offset + toc_length].decode("utf-8"))
+    if toc["format"] != format_version or toc["byteorder"] != sys.byteorder:
+        raise ValueError(path + " was written by an incompatible version or machine")
+
+    return {"mmap": mm, "view": memoryview(mm), "toc": toc, "dictionaries": dict()}
+
+def column_info(snap, table, name):
+    tables = snap["toc"]["tables"]
+    if table not in tables:
+        raise KeyError("No table named " + table)
+    if name not in tables[table]["columns"]:
+        raise KeyError("No column named " + name + " in " + table)
+    return tables[table]["columns"][name]
+
+def column(snap, table, name):
+    # The column data in place: float64 values or uint32 dictionary codes
+    info = column_info(snap, table, name)
+    data = snap["view"][info["offset"]:info["offset"] + info["length"]]
+    return data.cast("d" if info["type"] == "float" else "I")
+
+def dictionary(snap, table, name):
+    # The distinct values of a string column, decoded on first use
+    key = (table, name)
+    if key not in snap["dictionaries"]:
+        info = column_info(snap, table, name)
+        size = info["dict_size"]
+        blob = snap["view"][info["dict_offset"]:info["dict_offset"] + info["dict_length"]]
+        offsets = blob[:size * 4].cast("I")
+        text = blob[size * 4:]
+        strings = []
+        start = 0
+        for end in offsets:
+            strings.append(str(text[start:end], "utf-8"))
+            start = end
+        snap["dictionaries"][key] = strings
+    return snap["dictionaries"][key]
+
+def values(snap, table, name):
+    # The column as python values, None for missing values
+    info = column_info(snap, table, name)
+    data = column(snap, table, name)
+    if info["type"] == "float":
+        return [None if value != value else value for value in data]
+    strings = dictionary(snap, table, name)
+    return [None if code == missing_code else strings[code] for code in data]
+
+# --- Queries ---
+
+operators = ["<=", ">=", "!=", "=", "<", ">", "~"]
+
+def parse_condition(snap, table, condition):
+    # "<column><op><value>", the longest matching column name wins
+    # as column names can contain operator characters.
+    names = sorted(snap["toc"]["tables"][table]["columns"], key=len, reverse=True)
+    for name in names:
+        if not condition.startswith(name):
+            continue
+        rest = condition[len(name):]
+        for op in operators:
+            if rest.startswith(op):
+                return name, op, rest[len(op):]
+    raise ValueError("Can't parse the condition: " + condition)
+
+numeric_tests = {
+        "<": lambda a, b: a < b,
+        ">": lambda a, b: a > b,
+        "<=": lambda a, b: a <= b,
+        ">=": lambda a, b: a >= b,
+        "=": lambda a, b: a == b,
+        "!=": lambda a, b: a != b,
+        }
+
+def filter_rows(snap, table, conditions):
+    # Returns a mask with 1 for the rows that match all conditions
+    rows = snap["toc"]["tables"][table]["rows"]
+    mask = bytearray(b"\1" * rows)
+
+    for condition in conditions:
+        name, op, target = parse_condition(snap, table, condition)
+        data = column(snap, table, name)
+
+        if column_info(snap, table, name)["type"] == "float":
+            if op == "~":
+                raise ValueError("~ only works on string columns")
+            test = numeric_tests[op]
+            target = float(target)
+            for idx, value in enumerate(data):
+                # NaN (missing) never matches
+                if mask[idx] and (value != value or not test(value, target)):
+                    mask[idx] = 0
+            continue
+
+        # Test the distinct values once, then only compare codes
+        strings = dictionary(snap, table, name)
+        if op == "=":
+            codes = {code for code, string in enumerate(strings) if string == target}
+        elif op == "!=":
+            codes = {code for code, string in enumerate(strings) if string != target}
+        elif op == "~":
+            target = target.lower()
+            codes = {code for code, string in enumerate(strings) if target in string.lower()}
+        else:
+            raise ValueError(op + " only works on numeric columns")
+        for idx, code in enumerate(data):
+            if mask[idx] and code not in codes:
+                mask[idx] = 0
+
+    return mask
+
+def aggregate(snap, table, name, mask, func):
+    info = column_info(snap, table, name)
+    if info["type"] != "float":
+        raise ValueError(name + " is not a numeric column")
+    selected = [value for value, keep in zip(column(snap, table, name), mask) if keep and value == value]
+    if len(selected) == 0:
+        return None
+    if func == "sum":
+        return sum(selected)
+    elif func == "mean":
+        return sum(selected) / len(selected)
+    elif func == "min":
+        return min(selected)
+    else:
+        return max(selected)
+
+def group_count(snap, table, name, mask):
+    info = column_info(snap, table, name)
+    counts = dict()
+    if info["type"] == "float":
+        for value, keep in zip(column(snap, table, name), mask):
+            if keep:
+                value = None if value != value else value
+                counts[value] = counts.get(value, 0) + 1
+        return counts
+
+    code_counts = dict()
+    for code, keep in zip(column(snap, table, name), mask):
+        if keep:
+            code_counts[code] = code_counts.get(code, 0) + 1
+    strings = dictionary(snap, table, name)
+    for code, count in code_counts.items():
+        counts[None if code == missing_code else strings[code]] = count
+    return counts
+
+def print_info(snap):
+    for table, info in snap["toc"]["tables"].items():
+        print(table + " (" + str(info["rows"]) + " rows)")
+        for name, col in info["columns"].items():
+            if col["type"] == "float":
+                print("    " + name + ": float")
+            else:
+                print("    " + name + ": string (" + str(col["dict_size"]) + " distinct)")
+
+def run_query(snap, args):
+    start = time.perf_counter()
+    mask = filter_rows(snap, args.table, args.where)
+
+    if args.group_by is not None:
+        counts = group_count(snap, args.table, args.group_by, mask)
+        for value, count in sorted(counts.items(), key=lambda item: -item[1]):
+            print("%8d  %s" % (count, value))
+    else:
+        for func in ["sum", "mean", "min", "max"]:
+            name = getattr(args, func)
+            if name is not None:
+                print(func + " " + name + ": " + str(aggregate(snap, args.table, name, mask, func)))
+                break
+        else:
+            print("count: " + str(sum(mask)))
+
+    if args.time:
+        print("%.3f ms" % ((time.perf_counter() - start) * 1000))
+
+def main():
+    parser = argparse.ArgumentParser(description="Columnar snapshots of the HW database for fast fleet queries.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export = commands.add_parser("export", help="write a snapshot of a database (.json or .db/.sqlite)")
+    export.add_argument("database")
+    export.add_argument("snapshot")
+
+    info = commands.add_parser("info", help="list the tables and columns of a snapshot")
+    info.add_argument("snapshot")
+
+    query = commands.add_parser("query", help="count, aggregate or group the rows of a table")
+    query.add_argument("snapshot")
+    query.add_argument("table", help="Computers or a HW category (CPUs, RAM, GPUs, HDDs, Monitors, ...)")
+    query.add_argument("-w", "--where", action="append", default=[], metavar="COND",
+            help="only rows where COND holds: <column><op><value> with op one of "
+            + " ".join(operators) + " (~ is a case insensitive substring match), can be repeated")
+    query.add_argument("--sum", metavar="COLUMN")
+    query.add_argument("--mean", metavar="COLUMN")
+    query.add_argument("--min", metavar="COLUMN")
+    query.add_argument("--max", metavar="COLUMN")
+    query.add_argument("--group-by", metavar="COLUMN", help="count the rows per value of COLUMN")
+    query.add_argument("--time", action="store_true", help="print how long the query took")
+
+    args = parser.parse_args()
+
+    if args.command == "export":
+        write_snapshot(args.snapshot, fleet_db.load_database(args.database))
+        return
+
+    snap = open_snapshot(args.snapshot)
+    if args.command == "info":
+        print_info(snap)
+        return
+
+    if args.table not in snap["toc"]["tables"]:
+        print("No table named " + args.table + ", the tables are: " + ", ".join(snap["toc"]["tables"]))
+        sys.exit(1)
+    try:
+        run_query(snap, args)
+    except (KeyError, ValueError) as e:
+        print(e.args[0])
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
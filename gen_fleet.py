@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+
+import os
+import json
+import random
+import argparse
+
+# Generates synthetic hw_script.sh dumps for a fleet of machines.
+#
+# Every machine is generated from its own seeded random generator, so the same
+# seed always gives the same fleet. Later runs (--run N) apply churn on top of
+# run 0: components get swapped and some machines stop reporting.
+
+cpu_models = [
+        ("Intel(R) Corporation", "Intel(R) Core(TM) i7-8700K CPU @ 3.70GHz", "LGA1151", 12, 3700, "Intel Core i7-8700K @ 3.70GHz", 15960),
+        ("Intel(R) Corporation", "Intel(R) Core(TM) i9-9900K CPU @ 3.60GHz", "LGA1151", 16, 3600, "Intel Core i9-9900K @ 3.60GHz", 18850),
+        ("Intel(R) Corporation", "Intel(R) Xeon(R) W-2145 CPU @ 3.70GHz", "LGA2066", 16, 3700, "Intel Xeon W-2145 @ 3.70GHz", 17650),
+        ("Advanced Micro Devices, Inc.", "AMD Ryzen 9 3900X 12-Core Processor", "AM4", 24, 3800, "AMD Ryzen 9 3900X 12-Core", 32860),
+        ("Advanced Micro Devices, Inc.", "AMD Ryzen Threadripper 2950X 16-Core Processor", "SP3r2", 32, 3500, "AMD Ryzen Threadripper 2950X 16-Core", 30860),
+        ]
+
+gpu_models = [
+        ("NVIDIA Corporation", "GeForce GTX 1080 Ti", 10350),
+        ("NVIDIA Corporation", "GeForce RTX 2080 Ti", 12350),
+        ("NVIDIA Corporation", "Quadro RTX 6000", 12900),
+        ("NVIDIA Corporation", "GeForce RTX 3090", 18600),
+        ("Advanced Micro Devices, Inc. [AMD/ATI]", "Navi 10 [Radeon RX 5600 OEM/5600 XT / 5700/5700 XT]", None),
+        ]
+
+mobo_models = [
+        ("ASUSTeK COMPUTER INC.", "PRIME Z370-A"),
+        ("ASUSTeK COMPUTER INC.", "ROG STRIX X570-E GAMING"),
+        ("Gigabyte Technology Co., Ltd.", "X399 AORUS PRO-CF"),
+        ("Dell Inc.", "0X8DXD"),
+        ]
+
+ram_models = [
+        ("Samsung", "M378A2K43CB1-CTD", "16 GB", "DDR4", "2666 MT/s"),
+        ("Kingston", "KHX3200C16D4/16GX", "16 GB", "DDR4", "3200 MT/s"),
+        ("Micron", "8ATF1G64AZ-2G6E1", "8 GB", "DDR4", "2666 MT/s"),
+        ("Corsair", "CMK32GX4M2B3200C16", "32 GB", "DDR4", "3200 MT/s"),
+        ]
+
+sata_models = [
+        ("Samsung SSD 860 EVO 500GB", "RVT01B6Q", 500107, "2.5 inch", "Solid State Device"),
+        ("WDC WD40EFRX-68N32N0", "82.00A82", 4000787, "3.5 inch", "5400"),
+        ("ST2000DM008-2FR102", "0001", 2000398, "3.5 inch", "7200"),
+        ]
+
+nvme_models = [
+        ("Samsung SSD 970 EVO Plus 1TB", "1.00  TB", "2B2QEXM7"),
+        ("WDS500G3X0C-00SJG0", "500.11  GB", "102000WD"),
+        ]
+
+monitor_models = [
+        ("DELL U2415", "DEL", 53, 30, "1920x1200", "56-76"),
+        ("DELL P2419H", "DEL", 53, 30, "1920x1080", "56-76"),
+        ("LG HDR 4K", "GSM", 60, 34, "3840x2160", "56-61"),
+        ("BenQ PD2700Q", "BNQ", 60, 34, "2560x1440", "24-76"),
+        ]
+
+def serial(rng, prefix, length=10):
+    return prefix + "".join(rng.choice("0123456789ABCDEFGHJKLMNPRSTUVWXYZ") for i in range(length))
+
+def new_component(rng, kind, tag):
+    # tag makes the serials unique per machine and run
+    if kind == "ram":
+        return {"model": rng.choice(ram_models), "serial": serial(rng, tag, 8)}
+    if kind == "gpu":
+        return {"model": rng.choice(gpu_models), "serial": "GPU-" + serial(rng, tag, 24)}
+    if kind == "sata":
+        return {"model": rng.choice(sata_models), "serial": serial(rng, "S" + tag, 12)}
+    if kind == "nvme":
+        return {"model": rng.choice(nvme_models), "serial": serial(rng, "N" + tag, 12)}
+    if kind == "monitor":
+        return {"model": rng.choice(monitor_models), "serial": serial(rng, "M" + tag, 8)}
+    raise ValueError("Unknown component kind: " + kind)
+
+def make_machine(seed, idx, args):
+    rng = random.Random("%s-%d" % (seed, idx))
+    tag = "%05d" % idx
+    machine = {
+            "user": "user%05d" % idx,
+            "hostname": "ws-%05d" % idx,
+            "mobo": rng.choice(mobo_models),
+            "mobo_serial": serial(rng, "MB" + tag, 8),
+            "cpu": rng.choice(cpu_models),
+            "sockets": 2 if rng.random() < 0.05 else 1,
+            "ram": [new_component(rng, "ram", tag) for i in range(args.ram)],
+            "slots": args.ram + rng.choice([0, 0, 2, 4]),
+            "gpu": [new_component(rng, "gpu", tag) for i in range(args.gpus)],
+            "sata": [new_component(rng, "sata", tag) for i in range(args.sata)],
+            "nvme": [new_component(rng, "nvme", tag) for i in range(args.nvme)],
+            "monitor": [new_component(rng, "monitor", tag) for i in range(args.monitors)],
+            }
+    return machine
+
+def apply_churn(machine, seed, idx, run, args):
+    # Returns None if the machine has disappeared by this run
+    for r in range(1, run + 1):
+        rng = random.Random("%s-%d-run%d" % (seed, idx, r))
+        if rng.random() < args.drop:
+            return None
+        tag = "%05dR%d" % (idx, r)
+        for kind in ["ram", "gpu", "sata", "nvme", "monitor"]:
+            components = machine[kind]
+            for i in range(len(components)):
+                if rng.random() < args.churn:
+                    components[i] = new_component(rng, kind, tag)
+    return machine
+
+def render_dump(machine):
+    out = []
+    add = out.append
+
+    add(machine["hostname"])
+    add("===| OS |===")
+    add("")
+    add("Ubuntu 20.04.3 LTS")
+    add("")
+    add("===| Network |===")
+    add("")
+    idx = int(machine["user"][-5:])
+    mac = "%06x" % idx
+    add("enp0s31f6")
+    add("70:85:c2:%s:%s:%s" % (mac[0:2], mac[2:4], mac[4:6]))
+    add("192.168.%d.%d" % (idx // 250, idx % 250 + 2))
+    for line in ["00:1f.6", "Ethernet controller", "Intel Corporation", "Ethernet Connection (2) I219-V", "-r10", "ASUSTeK Computer Inc.", "Ethernet Connection (2) I219-V"]:
+        add(line)
+    add("")
+    add("")
+
+    add("===| Motherboard |===")
+    add("")
+    manufacturer, product = machine["mobo"]
+    add("Handle 0x0002, DMI type 2, 15 bytes")
+    add("Base Board Information")
+    add("\tManufacturer: " + manufacturer)
+    add("\tProduct Name: " + product)
+    add("\tVersion: Rev X.0x")
+    add("\tSerial Number: " + machine["mobo_serial"])
+    add("\tAsset Tag: Default string")
+    add("\tFeatures:")
+    add("\t\tBoard is a hosting board")
+    add("\t\tBoard is replaceable")
+    add("\tLocation In Chassis: Default string")
+    add("\tChassis Handle: 0x0003")
+    add("\tType: Motherboard")
+    add("\tContained Object Handles: 0")
+    add("")
+    add("")
+
+    add("===| CPU |===")
+    add("")
+    manufacturer, version, socket, threads, speed = machine["cpu"][:5]
+    for i in range(machine["sockets"]):
+        add("Handle 0x%04X, DMI type 4, 48 bytes" % (0x40 + i))
+        add("Processor Information")
+        add("\tSocket Designation: " + socket)
+        add("\tType: Central Processor")
+        add("\tFamily: Other")
+        add("\tManufacturer: " + manufacturer)
+        add("\tID: EA 06 09 00 FF FB EB BF")
+        add("\tSignature: Type 0, Family 6, Model 158, Stepping 10")
+        add("\tFlags:")
+        add("\t\tFPU (Floating-point unit on-chip)")
+        add("\t\tVME (Virtual mode extension)")
+        add("\tVersion: " + version)
+        add("\tVoltage: 1.2 V")
+        add("\tExternal Clock: 100 MHz")
+        add("\tMax Speed: 8300 MHz")
+        add("\tCurrent Speed: %d MHz" % speed)
+        add("\tStatus: Populated, Enabled")
+        add("\tUpgrade: Other")
+        add("\tCore Count: %d" % (threads // 2))
+        add("\tCore Enabled: %d" % (threads // 2))
+        add("\tThread Count: %d" % threads)
+        add("\tCharacteristics:")
+        add("\t\t64-bit capable")
+        add("")
+    add("")
+
+    add("===| RAM |===")
+    add("")
+    add("Handle 0x0030, DMI type 16, 23 bytes")
+    add("Physical Memory Array")
+    add("\tLocation: System Board Or Motherboard")
+    add("\tUse: System Memory")
+    add("\tError Correction Type: None")
+    add("\tMaximum Capacity: %d GB" % (machine["slots"] * 32))
+    add("\tError Information Handle: Not Provided")
+    add("\tNumber Of Devices: %d" % machine["slots"])
+    add("")
+    for slot in range(machine["slots"]):
+        add("Handle 0x%04X, DMI type 17, 40 bytes" % (0x31 + slot))
+        add("Memory Device")
+        add("\tArray Handle: 0x0030")
+        add("\tTotal Width: 64 bits")
+        add("\tData Width: 64 bits")
+        if slot < len(machine["ram"]):
+            stick = machine["ram"][slot]
+            vendor, part, size, ram_type, speed = stick["model"]
+            add("\tSize: " + size)
+            add("\tForm Factor: DIMM")
+            add("\tLocator: DIMM%d" % slot)
+            add("\tType: " + ram_type)
+            add("\tType Detail: Synchronous")
+            add("\tSpeed: " + speed)
+            add("\tManufacturer: " + vendor)
+            add("\tSerial Number: " + stick["serial"])
+            add("\tPart Number: " + part)
+            add("\tRank: 2")
+            add("\tConfigured Memory Speed: " + speed)
+        else:
+            add("\tSize: No Module Installed")
+            add("\tForm Factor: DIMM")
+            add("\tLocator: DIMM%d" % slot)
+            add("\tType: Unknown")
+            add("\tManufacturer: Not Specified")
+            add("\tSerial Number: Not Specified")
+            add("\tPart Number: Not Specified")
+        add("")
+    add("")
+
+    add("===| GPU |===")
+    add("")
+    for i, gpu in enumerate(machine["gpu"]):
+        vendor, model = gpu["model"][:2]
+        add("On pci bus: %02x:00.0" % (i + 1))
+        add("Vendor: " + vendor)
+        if "NVIDIA" in vendor:
+            add("Model: \t\t " + model)
+            add("GPU UUID: \t " + gpu["serial"])
+        else:
+            add("Model: " + model)
+            add("UUID: " + gpu["serial"])
+        add("---")
+    add("")
+
+    add("===| HDD |===")
+    add("")
+    for i, drive in enumerate(machine["sata"]):
+        model, firmware, size, form_factor, rotation = drive["model"]
+        add("/dev/sd" + chr(ord("a") + i))
+        add("\tModel Number:       " + model)
+        add("\tSerial Number:      " + drive["serial"])
+        add("\tFirmware Revision:  " + firmware)
+        add("\tdevice size with M = 1000*1000:      %d MBytes (%d GB)" % (size, size // 1000))
+        add("\tForm Factor: " + form_factor)
+        add("\tNominal Media Rotation Rate: " + rotation)
+    add("")
+
+    add("===| NVME |===")
+    add("")
+    add("Node             SN                   Model                                    Namespace Usage                      Format           FW Rev  ")
+    add("---------------- -------------------- ---------------------------------------- --------- -------------------------- ---------------- --------")
+    for i, drive in enumerate(machine["nvme"]):
+        model, size, firmware = drive["model"]
+        usage = "%s / %s" % (size, size)
+        add("%-16s %-20s %-40s %-9d %-26s %-16s %-8s" % ("/dev/nvme%dn1" % i, drive["serial"], model, 1, usage, "512   B +  0 B", firmware))
+    add("")
+
+    add("===| Input devices |===")
+    add("")
+    for line in ['I: Bus=0019 Vendor=0000 Product=0001 Version=0000', 'N: Name="Power Button"', 'P: Phys=PNP0C0C/button/input0', 'B: EV=3', '',
+            'I: Bus=0003 Vendor=046d Product=c52b Version=0111', 'N: Name="Logitech USB Receiver"', 'P: Phys=usb-0000:00:14.0-1/input0', '',
+            'I: Bus=0003 Vendor=04d9 Product=0169 Version=0111', 'N: Name="USB Keyboard"', '']:
+        add(line)
+    add("")
+
+    add("===| Monitor info |===")
+    add("")
+    for i, monitor in enumerate(machine["monitor"]):
+        name, vendor, width, height, resolution, refresh = monitor["model"]
+        add("card0-DP-%d" % (i + 1))
+        add("")
+        add("Section")
+        add("Display Product Name: '" + name + "'")
+        add("Display Product Serial Number: '" + monitor["serial"] + "'")
+        add("Manufacturer: " + vendor)
+        add("Made in: week 10 of 2019")
+        add("Maximum image size: %d cm x %d cm" % (width, height))
+        add("Bits per primary color channel: 8")
+        add("Supported color formats: RGB 4:4:4, YCrCb 4:4:4")
+        add("Monitor ranges (Bare Limits): " + refresh + " Hz V, 30-83 kHz H, max dotclock 170 MHz")
+        add("Native Video Resolution: " + resolution)
+        add("EndSection")
+        add("")
+
+    return "\n".join(out) + "\n"
+
+def write_bench_data(bench_dir):
+    # Benchmark lists in the same layout as bench_data/cpus.json and cuda.json
+    os.makedirs(bench_dir, exist_ok=True)
+    cpus = [[model[5], model[6]] for model in cpu_models]
+    gpus = [[model[1], model[2]] for model in gpu_models if model[2] is not None]
+    with open(os.path.join(bench_dir, "cpus.json"), "w") as f:
+        json.dump({"body": cpus}, f)
+    with open(os.path.join(bench_dir, "cuda.json"), "w") as f:
+        json.dump({"body": gpus}, f)
+
+def generate(out_dir, args):
+    os.makedirs(out_dir, exist_ok=True)
+    written = []
+    for idx in range(args.machines):
+        machine = make_machine(args.seed, idx, args)
+        machine = apply_churn(machine, args.seed, idx, args.run, args)
+        if machine is None:
+            continue
+        path = os.path.join(out_dir, machine["user"])
+        with open(path, "w") as f:
+            f.write(render_dump(machine))
+        written.append(path)
+    return written
+
+def make_parser():
+    parser = argparse.ArgumentParser(description="Generate synthetic hw_script.sh dumps for a fleet of machines.")
+    parser.add_argument("out_dir", help="directory to write the dumps to")
+    parser.add_argument("-n", "--machines", type=int, default=100, help="number of machines (default: %(default)s)")
+    parser.add_argument("--ram", type=int, default=4, help="RAM sticks per machine (default: %(default)s)")
+    parser.add_argument("--gpus", type=int, default=1, help="GPUs per machine (default: %(default)s)")
+    parser.add_argument("--sata", type=int, default=2, help="SATA drives per machine (default: %(default)s)")
+    parser.add_argument("--nvme", type=int, default=1, help="NVMe drives per machine (default: %(default)s)")
+    parser.add_argument("--monitors", type=int, default=2, help="monitors per machine (default: %(default)s)")
+    parser.add_argument("--run", type=int, default=0, help="which collection run to generate, churn is applied for every run after 0 (default: %(default)s)")
+    parser.add_argument("--churn", type=float, default=0.05, help="chance for a component to be swapped per run (default: %(default)s)")
+    parser.add_argument("--drop", type=float, default=0.01, help="chance for a machine to disappear per run (default: %(default)s)")
+    parser.add_argument("--seed", default="0", help="random seed (default: %(default)s)")
+    parser.add_argument("--bench-data", metavar="DIR", help="also write matching cpus.json/cuda.json benchmark lists to DIR")
+    return parser
+
+def main():
+    args = make_parser().parse_args()
+    written = generate(args.out_dir, args)
+    if args.bench_data is not None:
+        write_bench_data(args.bench_data)
+    print("Wrote " + str(len(written)) + " dumps to " + args.out_dir)
+
+if __name__ == "__main__":
+    main()
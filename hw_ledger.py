@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+
+import bisect
+from collections import Counter, defaultdict
+
+import hw_records
+
+# Component ledger: the state of every piece of HW in the database.
+#
+# A component is known by its identity, the match key of its category (the
+# serial number for most HW, the version string for CPUs). It is either
+#  - in use in a computer: an entry in the HW used lists, with "Comp Serial"
+#  - shelved: an entry in the HW unused lists
+# A merge moves components between these states: a new part is installed,
+# a removed part is shelved, a shelved part is reused, and a part removed
+# from one computer and installed in another in the same merge has moved.
+#
+# The ledger is indexed by identity, so every state change is a couple of
+# dict operations instead of a scan of the whole HW history. The HW
+# used/unused lists of the database are views of it (see views()).
+
+# The HW categories to track, nested keys are given as a list
+hw_keywords = ["Motherboard", "CPUs", ["RAM", "Sticks"], "GPUs", "HDDs", "Monitors"]
+
+entries_to_compare = {"Motherboard": "Serial Number",
+        "CPUs": "Version",
+        "RAM": ["Serial Number", "Part Number"],
+        "GPUs": "UUID",
+        "HDDs": {"NVME":"SN", "HDD":"Serial Number"},
+        "Monitors": "Serial Number"}
+
+def match_key(data, data_type):
+    # The identity of a HW entry, entries with the same key are the same HW
+    keyword = entries_to_compare[data_type]
+
+    if isinstance(keyword, list):
+        return tuple(data[key] for key in keyword)
+    elif isinstance(keyword, dict):
+        return data[keyword[data["Type"]]]
+    else:
+        return data[keyword]
+
+def computer_entries(data):
+    # Yield (category, list of entries) for the tracked HW of a computer,
+    # single entries (the Motherboard) are given as a list of one
+    for keyword in hw_keywords:
+        if isinstance(keyword, list):
+            entries = data[keyword[0]]
+            for i in range(1, len(keyword)):
+                entries = entries[keyword[i]]
+            keyword = keyword[0]
+        else:
+            entries = data[keyword]
+
+        if not isinstance(entries, list):
+            entries = [entries]
+        yield keyword, entries
+
+def new_ledger():
+    return {"used": dict(),                 # category -> {id: entry}, in view order
+            "unused": dict(),
+            "in_use": defaultdict(list),    # (category, key, comp serial) -> ids of used entries
+            "shelf": defaultdict(list),     # (category, key) -> ids of unused entries
+            "moved_from": dict(),           # id -> comp serial, for the parts shelved in this merge
+            "events": [],
+            "next_id": 0,
+            "base": 0,                      # the first id of this merge
+            "removed": []}                  # (state, category, entry) taken out of the database lists
+
+def add_entry(ledger, state, category, entry):
+    entry_id = ledger["next_id"]
+    ledger["next_id"] += 1
+    ledger[state].setdefault(category, dict())[entry_id] = entry
+    return entry_id
+
+def build(database):
+    # The ledger of a database, before any computers are merged into it
+    ledger = new_ledger()
+    computers = database["Computers"]
+
+    # The used lists of databases written before the ledger can have entries
+    # of parts that have since left their computer. Only as many entries as
+    # the computer really has of an identity are kept in use.
+    present = Counter()
+    for serial, data in computers.items():
+        for category, entries in computer_entries(data):
+            for entry in entries:
+                present[(category, match_key(entry, category), serial)] += 1
+
+    for category, entries in database["HW"]["used"].items():
+        for entry in entries:
+            place = (category, match_key(entry, category), entry.get("Comp Serial"))
+            if place[2] in computers and len(ledger["in_use"].get(place, ())) >= present[place]:
+                ledger["removed"].append(("used", category, entry))
+                continue
+            ledger["in_use"][place].append(add_entry(ledger, "used", category, entry))
+
+    for category, entries in database["HW"]["unused"].items():
+        for entry in entries:
+            ledger["shelf"][(category, match_key(entry, category))].append(add_entry(ledger, "unused", category, entry))
+
+    ledger["base"] = ledger["next_id"]
+    return ledger
+
+def remove_entry(ledger, state, category, entry_id):
+    entry = ledger[state][category].pop(entry_id)
+    if entry_id < ledger["base"]:
+        # It was in the database before this merge
+        ledger["removed"].append((state, category, entry))
+
+def shelve(ledger, category, entry, serial):
+    # A part was removed from computer serial
+    key = match_key(entry, category)
+    ids = ledger["in_use"].get((category, key, serial))
+    if ids:
+        remove_entry(ledger, "used", category, ids.pop())
+
+    if "Comp Serial" in entry:
+        entry = entry.copy()
+        del entry["Comp Serial"]
+    entry_id = add_entry(ledger, "unused", category, entry)
+    ledger["shelf"][(category, key)].append(entry_id)
+    ledger["moved_from"][entry_id] = serial
+    ledger["events"].append(("shelved", category, key, serial, None))
+
+def install(ledger, category, entry, serial):
+    # A part showed up in computer serial, it is taken off the shelf if it was there.
+    # Parts shelved in this merge are taken first, they have moved between computers.
+    key = match_key(entry, category)
+    ids = ledger["shelf"].get((category, key))
+    if ids:
+        shelved_id = ids.pop()
+        remove_entry(ledger, "unused", category, shelved_id)
+        source = ledger["moved_from"].pop(shelved_id, None)
+        kind = "moved" if source is not None else "reused"
+    else:
+        source = None
+        kind = "installed"
+
+    entry_id = add_entry(ledger, "used", category, hw_records.with_field(entry, "Comp Serial", serial))
+    ledger["in_use"][(category, key, serial)].append(entry_id)
+    ledger["events"].append((kind, category, key, source, serial))
+
+def view_order(ledger, state):
+    # (category, entries added in this merge, entries that were there before) in the
+    # order of the database lists, categories without entries are left out.
+    # The entries added in this merge come first, in the order they were added, then the
+    # ones that were there before. The categories that got new entries go first too.
+    added = []
+    kept = []
+    for category, entries in ledger[state].items():
+        # The ids of a category only go up, the new entries are at the end
+        ids = list(entries)
+        first_new = bisect.bisect_left(ids, ledger["base"])
+        values = list(entries.values())
+        if first_new != len(ids):
+            added.append((ids[first_new], category, values[first_new:], values[:first_new]))
+        elif len(values) != 0:
+            kept.append((category, [], values))
+    return [item[1:] for item in sorted(added)] + kept
+
+def views(ledger):
+    # The HW used/unused lists of the database
+    hw = dict()
+    for state in ["used", "unused"]:
+        hw[state] = {category: new + old for category, new, old in view_order(ledger, state)}
+    return hw
+
+def changes(ledger):
+    # How the merge changed the HW lists, so a store with one row per entry
+    # (fleet_db.py) only has to write those: the (state, category, entry) added,
+    # in list order, and the ones removed
+    added = []
+    for state in ["used", "unused"]:
+        for category, new, old in view_order(ledger, state):
+            added += [(state, category, entry) for entry in new]
+    return {"added": added, "removed": ledger["removed"]}
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+
+import sys
+
+# Compact records for the HW entries there are many of: RAM sticks, drives, GPUs and monitors.
+#
+# A plain dict per entry repeats the same keys and the same vendor/type
+# strings thousands of times in a big fleet. A record only holds a tuple of
+# values and a key -> position dict that is shared by all records with the
+# same keys (a "layout"). Repeated string values are interned, so every
+# "Samsung" or "DDR4" is the same string object.
+#
+# Records work like read/write dicts for the code that uses the entries
+# (entry["Model"], entry.get(...), "UUID" in entry, dict(entry), ...). They
+# are not dicts though, so json needs default=json_default to write them,
+# which gives back the same json as the dict they were made from.
+
+# Tuple of keys -> shared {key: position} dict
+layouts = dict()
+
+def layout(keys):
+    keys = tuple(keys)
+    index = layouts.get(keys)
+    if index is None:
+        index = {sys.intern(key): pos for pos, key in enumerate(keys)}
+        layouts[keys] = index
+    return index
+
+class Record:
+    __slots__ = ("_index", "_values")
+
+    # Values that are different for every entry, these are not worth interning
+    unique_fields = frozenset(["Comp Serial", "Serial Number"])
+
+    def __init__(self, keys, values):
+        # Also used for unpickling, which makes new string objects, so they are interned again
+        self._index = layout(keys)
+        unique = self.unique_fields
+        self._values = tuple([sys.intern(value) if type(value) is str and key not in unique else value
+            for key, value in zip(self._index, values)])
+
+    @classmethod
+    def from_dict(cls, data):
+        keys = tuple(data)
+        index = layouts.get(keys)
+        if index is None:
+            index = layout(keys)
+        unique = cls.unique_fields
+        new = object.__new__(cls)
+        new._index = index
+        new._values = tuple([sys.intern(value) if type(value) is str and key not in unique else value
+            for key, value in data.items()])
+        return new
+
+    def __getitem__(self, key):
+        return self._values[self._index[key]]
+
+    def get(self, key, default = None):
+        pos = self._index.get(key)
+        if pos is None:
+            return default
+        return self._values[pos]
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._values)
+
+    def keys(self):
+        return self._index.keys()
+
+    def values(self):
+        return self._values
+
+    def items(self):
+        return zip(self._index, self._values)
+
+    def __setitem__(self, key, value):
+        pos = self._index.get(key)
+        if pos is not None:
+            values = list(self._values)
+            values[pos] = value
+            self._values = tuple(values)
+        else:
+            self._index = layout(tuple(self._index) + (key,))
+            self._values = self._values + (value,)
+
+    def __delitem__(self, key):
+        pos = self._index[key]
+        keys = tuple(self._index)
+        self._index = layout(keys[:pos] + keys[pos + 1:])
+        self._values = self._values[:pos] + self._values[pos + 1:]
+
+    def copy(self):
+        new = object.__new__(type(self))
+        new._index = self._index
+        new._values = self._values
+        return new
+
+    def with_field(self, key, value):
+        # A copy with key set to value
+        new = self.copy()
+        new[key] = value
+        return new
+
+    def to_dict(self):
+        return dict(zip(self._index, self._values))
+
+    def __eq__(self, other):
+        if isinstance(other, Record):
+            if self._index is other._index:
+                return self._values == other._values
+            return self.to_dict() == other.to_dict()
+        if isinstance(other, dict):
+            return self.to_dict() == other
+        return NotImplemented
+
+    __hash__ = None
+
+    def __reduce__(self):
+        # For pickling (the parse_output.py and process_json_data.py worker processes)
+        return (type(self), (tuple(self._index), self._values))
+
+    def __repr__(self):
+        return type(self).__name__ + "(" + repr(self.to_dict()) + ")"
+
+class RamStick(Record):
+    __slots__ = ()
+
+class Drive(Record):
+    __slots__ = ()
+    unique_fields = frozenset(["Comp Serial", "Serial Number", "SN"])
+
+class Gpu(Record):
+    __slots__ = ()
+    unique_fields = frozenset(["Comp Serial", "UUID"])
+
+class Monitor(Record):
+    __slots__ = ()
+
+# HW category (the HW used/unused key) -> record class
+category_records = {"RAM": RamStick, "HDDs": Drive, "GPUs": Gpu, "Monitors": Monitor}
+
+def pack_entries(category, entries):
+    # Records for the entries of a category, other categories are left as they are
+    cls = category_records.get(category)
+    if cls is None or not isinstance(entries, list):
+        return entries
+    return [entry if isinstance(entry, Record) else cls.from_dict(entry) for entry in entries]
+
+def pack_computer(data):
+    for category in ["GPUs", "HDDs", "Monitors"]:
+        if category in data:
+            data[category] = pack_entries(category, data[category])
+    ram = data.get("RAM")
+    if isinstance(ram, dict) and "Sticks" in ram:
+        ram["Sticks"] = pack_entries("RAM", ram["Sticks"])
+    return data
+
+def pack_database(database):
+    for data in database["Computers"].values():
+        pack_computer(data)
+    for state in ["used", "unused"]:
+        hw = database["HW"][state]
+        for category in hw:
+            hw[category] = pack_entries(category, hw[category])
+    return database
+
+def with_field(entry, key, value):
+    # A copy of a record or dict entry with key set to value
+    if isinstance(entry, Record):
+        return entry.with_field(key, value)
+    tmp = entry.copy()
+    tmp[key] = value
+    return tmp
+
+def json_default(obj):
+    # Use as json.dump(..., default=json_default)
+    if isinstance(obj, Record):
+        return obj.to_dict()
+    raise TypeError("Object of type " + type(obj).__name__ + " is not JSON serializable")
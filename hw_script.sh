@@ -13,15 +13,35 @@ missing_command=false
 command -v dmidecode >/dev/null 2>&1 || { echo >&2 "I require 'dmidecode' but it's not installed.  Aborting."; missing_command=true; }
 command -v hdparm >/dev/null 2>&1 || { echo >&2 "I require 'hdparm' but it's not installed.  Aborting."; missing_command=true; }
 command -v nvme >/dev/null 2>&1 || { echo >&2 "I require 'nvme-cli' but it's not installed.  Aborting."; missing_command=true; }
-command -v edid-decode >/dev/null 2>&1 || { echo >&2 "I require 'edid-decode' but it's not installed.  Aborting."; missing_command=true; }
+command -v python3 >/dev/null 2>&1 || { echo >&2 "I require 'python3' but it's not installed.  Aborting."; missing_command=true; }
 
 if [ "$missing_command" = true ] ; then
   exit 1
 fi
 
-# read-edid is supplied in this script directory
+# edid.py is supplied in this script directory
 cd `dirname "$BASH_SOURCE"`
 
+usage() {
+  echo "Usage: $0 [-p] [-j [-b]] <output file> [extra id]"
+  echo "  -p  run the independent probes concurrently"
+  echo "  -j  write the final json document with collect.py instead of a text dump"
+  echo "  -b  with -j, only write the brief subset of the info"
+}
+
+parallel=false
+json_output=false
+brief=false
+while getopts "pjb" opt; do
+  case $opt in
+    p) parallel=true ;;
+    j) json_output=true ;;
+    b) brief=true ;;
+    *) usage; exit 1 ;;
+  esac
+done
+shift $((OPTIND-1))
+
 #Exit script if any command fails
 set -e
 
@@ -29,164 +49,276 @@ file=$1
 if [ -z "$1" ]
 then
   echo "You need to specify filepath for the output!"
+  usage
   exit 1
 fi
-
-comp_name=$(hostname)
-#Make sure that our file is clear (no appending!)
-echo -n $comp_name > $file
-#Check if we supplied any more ID data
-if [ ! -z "$2" ]
-then
-  echo " ($2)" >> $file
+extra_id=$2
+
+# In json mode collect.py reads sysfs/procfs and writes the document directly,
+# so it doesn't have to go through parse_output.py later.
+if [ "$json_output" = true ]; then
+  collect_args=(--user "$(basename "$file")" -o "$file")
+  if [ ! -z "$extra_id" ]; then
+    collect_args+=(--id "$extra_id")
+  fi
+  if [ "$brief" = true ]; then
+    collect_args+=(--brief)
+  fi
+  python3 ./collect.py "${collect_args[@]}"
+  exit 0
 fi
 
-printf '\n' >> $file
-echo ===\| OS \|=== >> $file
-printf '\n' >> $file
-
-#Source the os release file
-. /etc/os-release
-echo $PRETTY_NAME >> $file
+# Every section is written to its own buffer in here and the output file
+# is put together from them at the end.
+tmp_dir=$(mktemp -d)
+trap 'rm -rf "$tmp_dir"' EXIT
+
+# Run a command in the background in parallel mode, otherwise right away.
+# The output goes to the file given as the first argument.
+run_probe() {
+  local out=$1
+  shift
+  if [ "$parallel" = true ]; then
+    "$@" > "$out" &
+  else
+    "$@" > "$out"
+  fi
+}
 
-printf '\n' >> $file
-echo ===\| Network \|=== >> $file
-printf '\n' >> $file
+# Wait for all background probes, exit if any of them failed.
+wait_probes() {
+  local pid
+  for pid in $(jobs -p); do
+    wait $pid
+  done
+}
 
-for iface in /sys/class/net/*
-do
-  if [ -f "$iface/device/uevent" ]; then
-    # This is a non virtual device, save information about it
-    echo ${iface##*/} >> $file
-    # Get mac adress
-    cat "$iface/address" >> $file
-    # Get ip adress
-    if grep -q up "$iface/operstate"; then
-      ifconfig ${iface##*/} | grep "inet " | awk '{print $2}' >> $file
-    else
-      echo DOWN >> $file
+header_section() {
+  comp_name=$(hostname)
+  echo -n $comp_name
+  #Check if we supplied any more ID data
+  if [ ! -z "$extra_id" ]
+  then
+    echo " ($extra_id)"
+  fi
+  printf '\n'
+}
+
+os_section() {
+  echo ===\| OS \|===
+  printf '\n'
+
+  #Source the os release file
+  . /etc/os-release
+  echo $PRETTY_NAME
+}
+
+net_iface() {
+  local iface=$1
+  echo ${iface##*/}
+  # Get mac adress
+  cat "$iface/address"
+  # Get ip adress
+  if grep -q up "$iface/operstate"; then
+    ifconfig ${iface##*/} | grep "inet " | awk '{print $2}'
+  else
+    echo DOWN
+  fi
+  # Get the device pci bus address
+  pci_addr=$(cat "$iface/device/uevent" | grep -Po 'PCI_SLOT_NAME=\K.*')
+  # Dump device model name and extra info
+  lspci -mm -s $pci_addr | xargs -n 1 printf "%s\n"
+  printf '\n'
+}
+
+net_section() {
+  printf '\n'
+  echo ===\| Network \|===
+  printf '\n'
+
+  local dir=$(mktemp -d -p "$tmp_dir")
+  local nr=0
+  for iface in /sys/class/net/*
+  do
+    if [ -f "$iface/device/uevent" ]; then
+      # This is a non virtual device, save information about it
+      nr=$((nr+1))
+      run_probe "$dir/$(printf '%04d' $nr)" net_iface "$iface"
     fi
-    # Get the device pci bus address
-    pci_addr=$(cat "$iface/device/uevent" | grep -Po 'PCI_SLOT_NAME=\K.*')
-    # Dump device model name and extra info
-    lspci -mm -s $pci_addr | xargs -n 1 printf "%s\n" >> $file
-    printf '\n' >> $file
+  done
+  wait_probes
+  if [ $nr -gt 0 ]; then
+    cat "$dir"/*
   fi
-done
+}
 
-printf '\n' >> $file
-echo ===\| Motherboard \|=== >> $file
-printf '\n' >> $file
+# Read the DMI tables once, the DMI sections are decoded from this dump
+dmi_dump="$tmp_dir/dmi.bin"
 
-dmidecode --type baseboard | tail -n +5 >> $file
+mobo_section() {
+  printf '\n'
+  echo ===\| Motherboard \|===
+  printf '\n'
 
-printf '\n' >> $file
-echo ===\| CPU \|=== >> $file
-printf '\n' >> $file
+  dmidecode --from-dump "$dmi_dump" --type baseboard | tail -n +5
+}
 
-dmidecode --type processor | tail -n +5 >> $file
+cpu_section() {
+  printf '\n'
+  echo ===\| CPU \|===
+  printf '\n'
 
-printf '\n' >> $file
-echo ===\| RAM \|=== >> $file
-printf '\n' >> $file
+  dmidecode --from-dump "$dmi_dump" --type processor | tail -n +5
+}
 
-dmidecode --type memory | tail -n +5 >> $file
+ram_section() {
+  printf '\n'
+  echo ===\| RAM \|===
+  printf '\n'
 
-printf '\n' >> $file
-echo ===\| GPU \|=== >> $file
-printf '\n' >> $file
+  dmidecode --from-dump "$dmi_dump" --type memory | tail -n +5
+}
 
+gpu_section() {
+  printf '\n'
+  echo ===\| GPU \|===
+  printf '\n'
 
-#Taken from neofetch
-gpu_cmd="$(lspci -mm | awk -F '\"|\" \"|\\(' \
-                                          '/"Display|"3D|"VGA/ {a[$0] = $1 " | " $3 " | " $4}
-                                           END {for(i in a) {if(!seen[a[i]]++) print a[i]}}')"
+  #Taken from neofetch
+  gpu_cmd="$(lspci -mm | awk -F '\"|\" \"|\\(' \
+                                            '/"Display|"3D|"VGA/ {a[$0] = $1 " | " $3 " | " $4}
+                                             END {for(i in a) {if(!seen[a[i]]++) print a[i]}}')"
 
-nr_of_gpus=0
+  nr_of_gpus=0
 
-while IFS= read -r gpu
-do
-  ((nr_of_gpus=nr_of_gpus+1))
-  IFS='|' read -ra gpu_data <<< "$gpu"
+  while IFS= read -r gpu
+  do
+    ((nr_of_gpus=nr_of_gpus+1))
+    IFS='|' read -ra gpu_data <<< "$gpu"
 
-  #Trim whitespace on pcibus
-  pcibus=$(echo ${gpu_data[0]} | xargs)
+    #Trim whitespace on pcibus
+    pcibus=$(echo ${gpu_data[0]} | xargs)
 
-  echo On pci bus: $pcibus >> $file
-  echo Vendor: ${gpu_data[1]} >> $file
+    echo On pci bus: $pcibus
+    echo Vendor: ${gpu_data[1]}
 
-  if [[ ${gpu_data[1]} == *"NVIDIA"* ]]; then
-    #Nvidia cards
-    cat /proc/driver/nvidia/gpus/0000\:$pcibus/information | grep 'Model:\|UUID:' >> $file
-  else
-    #Other
-    echo Model: ${gpu_data[2]} >> $file
+    if [[ ${gpu_data[1]} == *"NVIDIA"* ]]; then
+      #Nvidia cards
+      cat /proc/driver/nvidia/gpus/0000\:$pcibus/information | grep 'Model:\|UUID:'
+    else
+      #Other
+      echo Model: ${gpu_data[2]}
 
-    uuid_file=/sys/bus/pci/devices/0000\:$pcibus/unique_id
+      uuid_file=/sys/bus/pci/devices/0000\:$pcibus/unique_id
 
-    if [ -e $uuid_file ]; then
-      uuid=$(cat $uuid_file)
-      echo UUID: $uuid >> $file
+      if [ -e $uuid_file ]; then
+        uuid=$(cat $uuid_file)
+        echo UUID: $uuid
+      fi
     fi
-  fi
 
-  echo "---" >> $file
-done <<< "$gpu_cmd"
-
-printf '\n' >> $file
-echo ===\| HDD \|=== >> $file
-printf '\n' >> $file
-
-if [ -b /dev/sda ]; then
-  for hdd in /dev/sd*[a-z]
+    echo "---"
+  done <<< "$gpu_cmd"
+}
+
+hdd_info() {
+  local hdd=$1
+  echo $hdd
+  hdparm -I $hdd | grep 'Model Number:\|Serial Number:\|Firmware Revision:\|device size with M = 1000\*1000:\|Form Factor:\|Nominal Media Rotation Rate:'
+}
+
+hdd_section() {
+  printf '\n'
+  echo ===\| HDD \|===
+  printf '\n'
+
+  if [ -b /dev/sda ]; then
+    local dir=$(mktemp -d -p "$tmp_dir")
+    local nr=0
+    for hdd in /dev/sd*[a-z]
+    do
+      nr=$((nr+1))
+      run_probe "$dir/$(printf '%04d' $nr)" hdd_info $hdd
+    done
+    wait_probes
+    cat "$dir"/*
+  fi
+}
+
+nvme_section() {
+  printf '\n'
+  echo ===\| NVME \|===
+  printf '\n'
+
+  nvme list
+}
+
+input_section() {
+  printf '\n'
+  echo ===\| Input devices \|===
+  printf '\n'
+
+  cat /proc/bus/input/devices
+}
+
+monitor_info() {
+  local output=$1
+  # Name, serial number, manufacturer, manufacturing date, size,
+  # color depth and formats, refresh ranges and native resolution
+  local info
+  info=$(python3 ./edid.py $output/edid)
+  # Outputs without a (valid) EDID are left out
+  if [ -z "$info" ]; then
+    return
+  fi
+  #Print the card and output port
+  basename $output
+  printf '\n'
+  #Print relevant monitor info
+  echo Section
+  echo "$info"
+  echo EndSection
+  printf '\n'
+}
+
+monitor_section() {
+  printf '\n'
+  echo ===\| Monitor info \|===
+  printf '\n'
+
+  local dir=$(mktemp -d -p "$tmp_dir")
+  local nr=0
+  MONITOR_OUTPUTS=/sys/class/drm/card*-*
+  for output in $MONITOR_OUTPUTS
   do
-    echo $hdd >> $file
-    hdparm -I $hdd | grep 'Model Number:\|Serial Number:\|Firmware Revision:\|device size with M = 1000\*1000:\|Form Factor:\|Nominal Media Rotation Rate:' >> $file
+    #Is there something connected to this output?
+    if grep -Fxq "connected" $output/status
+    then
+      nr=$((nr+1))
+      run_probe "$dir/$(printf '%04d' $nr)" monitor_info $output
+    fi
   done
-fi
-
-printf '\n' >> $file
-echo ===\| NVME \|=== >> $file
-printf '\n' >> $file
-
-nvme list >> $file
-
-printf '\n' >> $file
-echo ===\| Input devices \|=== >> $file
-printf '\n' >> $file
+  wait_probes
+  if [ $nr -gt 0 ]; then
+    cat "$dir"/*
+  fi
+}
 
-cat /proc/bus/input/devices >> $file
+# The sections in output order
+sections=(header_section os_section net_section mobo_section cpu_section ram_section gpu_section hdd_section nvme_section input_section monitor_section)
 
-printf '\n' >> $file
-echo ===\| Monitor info \|=== >> $file
-printf '\n' >> $file
+dmidecode --dump-bin "$dmi_dump" > /dev/null
 
-MONITOR_OUTPUTS=/sys/class/drm/card*-*
-for output in $MONITOR_OUTPUTS
+for section in "${sections[@]}"
 do
-  #Is there something connected to this output?
-  if grep -Fxq "connected" $output/status
-  then
-    #Print the card and output port
-    basename $output >> $file
-    printf '\n' >> $file
-    #Print relevant monitor info
-    # awk '{$1=$1};1' trims whitespace in the output
-    edid_output=$(edid-decode -sn $output/edid | awk '{$1=$1};1')
-
-    echo Section >> $file
-    # Both name and serial number
-    echo "$edid_output" | grep "Display Product" >> $file
-    echo "$edid_output" | grep "Manufacturer" >> $file
-    # Manufacturing date
-    echo "$edid_output" | grep "Made in" >> $file
-    echo "$edid_output" | grep "Maximum image size" >> $file
-    echo "$edid_output" | grep "Bits per primary color channel" >> $file
-    echo "$edid_output" | grep "Supported color formats" >> $file
-    echo "$edid_output" | grep "Monitor ranges" >> $file
-    # Native resolution
-    echo Native Video Resolution: $(echo "$edid_output" | tail -n1) >> $file
-    echo EndSection >> $file
-    printf '\n' >> $file
-  fi
+  run_probe "$tmp_dir/$section" $section
 done
+wait_probes
+
+# Put the output file together and move it in place in one go,
+# so readers never see a half written file.
+for section in "${sections[@]}"
+do
+  cat "$tmp_dir/$section"
+done > "$file.tmp"
+mv -f "$file.tmp" "$file"
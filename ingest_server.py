@@ -0,0 +1,378 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import io
+import json
+import signal
+import asyncio
+import argparse
+import urllib.parse
+import urllib.error
+import urllib.request
+import concurrent.futures
+
+import atomic_file
+import fleet_db
+import hw_records
+import parse_output
+import process_json_data
+
+# Ingestion server: computers send their dumps over HTTP and they are parsed
+# and merged into the HW database as they come in.
+#
+#   POST /dump/<user>   a hw_script.sh text dump, or a json document from
+#                       hw_script.sh -j / collect.py (Content-Type: application/json)
+#   GET  /status        counters as json
+#
+# Text dumps are parsed in a process pool. Parsed computers go into a bounded
+# queue and a single merger task takes them out in micro-batches: it waits at
+# most --batch-delay seconds for a batch to fill up, then merges it the same
+# way process_json_data.py does. When the queue is full new uploads wait
+# before they get their reply, which slows down the senders (backpressure).
+#
+# A 202 reply means the dump will be merged or kept: if a batch can't be
+# merged, its dumps are merged one at a time, and the ones that still fail
+# are saved as json files in the database path + .failed/, to be merged with
+# process_json_data.py once the problem is fixed. On SIGINT/SIGTERM the
+# uploads that are still being received are finished and merged before exiting.
+#
+# The "send" command is a small client, for testing over localhost or for
+# sending dumps from a machine that has no curl.
+
+default_port = 8765
+max_body_size = 32 * 1024 * 1024
+
+class RequestError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+reasons = {200: "OK", 202: "Accepted", 400: "Bad Request", 404: "Not Found",
+        405: "Method Not Allowed", 413: "Payload Too Large", 500: "Internal Server Error"}
+
+def parse_text(text, user):
+    # Runs in the parser processes
+    return parse_output.parse_dump(io.StringIO(text), user)
+
+async def read_body(reader, headers):
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        # Streamed upload
+        body = bytearray()
+        while True:
+            size_line = await reader.readline()
+            try:
+                size = int(size_line.split(b";")[0].strip(), 16)
+            except ValueError:
+                raise RequestError(400, "Bad chunk size")
+            if size == 0:
+                # Skip the trailers
+                while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                return bytes(body)
+            if len(body) + size > max_body_size:
+                raise RequestError(413, "Dump too large")
+            body += await reader.readexactly(size)
+            await reader.readline()
+
+    try:
+        length = int(headers.get("content-length", "0"))
+    except ValueError:
+        raise RequestError(400, "Bad Content-Length")
+    if length < 0:
+        raise RequestError(400, "Bad Content-Length")
+    if length > max_body_size:
+        raise RequestError(413, "Dump too large")
+    return await reader.readexactly(length)
+
+async def read_request(reader):
+    request_line = (await reader.readline()).decode("latin-1").split()
+    if len(request_line) != 3:
+        raise RequestError(400, "Bad request line")
+    method, target, version = request_line
+
+    headers = dict()
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, sep, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    body = await read_body(reader, headers) if method == "POST" else b""
+    return method, urllib.parse.urlsplit(target).path, headers, body
+
+def write_response(writer, status, data):
+    body = (json.dumps(data) + "\n").encode("utf-8")
+    writer.write(("HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\nConnection: close\r\n\r\n"
+        % (status, reasons[status], len(body))).encode("latin-1") + body)
+
+def new_state(args):
+    return {"args": args,
+            "database": fleet_db.load_database(args.db),
+            "queue": asyncio.Queue(maxsize=args.queue),
+            "parse_slots": asyncio.Semaphore(args.jobs * 2),
+            "parse_pool": concurrent.futures.ProcessPoolExecutor(args.jobs),
+            # One thread, so the merges never overlap
+            "merge_pool": concurrent.futures.ThreadPoolExecutor(1),
+            # The connections being handled, waited for on shutdown
+            "handlers": set(),
+            "counters": {"received": 0, "rejected": 0, "merged": 0, "batches": 0, "failed": 0}}
+
+def keep_dump(keep_dir, user, body):
+    # Save the upload like extract.sh would in hw_data/
+    path = os.path.join(keep_dir, user)
+    with atomic_file.open_atomic(path, "wb") as f:
+        f.write(body)
+
+async def ingest(state, user, headers, body):
+    args = state["args"]
+    loop = asyncio.get_running_loop()
+
+    if headers.get("content-type", "").startswith("application/json"):
+        try:
+            data = json.loads(body)
+        except ValueError as e:
+            raise RequestError(400, "Invalid json: " + str(e))
+        if not isinstance(data, dict):
+            raise RequestError(400, "The json document is not an object")
+        data["User"] = user
+        error = process_json_data.computer_error(data)
+        if error is not None:
+            raise RequestError(400, error)
+        hw_records.pack_computer(data)
+    else:
+        async with state["parse_slots"]:
+            try:
+                data = await loop.run_in_executor(state["parse_pool"], parse_text, body.decode("utf-8", "replace"), user)
+            except Exception as e:
+                raise RequestError(400, "Couldn't parse the dump: " + repr(e))
+
+    # Everything the merge needs is checked here, a rejected dump never gets into a batch
+    error = process_json_data.computer_error(data)
+    if error is not None:
+        raise RequestError(400, error)
+    serial = data["Motherboard"]["Serial Number"]
+
+    if args.keep is not None:
+        await loop.run_in_executor(None, keep_dump, args.keep, user, body)
+
+    # Waits here while the merger is behind
+    await state["queue"].put((serial, data))
+    return serial
+
+def failed_dir(db_path):
+    return db_path + ".failed"
+
+def keep_failed(state, batch):
+    # The dumps that can't be merged are saved for process_json_data.py,
+    # they were already accepted
+    path = failed_dir(state["args"].db)
+    os.makedirs(path, exist_ok=True)
+    for serial, data in batch:
+        with atomic_file.open_atomic(os.path.join(path, data["User"] + ".json")) as f:
+            json.dump(data, f, default=hw_records.json_default)
+    print("Saved " + str(len(batch)) + " computers that couldn't be merged to " + path)
+
+def merge_retry(state, batch):
+    # Runs in the merge thread after a failed merge. The database may have been
+    # left half merged, so it is loaded again, then the dumps are merged one at a
+    # time to find the ones that fail. Returns the number of merged computers.
+    args = state["args"]
+    state["database"] = fleet_db.load_database(args.db)
+    failed = []
+    for item in batch:
+        try:
+            merge_batch(state, [item])
+        except Exception as e:
+            print("Merge of " + item[1]["User"] + " (" + item[0] + ") failed: " + repr(e))
+            state["database"] = fleet_db.load_database(args.db)
+            failed.append(item)
+    if len(failed) != 0:
+        try:
+            keep_failed(state, failed)
+        except OSError as e:
+            print("Couldn't save the computers that failed to merge: " + repr(e))
+    return len(batch) - len(failed)
+
+async def client_connected(state, reader, writer):
+    task = asyncio.current_task()
+    state["handlers"].add(task)
+    try:
+        await handle_client(state, reader, writer)
+    finally:
+        state["handlers"].discard(task)
+
+async def handle_client(state, reader, writer):
+    counters = state["counters"]
+    try:
+        method, path, headers, body = await read_request(reader)
+        if path == "/status":
+            if method != "GET":
+                raise RequestError(405, "Use GET")
+            status = dict(counters)
+            status["queued"] = state["queue"].qsize()
+            status["computers"] = len(state["database"]["Computers"])
+            write_response(writer, 200, status)
+        elif path.startswith("/dump/"):
+            if method != "POST":
+                raise RequestError(405, "Use POST")
+            user = urllib.parse.unquote(path[len("/dump/"):])
+            if len(user) == 0 or "/" in user or user.startswith("."):
+                raise RequestError(400, "Invalid user name")
+            counters["received"] += 1
+            serial = await ingest(state, user, headers, body)
+            print("Received " + user + " (" + serial + ")")
+            write_response(writer, 202, {"status": "accepted", "user": user, "serial": serial})
+        else:
+            raise RequestError(404, "Unknown path " + path)
+    except RequestError as e:
+        counters["rejected"] += 1
+        print("Rejected request: " + str(e))
+        write_response(writer, e.status, {"status": "error", "error": str(e)})
+    except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+        counters["rejected"] += 1
+    try:
+        await writer.drain()
+        writer.close()
+        await writer.wait_closed()
+    except ConnectionError:
+        pass
+
+def merge_batch(state, batch):
+    # Runs in the merge thread, the same steps as process_json_data.py
+    args = state["args"]
+    database = state["database"]
+    merge = process_json_data.new_merge(database)
+    previous = dict(database["Computers"])
+
+    # A computer that reports twice in one batch is merged twice, in order,
+    # like two dumps of it given to process_json_data.py
+    for serial, data in batch:
+        process_json_data.add_computer(database, merge, serial, data)
+    process_json_data.finish_merge(database, merge)
+    process_json_data.save_merge(args.db, database, merge, previous, not args.no_history, not args.no_index, args.snapshot)
+
+async def merger(state):
+    args = state["args"]
+    queue = state["queue"]
+    loop = asyncio.get_running_loop()
+    running = True
+
+    while running:
+        item = await queue.get()
+        if item is None:
+            break
+        batch = [item]
+        deadline = loop.time() + args.batch_delay
+        while len(batch) < args.batch:
+            try:
+                item = await asyncio.wait_for(queue.get(), max(deadline - loop.time(), 0))
+            except asyncio.TimeoutError:
+                break
+            if item is None:
+                running = False
+                break
+            batch.append(item)
+
+        try:
+            await loop.run_in_executor(state["merge_pool"], merge_batch, state, batch)
+            merged = len(batch)
+        except Exception as e:
+            print("Merge failed: " + repr(e))
+            merged = await loop.run_in_executor(state["merge_pool"], merge_retry, state, batch)
+        state["counters"]["merged"] += merged
+        state["counters"]["failed"] += len(batch) - merged
+        state["counters"]["batches"] += 1
+        print("Merged " + str(merged) + " computers into " + args.db)
+
+async def serve(args):
+    state = new_state(args)
+    loop = asyncio.get_running_loop()
+
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    merge_task = asyncio.create_task(merger(state))
+    server = await asyncio.start_server(lambda r, w: client_connected(state, r, w), args.host, args.port)
+    print("Listening on " + args.host + ":" + str(args.port))
+
+    async with server:
+        await stop.wait()
+
+    # Closing the server doesn't wait for the uploads that are still being
+    # received or parsed (before Python 3.12), they have to be queued first
+    if len(state["handlers"]) != 0:
+        await asyncio.wait(list(state["handlers"]))
+
+    # Merge what is still queued before exiting
+    await state["queue"].put(None)
+    await merge_task
+    state["parse_pool"].shutdown()
+    state["merge_pool"].shutdown()
+
+def send(args):
+    if args.file == "-":
+        body = sys.stdin.buffer.read()
+        user = args.user
+    else:
+        with open(args.file, "rb") as f:
+            body = f.read()
+        user = args.user if args.user is not None else os.path.basename(args.file)
+    if user is None:
+        print("You need to give a --user when sending from stdin")
+        sys.exit(1)
+
+    is_json = args.json or body.lstrip().startswith(b"{")
+    request = urllib.request.Request(args.url.rstrip("/") + "/dump/" + urllib.parse.quote(user, safe=""),
+            data=body, method="POST",
+            headers={"Content-Type": "application/json" if is_json else "text/plain; charset=utf-8"})
+    try:
+        with urllib.request.urlopen(request, timeout=args.timeout) as response:
+            print(response.read().decode("utf-8").strip())
+    except urllib.error.HTTPError as e:
+        print(e.read().decode("utf-8").strip())
+        sys.exit(1)
+
+def main():
+    parser = argparse.ArgumentParser(description="Receive HW dumps over HTTP and merge them into the HW database.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    server = commands.add_parser("serve", help="run the ingestion server")
+    server.add_argument("--db", default=process_json_data.data_base_path,
+            help="database to merge into, .json or .db/.sqlite (default: %(default)s)")
+    server.add_argument("--host", default="127.0.0.1", help="address to listen on (default: %(default)s)")
+    server.add_argument("--port", type=int, default=default_port, help="port to listen on (default: %(default)s)")
+    server.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1,
+            help="parser processes (default: %(default)s)")
+    server.add_argument("--queue", type=int, default=256,
+            help="parsed computers waiting to be merged before uploads are held back (default: %(default)s)")
+    server.add_argument("--batch", type=int, default=64, help="most computers per merge (default: %(default)s)")
+    server.add_argument("--batch-delay", type=float, default=2.0,
+            help="seconds to wait for more computers before merging (default: %(default)s)")
+    server.add_argument("--keep", metavar="DIR", help="also save the received dumps in DIR")
+    server.add_argument("--no-index", action="store_true", help="don't update the fleet_index.py lookup index")
+    server.add_argument("--no-history", action="store_true", help="don't record the merges in the fleet_history.py history")
+    server.add_argument("--snapshot", metavar="FILE", help="rewrite this fleet_snapshot.py snapshot after every merge")
+
+    client = commands.add_parser("send", help="send a dump to an ingestion server")
+    client.add_argument("file", help="hw_script.sh output (text or json), - for stdin")
+    client.add_argument("--url", default="http://127.0.0.1:" + str(default_port),
+            help="server address (default: %(default)s)")
+    client.add_argument("--user", help="user name to store the computer under (default: the file name)")
+    client.add_argument("--json", action="store_true", help="send as json even if it doesn't look like json")
+    client.add_argument("--timeout", type=float, default=300, help="seconds to wait for the server (default: %(default)s)")
+
+    args = parser.parse_args()
+
+    if args.command == "send":
+        send(args)
+        return
+
+    if args.keep is not None:
+        os.makedirs(args.keep, exist_ok=True)
+    asyncio.run(serve(args))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+import json
+import time
+
+import atomic_file
+
+# Optional timing and counting of the pipeline stages.
+#
+# Names are "group/item", like "section/RAM" or "stage/merge". Timers add up
+# the wall time and the number of calls, counters add up numbers (lines,
+# comparisons, bytes, ...).
+#
+# Everything is off until enable() is called. Then timer() hands out a
+# shared object that does nothing and count() returns right away, so the
+# instrumented code costs next to nothing in normal runs.
+
+enabled = False
+
+timers = dict()
+counters = dict()
+
+class Timer:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        entry = timers.get(self.name)
+        if entry is None:
+            entry = timers[self.name] = [0, 0.0]
+        entry[0] += 1
+        entry[1] += time.perf_counter() - self.start
+        return False
+
+class NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+null_timer = NullTimer()
+
+def enable():
+    global enabled
+    enabled = True
+
+def timer(name):
+    if not enabled:
+        return null_timer
+    return Timer(name)
+
+def count(name, amount = 1):
+    if not enabled:
+        return
+    counters[name] = counters.get(name, 0) + amount
+
+def report():
+    return {"timers": {name: {"calls": calls, "seconds": seconds} for name, (calls, seconds) in sorted(timers.items())},
+            "counters": dict(sorted(counters.items()))}
+
+def take():
+    # The report so far, and start over (for worker processes)
+    data = report()
+    timers.clear()
+    counters.clear()
+    return data
+
+def merge(data):
+    # Add a report from take() in another process
+    for name, entry in data["timers"].items():
+        total = timers.setdefault(name, [0, 0.0])
+        total[0] += entry["calls"]
+        total[1] += entry["seconds"]
+    for name, amount in data["counters"].items():
+        counters[name] = counters.get(name, 0) + amount
+
+def metric_name(text):
+    return "".join(char if char.isalnum() else "_" for char in text.lower())
+
+def label_value(text):
+    return text.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def prometheus_text(script, prefix = "hw_script"):
+    # Text exposition format, for the node exporter textfile collector
+    lines = []
+    groups = dict()
+    for name, (calls, seconds) in sorted(timers.items()):
+        group, sep, item = name.partition("/")
+        groups.setdefault(("timer", group), []).append((item, calls, seconds))
+    for name, amount in sorted(counters.items()):
+        group, sep, item = name.partition("/")
+        groups.setdefault(("counter", group), []).append((item, amount, None))
+
+    for (kind, group), items in groups.items():
+        base = prefix + "_" + metric_name(group)
+        if kind == "timer":
+            names = [(base + "_seconds_total", 2), (base + "_calls_total", 1)]
+        else:
+            names = [(base + "_total", 1)]
+        for metric, field in names:
+            lines.append("# TYPE " + metric + " counter")
+            for entry in items:
+                labels = 'script="' + label_value(script) + '"'
+                if len(entry[0]) != 0:
+                    labels += ',item="' + label_value(entry[0]) + '"'
+                lines.append(metric + "{" + labels + "} " + repr(entry[field]))
+    return "\n".join(lines) + "\n"
+
+def write_file(path, text):
+    # Rename into place, so a scraper never reads a half written file
+    with atomic_file.open_atomic(path) as f:
+        f.write(text)
+
+def add_arguments(parser):
+    parser.add_argument("--metrics", metavar="FILE", help="write timings and counts of the run as json to FILE")
+    parser.add_argument("--metrics-prom", metavar="FILE",
+            help="write timings and counts of the run in the Prometheus text format to FILE (for example for the node exporter textfile collector)")
+
+def setup(args):
+    if args.metrics is not None or args.metrics_prom is not None:
+        enable()
+
+def finish(args, script):
+    if args.metrics is not None:
+        write_file(args.metrics, json.dumps(report(), indent=4) + "\n")
+    if args.metrics_prom is not None:
+        write_file(args.metrics_prom, prometheus_text(script))
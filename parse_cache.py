@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+import hashlib
+import json
+import os
+
+import hw_records
+
+# On disk cache of parsed hw dumps.
+# The entries are keyed by the hash of the raw dump data and the parser version,
+# so a changed parser will never return stale results.
+
+default_max_size = 512 * 1024 * 1024
+
+def cache_key(raw_data, parser_version):
+    h = hashlib.sha256()
+    h.update(parser_version.encode())
+    h.update(b"\0")
+    h.update(raw_data)
+    return h.hexdigest()
+
+def entry_path(cache_dir, key):
+    return os.path.join(cache_dir, key + ".json")
+
+def get(cache_dir, key):
+    path = entry_path(cache_dir, key)
+    try:
+        with open(path, "r") as f:
+            output_data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    # Mark the entry as recently used for the eviction
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+    return output_data
+
+def put(cache_dir, key, output_data):
+    os.makedirs(cache_dir, exist_ok=True)
+    path = entry_path(cache_dir, key)
+    # Write to a temp file first so other processes never see a partial entry
+    tmp_path = path + "." + str(os.getpid()) + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(output_data, f, default=hw_records.json_default)
+    os.replace(tmp_path, path)
+
+def evict(cache_dir, max_size = default_max_size):
+    # Remove the least recently used entries until the cache fits in max_size bytes
+    entries = []
+    total_size = 0
+    try:
+        dir_entries = list(os.scandir(cache_dir))
+    except OSError:
+        return 0
+
+    for entry in dir_entries:
+        if not entry.name.endswith(".json"):
+            continue
+        try:
+            stat = entry.stat()
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, entry.path, stat.st_size))
+        total_size += stat.st_size
+
+    removed = 0
+    entries.sort()
+    for mtime, path, size in entries:
+        if total_size <= max_size:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total_size -= size
+        removed += 1
+
+    return removed
@@ -4,164 +4,170 @@ import json
 import sys
 import os
 import math
+import io
+import mmap
+import functools
+import argparse
+import multiprocessing
+from collections import deque
 
-brief_output = False
+import dump_archive
+import hw_records
+import metrics
+import parse_cache
+
+# Bump this when the parsers change, it invalidates the parse cache
+parser_version = "3"
+
+# Version of the json document layout, stored as "Schema version" in every document.
+# Bump this when keys are renamed or removed, so readers can reject documents they don't know.
+schema_version = 1
 
-def os_parse(f, output_data):
-    f.readline() #Skip blank line
-    output_data["OS"] = f.readline()[:-1] #skip newline
+brief_output = False
 
-def net_parse(f, output_data):
-    f.readline() #Skip blank line
+class SectionError(Exception):
+    pass
+
+class KeyMatcher(dict):
+    # Lookup for which "Key: value" lines to keep, use as matcher[key].
+    # A key matches if "Key:" ends with one of the keywords. The answer is
+    # stored in the dict, so every distinct key is only checked once.
+    def __init__(self, keywords):
+        super().__init__()
+        self.suffixes = tuple(keyword[:-1] for keyword in keywords)
+
+    def __missing__(self, key):
+        found = self[key] = key.endswith(self.suffixes)
+        return found
+
+mobo_keys = KeyMatcher(["Manufacturer:", "Product Name:", "Serial Number:"])
+cpu_keys = KeyMatcher(["Socket Designation:", "Type:", "Manufacturer:", "ID:", "Version:", "Current Speed:", "Thread Count:", "Upgrade:"])
+cpu_brief_keys = KeyMatcher(["Version:"])
+ram_array_keys = KeyMatcher(["Maximum Capacity:", "Number Of Devices:"])
+ram_stick_keys = KeyMatcher(["Size:", "Manufacturer:", "Serial Number:", "Part Number:", "Configured Memory Speed:", "Type:"])
+
+# Record handlers, one per section.
+# They get the records of their section from tokenize() as (section, block, key, value) tuples.
+# A record with the value None marks the start of the section or an empty line.
+
+def os_parse(records, output_data):
+    output_data["OS"] = ""
+    for section, block, key, value in records:
+        if value is not None:
+            output_data["OS"] = value
+            break
 
+def net_parse(records, output_data):
     net_ifaces = list()
     net_data = dict()
 
-    prev_line_empty = False
     entry = 0
 
     net_entries = ["Interface", "MAC", "IP", "PCI address", "Type", "Manufacturer", "Product Name"]
     brief_entries = [1,2]
 
-    while True:
-        out = f.readline()
-        if len(out.split()) == 0:
-            section_type = -1
-            if prev_line_empty:
-                #End of net section
-                break
-            net_ifaces.append(net_data)
-            net_data = dict()
-
-            prev_line_empty = True
+    for section, block, key, value in records:
+        if value is None:
+            if len(net_data) != 0:
+                net_ifaces.append(net_data)
+                net_data = dict()
             entry = 0
         else:
-            prev_line_empty = False
             if brief_output and entry not in brief_entries:
                 entry += 1
                 continue
             if len(net_entries) <= entry:
                 continue
             # Add entry to dict
-            net_data[net_entries[entry]] = out.strip()
+            net_data[net_entries[entry]] = value.strip()
             entry += 1
 
-    output_data["Network"] = net_ifaces
+    if len(net_data) != 0:
+        net_ifaces.append(net_data)
 
-def mobo_parse(f, output_data):
-    #Skip the first line
-    f.readline()
+    output_data["Network"] = net_ifaces
 
+def mobo_parse(records, output_data):
     mobo_data = dict()
 
-    prev_line_empty = False
-
     section_type = -1
-    sec2_keys = ["Manufacturer:", "Product Name:", "Serial Number:"]
 
-    while True:
-        out = f.readline()
-        if len(out.split()) == 0:
+    for section, block, key, value in records:
+        if value is None:
             section_type = -1
-            if prev_line_empty:
-                #End of MOBO section
-                break
-            prev_line_empty = True
-        elif section_type == 2:
-            if any(keyword in out for keyword in sec2_keys):
-                out = out.split(":")
-                mobo_data[out[0].strip()] = out[1].strip()
-        else:
-            prev_line_empty = False
-            if "DMI type 2" in out:
-                section_type = 2
+        elif key == "DMI type":
+            section_type = value
+        elif section_type == 2 and key is not None and mobo_keys[key]:
+            mobo_data[key] = value.split(":")[0].strip()
 
     output_data["Motherboard"] = mobo_data
 
-def cpu_parse(f, output_data):
-    #Skip the first line
-    f.readline()
-
+def cpu_parse(records, output_data):
     cpus = list()
     cpu_data = dict()
 
-    prev_line_empty = False
-
     if brief_output:
-        cpu_keys = ["Version:"]
+        keys = cpu_brief_keys
     else:
-        cpu_keys = ["Socket Designation:", "Type:", "Manufacturer:", "ID:", "Version:", "Current Speed:", "Thread Count:", "Upgrade:"]
+        keys = cpu_keys
 
-    while True:
-        out = f.readline()
-        if len(out.split()) == 0:
-            if prev_line_empty:
-                #End of CPU section
-                break
-            prev_line_empty = True
+    for section, block, key, value in records:
+        if value is None:
             if len(cpu_data) != 0:
                 cpus.append(cpu_data)
                 cpu_data = dict()
-        elif any(keyword in out for keyword in cpu_keys):
-            prev_line_empty = False
-            out = out.split(":")
-            cpu_data[out[0].strip()] = out[1].strip()
+        elif key is not None and key != "DMI type" and keys[key]:
+            cpu_data[key] = value.split(":")[0].strip()
 
-    output_data["CPUs"] = cpus
+    if len(cpu_data) != 0:
+        cpus.append(cpu_data)
 
-def ram_parse(f, output_data):
-    #Skip the first line
-    f.readline()
+    output_data["CPUs"] = cpus
 
+def ram_parse(records, output_data):
     ram_data = dict()
     ram_stick = dict()
     ram_sticks = list()
 
     total_mem = 0
 
-    prev_line_empty = False
-
     section_type = -1
-    sec16_keys = ["Maximum Capacity:", "Number Of Devices:"]
-    sec17_keys = ["Size:", "Manufacturer:", "Serial Number:", "Part Number:", "Configured Memory Speed:", "Type:"]
 
-    while True:
-        out = f.readline()
-        if len(out.split()) == 0:
+    for section, block, key, value in records:
+        if value is None:
             section_type = -1
-            if prev_line_empty:
-                #End of RAM section
-                break
-            prev_line_empty = True
             if len(ram_stick) != 0:
                 ram_sticks.append(ram_stick)
                 ram_stick = dict()
+        elif key == "DMI type":
+            section_type = value
+        elif key is None:
+            continue
         elif section_type == 16:
-            if any(keyword in out for keyword in sec16_keys):
-                out = out.split(":")
-                label = out[0].strip()
-                if label in ram_data:
+            if ram_array_keys[key]:
+                value = value.split(":")[0]
+                if key in ram_data:
                     #Add the quantities together
-                    old_data = int(ram_data[label].split()[0])
-                    new_data = out[1].split()
+                    old_data = int(ram_data[key].split()[0])
+                    new_data = value.split()
                     new_data[0] = str( int(new_data[0]) + old_data )
 
                     new_data = " ".join(new_data)
-                    ram_data[label] = new_data
+                    ram_data[key] = new_data
                 else:
-                    ram_data[label] = out[1].strip()
+                    ram_data[key] = value.strip()
         elif section_type == 17:
-            if any(keyword in out for keyword in sec17_keys):
-                out = out.split(":")
-                ram_stick[out[0].strip()] = out[1].strip()
-                if out[0].strip() == "Size":
-                    mem = out[1].split()[0]
+            if ram_stick_keys[key]:
+                value = value.split(":")[0]
+                ram_stick[key] = value.strip()
+                if key == "Size":
+                    mem = value.split()[0]
                     if not mem.isdigit():
                         #This slot is not populated
                         section_type = -1
                         ram_stick.clear()
                         continue
-                    unit_size = out[1].split()[1]
+                    unit_size = value.split()[1]
                     #Convert to GB
                     if (unit_size == "MB"):
                         mem = int(mem) / 1024
@@ -171,307 +177,567 @@ def ram_parse(f, output_data):
                         mem = int(mem)
 
                     total_mem = total_mem + mem
-        else:
-            prev_line_empty = False
-            if "DMI type 16" in out:
-                section_type = 16
-            elif "DMI type 17" in out:
-                section_type = 17
+
+    if len(ram_stick) != 0:
+        ram_sticks.append(ram_stick)
 
     if brief_output:
         ram_data.clear()
     else:
-        ram_data["Sticks"] = ram_sticks
+        ram_data["Sticks"] = hw_records.pack_entries("RAM", ram_sticks)
 
     ram_data["Total RAM (GB)"] = total_mem
     output_data["RAM"] = ram_data
 
-def gpu_parse(f, output_data):
-    #Skip the first line
-    f.readline()
-
+def gpu_parse(records, output_data):
     gpus = list()
     info = dict()
 
-    while True:
-        out = f.readline()
-        if len(out.split()) == 0:
-            #End of GPU section
-            break
-        elif out[0:3] == "---":
-            if "NVIDIA" in info["Vendor"] or "AMD" in info["Vendor"]:
-               #Only save GPUs from Nvidia and AMD
-                if brief_output:
-                    new_info = dict()
-                    new_info["Vendor"] = info["Vendor"]
-                    new_info["Model"] = info["Model"]
-                    info = new_info
-                gpus.append(info)
+    has_data = False
+
+    for section, block, key, value in records:
+        if value is None:
+            if has_data:
+                #End of GPU section
+                break
+            continue
+
+        has_data = True
+        if key is None:
+            if value[0:3] == "---":
+                if "NVIDIA" in info["Vendor"] or "AMD" in info["Vendor"]:
+                    #Only save GPUs from Nvidia and AMD
+                    if brief_output:
+                        new_info = dict()
+                        new_info["Vendor"] = info["Vendor"]
+                        new_info["Model"] = info["Model"]
+                        info = new_info
+                    gpus.append(info)
                 info = dict()
         else:
-            data = out.split(":")
-
-            if data[0] == "GPU UUID":
+            if key == "GPU UUID":
                 #Nvidia cards
-                data[0] = "UUID"
-
-            if len(data) == 2:
-                info[data[0]] = data[1].strip()
-            else:
-                #we need to stitch together the data string again
-                info[data[0]] = ":".join(data[1:]).strip()
+                key = "UUID"
 
-    output_data["GPUs"] = gpus
+            info[key] = value.strip()
 
-def disk_parse(f, output_data):
-    #Skip the first line
-    f.readline()
+    output_data["GPUs"] = hw_records.pack_entries("GPUs", gpus)
 
+def disk_parse(records, output_data):
     has_drive = False
+    has_data = False
     drives = list()
     info = dict()
-    info["Type"] = "HDD"
-
-    #HDDs
-    while True:
-        out = f.readline()
-        if len(out.split()) == 0:
-            #End of HDD section
-            if has_drive:
-                drives.append(info)
-            break
-        if out[0] == "/":
-            if has_drive:
-                drives.append(info)
+
+    for section, block, key, value in records:
+        if value is None:
+            if has_data:
+                #End of HDD section
+                break
+            continue
+
+        has_data = True
+        if key is None:
+            if value[0] == "/":
+                if has_drive:
+                    drives.append(info)
                 info = dict()
                 info["Type"] = "HDD"
-            info["Node"] = out.strip()
-            has_drive = True
-        else:
-            data = out.split(":")
-            if data[0] == "device size with M = 1000*1000":
+                info["Node"] = value
+                has_drive = True
+        elif has_drive:
+            value = value.split(":")[0].strip()
+            if key == "device size with M = 1000*1000":
                 #Check if this is a empty disk (probably disconnected)
-                data_size = int(data[1].split()[0])
+                data_size = int(value.split()[0])
                 if data_size == 0:
                     #Throw away the data
                     has_drive = False
-                    info = dict()
-                    info["Type"] = "HDD"
+                    continue
 
-            info[data[0].strip()] = data[1].strip()
+            info[key] = value
 
-    output_data["HDDs"] = drives
+    if has_drive:
+        drives.append(info)
 
-def nvme_parse(f, output_data):
-    #Skip the first line
-    f.readline()
+    output_data["HDDs"] = hw_records.pack_entries("HDDs", drives)
 
+def nvme_parse(records, output_data):
     nvme_drives = list()
 
-    category = f.readline().split()
-
-    category_range = list()
-    range_start = 0
-    range_end = 0
-    for entry in f.readline().split():
-        range_end = range_end + len(entry) +1
-        category_range.append(slice(range_start, range_end))
-        range_start = range_end
-
-    #HDDs
-    while True:
-        out = f.readline()
-        if len(out.split()) == 0:
-            #End of NVME section
-            break
+    category = None
+    category_range = None
+
+    for section, block, key, value in records:
+        if value is None:
+            if category_range is not None:
+                #End of NVME section
+                break
+        elif category is None:
+            category = value.split()
+        elif category_range is None:
+            category_range = list()
+            range_start = 0
+            range_end = 0
+            for entry in value.split():
+                range_end = range_end + len(entry) +1
+                category_range.append(slice(range_start, range_end))
+                range_start = range_end
         else:
             info = dict()
             info["Type"] = "NVME"
             for idx, r in enumerate(category_range):
-                info[category[idx]] = out[r].strip()
+                info[category[idx]] = value[r].strip()
             nvme_drives.append(info)
 
-    output_data["HDDs"] += nvme_drives
-
-def input_parse(f, output_data):
-    #Skip the first line
-    f.readline()
+    output_data.setdefault("HDDs", list())
+    output_data["HDDs"] += hw_records.pack_entries("HDDs", nvme_drives)
 
+def input_parse(records, output_data):
     input_list = list()
 
     found_devs = dict() #vendor id : product list
 
-    prev_line_empty = False
     in_section = False
 
     vendor_black_list = ["0000"]
 
-    while True:
-        out = f.readline()
-        if len(out.split()) == 0:
-            if prev_line_empty:
-                #End of input section
-                break
-            prev_line_empty = True
+    for section, block, key, value in records:
+        if value is None:
             in_section = False
-        elif out[0] == "I":
-            prev_line_empty = False
-            vendor = out.split()[2].split("=")[1]
-            product = out.split()[3].split("=")[1]
+        elif value[0] == "I":
+            vendor = value.split()[2].split("=")[1]
+            product = value.split()[3].split("=")[1]
             if vendor in vendor_black_list:
                 continue
             elif vendor in found_devs and found_devs[vendor] == product:
                 continue
             found_devs[vendor] = product
             in_section = True
-        elif in_section and out[0] == "N":
-            out = out[3:].split("=")
+        elif in_section and value[0] == "N":
+            out = value[3:].split("=")
             out = out[1].strip().strip('"')
             input_list.append(out)
 
     output_data["Input devices"] = input_list
 
-def monitor_parse(f, output_data):
+def monitor_parse(records, output_data):
     in_section = False
     mon_info_list = list()
     mon_info = dict()
 
-    for line in f:
-        out = line.strip()
-        if len(out) == 0:
+    for section, block, key, value in records:
+        if value is None:
             continue
 
-        out = out.split(":")
-
-        if out[0] == "Section":
-            in_section = True
-            continue
-        if out[0] == "EndSection":
-            if brief_output:
-                mon_info_new = dict()
-                mon_info_new["Display Size (inch)"] = mon_info["Display Size (inch)"]
-                mon_info = mon_info_new
+        if key is None:
+            if value == "Section":
+                in_section = True
+                continue
+            if value == "EndSection":
+                if brief_output:
+                    mon_info_new = dict()
+                    mon_info_new["Display Size (inch)"] = mon_info["Display Size (inch)"]
+                    mon_info = mon_info_new
 
-            in_section = False
-            mon_info_list.append(mon_info)
-            mon_info = dict()
-            continue
+                in_section = False
+                mon_info_list.append(mon_info)
+                mon_info = dict()
+                continue
 
         if not in_section:
             #The card and output port
-            mon_info["Connector"] = out[0]
+            if key is None:
+                mon_info["Connector"] = value
+            else:
+                mon_info["Connector"] = key
         else:
-            if out[0] == "Display Product Name":
-                mon_info["Model"] = out[1][1:].strip("'")
-            elif out[0] == "Manufacturer":
-                mon_info["Vendor"] = out[1][1:]
-            elif out[0] == "Native Video Resolution":
-                mon_info["Native Resolution"] = out[1][1:]
-            elif out[0] == "Monitor ranges (Bare Limits)":
-                mon_info["Refresh Rate"] = out[1].split()[0] + " Hz"
-            elif out[0] == "Maximum image size":
+            field = value.rstrip().split(":")[0]
+            if key == "Display Product Name":
+                mon_info["Model"] = field[1:].strip("'")
+            elif key == "Manufacturer":
+                mon_info["Vendor"] = field[1:]
+            elif key == "Native Video Resolution":
+                mon_info["Native Resolution"] = field[1:]
+            elif key == "Monitor ranges (Bare Limits)":
+                mon_info["Refresh Rate"] = field.split()[0] + " Hz"
+            elif key == "Maximum image size":
                 # Assuming that this is always in centimeters
-                temp = out[1].split("x")
+                temp = field.split("x")
                 v_size = int(temp[0].split()[0])
                 h_size = int(temp[1].split()[0])
                 inch = math.sqrt(v_size ** 2 + h_size ** 2) / 2.54
                 mon_info["Display Dimentions (cm)"] = [v_size, h_size]
                 mon_info["Display Size (inch)"] = inch
-            elif out[0] == "Made in":
-                mon_info["Manufacture date"] = out[1][1:]
-            elif out[0] == "Display Product Serial Number":
-                mon_info["Serial Number"] = out[1][1:].strip("'")
-            elif out[0] == "Bits per primary color channel":
-                mon_info["Color depth"] = out[1][1:]
-            elif out[0] == "Supported color formats":
-                out = line[25:].strip()
-                mon_info["Color formats"] = out.split(", ")
+            elif key == "Made in":
+                mon_info["Manufacture date"] = field[1:]
+            elif key == "Display Product Serial Number":
+                mon_info["Serial Number"] = field[1:].strip("'")
+            elif key == "Bits per primary color channel":
+                mon_info["Color depth"] = field[1:]
+            elif key == "Supported color formats":
+                mon_info["Color formats"] = value.strip().split(", ")
 
     if in_section:
         #Something is wrong, this shouldn't happen
         output_data["Monitors"] = "Error parsing monitor data, check input file"
     else:
-        output_data["Monitors"] = mon_info_list
+        output_data["Monitors"] = hw_records.pack_entries("Monitors", mon_info_list)
+
+# Section name: (line format, record handler)
+# The line formats are:
+#  "raw": the value is the line as is
+#  "kv": "Key: value" lines are split on the first colon (the value is left as is), other lines are stripped
+#  "dmi": like "kv", but dmidecode "Handle ..., DMI type N, ..." lines give a ("DMI type", N) record
+sections = {
+        "OS": ("raw", os_parse),
+        "Network": ("raw", net_parse),
+        "Motherboard": ("dmi", mobo_parse),
+        "CPU": ("dmi", cpu_parse),
+        "RAM": ("dmi", ram_parse),
+        "GPU": ("kv", gpu_parse),
+        "HDD": ("kv", disk_parse),
+        "NVME": ("raw", nvme_parse),
+        "Input devices": ("raw", input_parse),
+        "Monitor info": ("kv", monitor_parse),
+        }
+
+# Sections that are not parsed with brief_output
+brief_skip_sections = {"OS", "Motherboard", "HDD", "NVME", "Input devices"}
+
+def section_name(line):
+    # "===| CPU |===" -> "CPU"
+    if not line.startswith("===|"):
+        return None
+    line_parse = line.split("|")
+    if len(line_parse) != 3:
+        return None
+    return line_parse[1].strip()
+
+def split_sections(f):
+    # Walk the dump once and yield (section, records) for every section.
+    # The records are (section, block, key, value) tuples,
+    # block counts the empty line separated blocks in a section.
+    section = None
+    line_format = None
+    block = 0
+    records = []
+    add = records.append
 
-#Main section start
-
-if len(sys.argv) < 3:
-    print("You need to provide a file to parse and output directory!")
-    sys.exit()
+    for line in f:
+        if line.isspace():
+            block += 1
+            add((section, block, None, None))
+            continue
 
-out_dir = sys.argv[-1]
+        if line_format != "raw":
+            key, sep, value = line.partition(":")
+            if len(sep) != 0:
+                add((section, block, key.strip(), value))
+                continue
 
-for input_file in sys.argv[1:-1]:
-    print(input_file)
-    try:
-        f= open(input_file,"r")
-    except:
-        print("Couldn't open file " + input_file + " for reading")
-        continue
-        #sys.exit()
+        if line.startswith("===|"):
+            name = section_name(line)
+            if name is not None:
+                if name not in sections:
+                    raise SectionError("Unknown section value: " + name)
+                if len(records) != 0:
+                    yield section, records
+                section = name
+                line_format = sections[name][0]
+                block = 0
+                records = [(section, block, None, None)]
+                add = records.append
+                continue
 
+        if line_format == "raw":
+            add((section, block, None, line.rstrip("\n")))
+        elif line_format == "dmi" and line.startswith("Handle ") and ", DMI type " in line:
+            dmi_type = line.split(", DMI type ")[1].split(",")[0]
+            add((section, block, "DMI type", int(dmi_type)))
+        else:
+            add((section, block, None, line.strip()))
+
+    if len(records) != 0:
+        yield section, records
+
+def section_index(buf):
+    # Byte offsets of the sections of a dump in buf (bytes or an mmap), found
+    # without decoding or splitting the rest of it. Returns [section, start, end]
+    # lists in file order, start is the offset of the "===| X |===" line.
+    # The header lines are recognized the same way split_sections() does.
+    index = []
+    first = buf.find(b"\n")
+    if first < 0:
+        # Only the hostname line
+        return index
+
+    line_format = None
+    pos = first + 1
+    while pos < len(buf):
+        if buf[pos:pos + 4] != b"===|":
+            found = buf.find(b"\n===|", pos)
+            if found < 0:
+                break
+            pos = found + 1
+        end = buf.find(b"\n", pos)
+        if end < 0:
+            end = len(buf)
+
+        line = bytes(buf[pos:end]).decode("utf-8", "replace")
+        name = section_name(line)
+        # In the "kv" and "dmi" sections a line with a colon is a record
+        if name is not None and (line_format == "raw" or ":" not in line):
+            if name not in sections:
+                raise SectionError("Unknown section value: " + name)
+            if len(index) != 0:
+                index[-1][2] = pos
+            index.append([name, pos, len(buf)])
+            line_format = sections[name][0]
+        pos = end + 1
+
+    return index
+
+def tokenize(f):
+    # Walk the dump once and yield the (section, block, key, value) records
+    for section, records in split_sections(f):
+        yield from records
+
+def parse_dump(f, user):
     output_data = dict()
 
-    filename = os.path.basename(input_file)
-
-    output_data["User"] = filename
+    output_data["Schema version"] = schema_version
+    output_data["User"] = user
     output_data["Hostname"] = f.readline()[:-1] #skip newline
 
-    for line in f:
-        line_parse = line.split("|")
-        if len(line_parse) != 3:
-            #Not a section line
+    for section, records in split_sections(f):
+        if section is None:
+            #Lines before the first section
+            continue
+        if brief_output and section in brief_skip_sections:
             continue
+        parse_section(section, records, output_data)
 
-        line_parse = line_parse[1]
-        if line_parse == " OS ":
-            #===| OS |===
-            if brief_output:
-                continue
-            os_parse(f, output_data)
-        elif line_parse == " Network ":
-            net_parse(f, output_data)
-        elif line_parse == " Motherboard ":
-            #===| Motherboard |===
-            if brief_output:
-                continue
-            mobo_parse(f, output_data)
-        elif line_parse == " CPU ":
-            #===| CPU |===
-            cpu_parse(f, output_data)
-        elif line_parse == " RAM ":
-            #===| RAM |===
-            ram_parse(f, output_data)
-        elif line_parse == " GPU ":
-            #===| GPU |===
-            gpu_parse(f, output_data)
-        elif line_parse == " HDD ":
-            #===| HDD |===
-            if brief_output:
-                continue
-            disk_parse(f, output_data)
-        elif line_parse == " NVME ":
-            #===| NVME |===
-            if brief_output:
-                continue
-            nvme_parse(f, output_data)
-        elif line_parse == " Input devices ":
-            #===| Input devices |===
-            if brief_output:
-                continue
-            input_parse(f, output_data)
-        elif line_parse == " Monitor info ":
-            #===| Monitor info |===
-            monitor_parse(f, output_data)
-        else:
-            print("Unknown section value! Exiting...")
-            sys.exit()
+    return output_data
 
-    #convert to json
-    out_json = json.dumps(output_data)
+def parse_section(section, records, output_data):
+    with metrics.timer("section/" + section):
+        sections[section][1](records, output_data)
+    metrics.count("lines/" + section, len(records))
+
+def decode(data):
+    # Decode the same way as open(input_file, "r") would
+    return io.TextIOWrapper(io.BytesIO(data))
+
+def parse_dump_sections(buf, user, wanted):
+    # Like parse_dump, but only the wanted sections are parsed. The dump is in
+    # buf (bytes or an mmap), only the hostname line and the wanted sections of it are decoded.
+    output_data = dict()
+
+    output_data["Schema version"] = schema_version
+    output_data["User"] = user
+    first = buf.find(b"\n")
+    output_data["Hostname"] = decode(buf[:first + 1 if first >= 0 else len(buf)]).readline()[:-1]
+
+    with metrics.timer("stage/index"):
+        index = section_index(buf)
+    for name, start, end in index:
+        if name not in wanted or (brief_output and name in brief_skip_sections):
+            metrics.count("bytes/skipped", end - start)
+            continue
+        for section, records in split_sections(decode(buf[start:end])):
+            parse_section(section, records, output_data)
+
+    return output_data
+
+def section_list(text):
+    # "cpu,GPU, RAM" -> {"CPU", "GPU", "RAM"}, for --sections
+    by_name = {name.lower(): name for name in sections}
+    wanted = set()
+    for name in text.split(","):
+        name = name.strip()
+        if name.lower() not in by_name:
+            raise argparse.ArgumentTypeError("unknown section " + name + ", use a comma separated list of " + ", ".join(sections))
+        wanted.add(by_name[name.lower()])
+    return wanted
+
+def cache_variant(wanted = None):
+    # Everything besides the dump that changes the parse result
+    variant = parser_version + str(brief_output)
+    if wanted is not None:
+        variant += "|" + ",".join(sorted(wanted))
+    return variant
+
+def parse_file(input_file, cache_dir = None, wanted = None, raw_data = None):
+    # wanted is the set of sections to parse, None for all of them.
+    # raw_data is the content of input_file if it is already read (from an archive).
+    user = os.path.basename(input_file)
+
+    if raw_data is not None:
+        metrics.count("bytes/read", len(raw_data))
+        if cache_dir is None:
+            with metrics.timer("stage/parse"):
+                if wanted is not None:
+                    return parse_dump_sections(raw_data, user, wanted)
+                return parse_dump(decode(raw_data), user)
+        return parse_cached(raw_data, user, cache_dir, wanted)
+
+    if cache_dir is None and wanted is not None:
+        with open(input_file, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            metrics.count("bytes/read", size)
+            # An empty file can't be mapped
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size != 0 else b""
+        try:
+            with metrics.timer("stage/parse"):
+                return parse_dump_sections(buf, user, wanted)
+        finally:
+            if size != 0:
+                buf.close()
+
+    if cache_dir is None:
+        with open(input_file, "r") as f:
+            metrics.count("bytes/read", os.fstat(f.fileno()).st_size)
+            with metrics.timer("stage/parse"):
+                return parse_dump(f, user)
+
+    with open(input_file, "rb") as f:
+        raw_data = f.read()
+    metrics.count("bytes/read", len(raw_data))
+    return parse_cached(raw_data, user, cache_dir, wanted)
+
+def parse_cached(raw_data, user, cache_dir, wanted = None):
+    key = parse_cache.cache_key(raw_data, cache_variant(wanted))
+    with metrics.timer("stage/cache get"):
+        output_data = parse_cache.get(cache_dir, key)
+    if output_data is not None:
+        metrics.count("cache/hit")
+        # The user name comes from the file name and not the dump content
+        output_data["User"] = user
+        return output_data
+    metrics.count("cache/miss")
+
+    with metrics.timer("stage/parse"):
+        if wanted is not None:
+            output_data = parse_dump_sections(raw_data, user, wanted)
+        else:
+            output_data = parse_dump(decode(raw_data), user)
+    with metrics.timer("stage/cache put"):
+        parse_cache.put(cache_dir, key, output_data)
+    return output_data
+
+def iter_sources(input_files):
+    # Yield (file, None) for the dump files and (name, content) for the dumps in archives.
+    # An archive that can't be read (or stops half way) is given as (archive, ArchiveError),
+    # it fails like a dump that can't be parsed and the other inputs are still parsed.
+    for input_file in input_files:
+        if dump_archive.is_archive(input_file):
+            try:
+                yield from dump_archive.iter_members(input_file)
+            except dump_archive.ArchiveError as e:
+                yield input_file, e
+        else:
+            yield input_file, None
+
+def ordered_imap(pool, func, items, window):
+    # Like pool.imap, but at most window items are taken from items ahead of the
+    # results, so a big archive is never read into memory all at once
+    pending = deque()
+    for item in items:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while len(pending) != 0:
+        yield pending.popleft().get()
+
+def parse_job(source, cache_dir = None, with_metrics = False, wanted = None):
+    # Runs in the worker processes, so errors are returned instead of raised
+    # to not stop the rest of the batch. The metrics of the job are sent back as well.
+    if with_metrics:
+        metrics.enable()
+    input_file, raw_data = source
     try:
-        f_out = open(out_dir + filename + ".json","w")
-    except:
-        print("Couldn't open file " + input_file + " for writing")
-        sys.exit()
-    f_out.write(out_json)
+        if isinstance(raw_data, dump_archive.ArchiveError):
+            raise raw_data
+        result = input_file, parse_file(input_file, cache_dir, wanted, raw_data), None
+    except dump_archive.ArchiveError as e:
+        result = input_file, None, str(e)
+    except OSError:
+        result = input_file, None, "Couldn't open file " + input_file + " for reading"
+    except Exception as e:
+        result = input_file, None, "Couldn't parse file " + input_file + ": " + repr(e)
+    return result + (metrics.take() if with_metrics else None,)
+
+def write_output(out_dir, input_file, output_data):
+    filename = os.path.basename(input_file)
+    #convert to json
+    with metrics.timer("stage/write"):
+        out_json = json.dumps(output_data, default=hw_records.json_default)
+        with open(out_dir + filename + ".json","w") as f_out:
+            f_out.write(out_json)
+    metrics.count("bytes/written", len(out_json))
+
+def main():
+    parser = argparse.ArgumentParser(description="Parse hw_script.sh dumps into json files.")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+            help="number of worker processes to parse with (default: 1)")
+    parser.add_argument("--cache", metavar="DIR",
+            help="cache parse results in DIR and skip re-parsing unchanged dumps")
+    parser.add_argument("--cache-size", type=int, default=parse_cache.default_max_size // (1024 * 1024),
+            metavar="MB", help="maximum size of the parse cache (default: %(default)s MB)")
+    parser.add_argument("--sections", type=section_list, metavar="LIST",
+            help="only parse these sections, a comma separated list out of " + ", ".join(sections) +
+            " (for example CPU,GPU,RAM for the ranking). The dump is memory mapped and the other sections are skipped without reading them.")
+    parser.add_argument("input_files", nargs="+",
+            help="hw_script.sh output files, or .tar/.tar.gz/.tar.zst archives or .gz files of them")
+    parser.add_argument("out_dir", help="output directory (with trailing slash)")
+    metrics.add_arguments(parser)
+
+    args = parser.parse_args()
+    metrics.setup(args)
+
+    job = functools.partial(parse_job, cache_dir=args.cache, with_metrics=metrics.enabled, wanted=args.sections)
+
+    if args.jobs > 1:
+        pool = multiprocessing.Pool(args.jobs)
+        # The results come in input order, so the output is the same as a serial run
+        results = ordered_imap(pool, job, iter_sources(args.input_files), args.jobs * 4)
+    else:
+        pool = None
+        results = map(job, iter_sources(args.input_files))
+
+    failed = []
+    for input_file, output_data, error, job_metrics in results:
+        if job_metrics is not None:
+            metrics.merge(job_metrics)
+        print(input_file)
+        if error is not None:
+            metrics.count("files/failed")
+            print(error)
+            failed.append(input_file)
+            continue
+        metrics.count("files/parsed")
+        try:
+            write_output(args.out_dir, input_file, output_data)
+        except OSError:
+            print("Couldn't open file " + input_file + " for writing")
+            sys.exit(1)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    if args.cache is not None:
+        with metrics.timer("stage/cache evict"):
+            parse_cache.evict(args.cache, args.cache_size * 1024 * 1024)
+
+    metrics.finish(args, "parse_output")
+
+    if len(failed) != 0:
+        print("The following files could not be parsed:")
+        for input_file in failed:
+            print(input_file)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -3,198 +3,320 @@
 import sys
 import json
 import os
-from collections import defaultdict
+import argparse
+import glob
+import multiprocessing
+from collections import defaultdict, deque
+
+import dump_archive
+import fleet_db
+import fleet_history
+import fleet_index
+import fleet_snapshot
+import hw_ledger
+import hw_records
+import metrics
+import parse_output
 
 # Same dir as this python file
 data_base_dir = os.path.dirname(os.path.realpath(__file__))
 data_base_path = data_base_dir + "/data.json"
 
-def load(input_file):
-    # read file
-    with open(input_file, 'r') as json_file:
-        data = json_file.read()
-
-    # parse file
-    obj = json.loads(data)
+def read_source(source, text = None):
+    # The json object of a file, or of a line read from stdin or a file in an archive (text)
+    with metrics.timer("stage/load"):
+        if text is None:
+            # read file
+            with open(source, 'r') as json_file:
+                text = json_file.read()
+
+        # parse file
+        obj = json.loads(text)
+    metrics.count("bytes/read", len(text))
+    return obj
+
+def load(source, text = None):
+    obj = read_source(source, text)
+    check_computer(obj, source)
     mobo_serial = obj["Motherboard"]["Serial Number"]
-    return mobo_serial, obj
-
-def data_match(new_data, old_data, data_type):
-    entries_to_compare = {"Motherboard": "Serial Number",
-            "CPUs": "Version",
-            "RAM": ["Serial Number", "Part Number"],
-            "GPUs": "UUID",
-            "HDDs": {"NVME":"SN", "HDD":"Serial Number"},
-            "Monitors": "Serial Number"}
-
-    keyword = entries_to_compare[data_type]
-
-    if isinstance(keyword, list):
-        for key in keyword:
-            if new_data[key] != old_data[key]:
-                return False
-    elif isinstance(keyword, dict):
-        new_key = keyword[new_data["Type"]]
-        old_key = keyword[old_data["Type"]]
-        if new_data[new_key] != old_data[old_key]:
-            return False
+    return mobo_serial, hw_records.pack_computer(obj)
+
+def schema_error(obj):
+    # Documents without a version are from before it was added, they have the version 1 layout
+    version = obj.get("Schema version", 1)
+    if not isinstance(version, int) or version > parse_output.schema_version:
+        return ("unsupported schema version " + str(version) +
+                ", this script supports up to version " + str(parse_output.schema_version))
+    return None
+
+def computer_error(obj):
+    # Why a parsed computer can't be merged, None if it can. Checked before
+    # anything is changed, so a bad document never leaves a merge half done.
+    if not isinstance(obj, dict):
+        return "the document is not a json object"
+    error = schema_error(obj)
+    if error is not None:
+        return error
+    try:
+        if not isinstance(obj["Motherboard"]["Serial Number"], str):
+            return "the motherboard serial number is not a string"
+        for keyword, entries in hw_ledger.computer_entries(obj):
+            for entry in entries:
+                hash(hw_ledger.match_key(entry, keyword))
+    except (KeyError, TypeError, IndexError) as e:
+        return "missing or invalid HW info: " + repr(e)
+    return None
+
+def check_computer(obj, source):
+    error = computer_error(obj)
+    if error is not None:
+        print(source + ": " + error)
+        sys.exit(1)
+
+def file_sources(input_file):
+    # The .json files in an archive are read from it one at a time, in archive order
+    if dump_archive.is_archive(input_file):
+        yield from dump_archive.iter_members(input_file, ".json")
     else:
-        if new_data[keyword] != old_data[keyword]:
-            return False
-
-    return True
-
-def process_new_computer_info(serial, new_data, old_data, used_dict, unused_dict):
-    keywords = ["Motherboard", "CPUs", ["RAM", "Sticks"], "GPUs", "HDDs", "Monitors"]
-    for keyword in keywords:
-        if isinstance(keyword, list):
-            new_key_data = new_data[keyword[0]]
-            old_key_data = old_data[keyword[0]]
-            for i in range(1,len(keyword)):
-                new_key_data = new_key_data[keyword[i]]
-                old_key_data = old_key_data[keyword[i]]
-            #Set keyword for later usage
-            keyword = keyword[0]
+        yield input_file, None
+
+def iter_sources(inputs):
+    # Yield (file, None) for the json files in files, directories or globs,
+    # ("<stdin>", line) for the json lines on stdin ("-"), empty lines are skipped,
+    # and (name, content) for the json files in archives
+    for input_path in inputs:
+        if input_path == "-":
+            for line in sys.stdin:
+                if len(line.strip()) != 0:
+                    yield "<stdin>", line
+        elif os.path.isdir(input_path):
+            for input_file in sorted(glob.glob(os.path.join(input_path, "*.json"))):
+                yield input_file, None
+        elif not os.path.exists(input_path) and glob.has_magic(input_path):
+            for input_file in sorted(glob.glob(input_path)):
+                yield from file_sources(input_file)
         else:
-            new_key_data = new_data[keyword]
-            old_key_data = old_data[keyword]
-
-        if isinstance(new_key_data, list):
-            for new_entry in new_key_data:
-                found_match = False
-                for old_entry in old_key_data:
-                    if data_match(new_entry, old_entry, keyword):
-                        found_match = True
-                        old_key_data.remove(old_entry)
-                        break
-                if not found_match:
-                    #Insert the serial of the computer in the new used entry
-                    tmp = new_entry.copy()
-                    tmp["Comp Serial"] = serial
-                    used_dict[keyword].append(tmp)
-            if len(old_data) != 0:
-                for old_entry in old_key_data:
-                    unused_dict[keyword].append(old_entry)
+            yield from file_sources(input_path)
+
+def iter_inputs(inputs):
+    # Yield the computers one at a time
+    for source, text in iter_sources(inputs):
+        yield load(source, text)
+
+def match_entries(new_entries, old_entries, data_type):
+    # Pair up the new and old entries with the same identity.
+    # Returns the new entries without a match and the old entries without a match.
+    # Duplicate keys are matched in list order, the same as a linear search would.
+    old_index = defaultdict(deque)
+    for idx, old_entry in enumerate(old_entries):
+        old_index[hw_ledger.match_key(old_entry, data_type)].append(idx)
+
+    matched = set()
+    new_unmatched = []
+    for new_entry in new_entries:
+        candidates = old_index.get(hw_ledger.match_key(new_entry, data_type))
+        if candidates:
+            matched.add(candidates.popleft())
         else:
-            #data is dict
-            if not data_match(new_key_data, old_key_data, keyword):
-               #Insert the serial of the computer in the new used entry
-               tmp = new_key_data.copy()
-               tmp["Comp Serial"] = serial
-               used_dict[keyword].append(tmp)
-
-               unused_dict[keyword].append(old_key_data)
-
-#Main start
-
-if len(sys.argv) < 2:
-    print("You need to provide files to parse!")
-    sys.exit()
-
-if os.path.isfile(data_base_path):
-    with open(data_base_path, 'r') as data_file:
-        data = data_file.read()
-
-    database = json.loads(data)
-else:
-    database = {"Computers": {}, "HW": {"used": {}, "unused": {}}}
-
-data_to_add = []
-
-# Default init all key values to lists
-new_used_hw = defaultdict(list)
-new_unused_hw = defaultdict(list)
-
-for input_file in sys.argv[1:]:
-    serial, data = load(input_file)
-
-    if serial in database["Computers"]:
-        process_new_computer_info(serial, data, database["Computers"][serial], new_used_hw, new_unused_hw)
-        del database["Computers"][serial]
+            new_unmatched.append(new_entry)
+
+    old_unmatched = [old_entry for idx, old_entry in enumerate(old_entries) if idx not in matched]
+    metrics.count("comparisons/" + data_type, len(new_entries))
+    metrics.count("matches/" + data_type, len(matched))
+    return new_unmatched, old_unmatched
+
+def process_new_computer_info(serial, new_data, old_data, merge):
+    new_entries = dict(hw_ledger.computer_entries(new_data))
+    for keyword, old_entries in hw_ledger.computer_entries(old_data):
+        new_unmatched, old_unmatched = match_entries(new_entries[keyword], old_entries, keyword)
+        for new_entry in new_unmatched:
+            merge["installed"].append((keyword, new_entry, serial))
+        for old_entry in old_unmatched:
+            merge["removed"].append((keyword, old_entry, serial))
+
+def new_merge(database):
+    # State of a merge in progress, the HW changes are applied to the ledger at the end
+    return {"seen": {}, "installed": [], "removed": [], "ledger": hw_ledger.build(database)}
+
+def diff_computer(serial, data, old_data, merge):
+    # The HW installed in and removed from a computer, old_data is None for a new computer
+    if old_data is not None:
+        process_new_computer_info(serial, data, old_data, merge)
     else:
         #Add all hw to the used pile
-        keywords = ["Motherboard", "CPUs", ["RAM", "Sticks"], "GPUs", "HDDs", "Monitors"]
-        for keyword in keywords:
-            if isinstance(keyword, list):
-                new_key_data = data[keyword[0]]
-                for i in range(1,len(keyword)):
-                    new_key_data = new_key_data[keyword[i]]
-                #Set keyword for later usage
-                keyword = keyword[0]
-            else:
-                new_key_data = data[keyword]
-
-            if isinstance(new_key_data, list):
-                for new_entry in new_key_data:
-                    #Insert the serial of the computer in the new used entry
-                    tmp = new_entry.copy()
-                    tmp["Comp Serial"] = serial
-                    new_used_hw[keyword].append(tmp)
-            else:
-                #data is dict
-                #Insert the serial of the computer in the new used entry
-                tmp = new_key_data.copy()
-                tmp["Comp Serial"] = serial
-                new_used_hw[keyword].append(tmp)
-
-    data_to_add.append({serial: data})
-
-# Computers unaccounted for
-if len(database["Computers"]):
-    print("The following computers have not dumped their HW info for this update:")
-    for comp in database["Computers"]:
-        print("User: " + database["Computers"][comp]["User"])
-        print("Serial: " + comp)
-        print()
+        for keyword, new_entries in hw_ledger.computer_entries(data):
+            for new_entry in new_entries:
+                merge["installed"].append((keyword, new_entry, serial))
 
-# Missing computers
-missing_serials = [serial for serial in database["Computers"]]
+def add_computer(database, merge, serial, data):
+    computers = database["Computers"]
 
-print(missing_serials)
+    # Pop it so the updated computer is moved to the end, the same as a new one
+    diff_computer(serial, data, computers.pop(serial, None), merge)
 
-for data in data_to_add:
     # Add new computer
-    for serial, comp_data in data.items():
-        database["Computers"][serial] = comp_data
-
-# Merge the unused HW list
-for key, value in database["HW"]["unused"].items():
-    new_unused_hw[key] += value
-
-# Did any HW get reused?
-for keyword in new_unused_hw:
-    for entry in new_unused_hw[keyword]:
-        for used in new_used_hw[keyword]:
-            if data_match(used, entry, keyword):
-                #This one was probably reused in a new computer
-                new_unused_hw[keyword].remove(entry)
-                break
-
-# Merge the used HW list
-for key, entry in database["HW"]["used"].items():
-    new_used_hw[key] += entry
-
-# Cleanup unused entries in the used/unused categories (warpped in list to be able to delete in the for loop)
-for keyword in list(new_unused_hw):
-    if len(new_unused_hw[keyword]) == 0:
-        del new_unused_hw[keyword]
-
-for keyword in list(new_used_hw):
-    if len(new_used_hw[keyword]) == 0:
-        del new_used_hw[keyword]
-
-#Remove unused hw from the used dict. (and remove computer serial numbers from them)
-for keyword in new_unused_hw:
-    for entry in new_unused_hw[keyword]:
-        if "Comp Serial" in entry:
-            for used in new_used_hw[keyword]:
-                if used["Comp Serial"] == entry["Comp Serial"] and data_match(used, entry, keyword):
-                    new_used_hw[keyword].remove(used)
-                    del entry["Comp Serial"]
-                    break
-
-database["HW"]["used"] = new_used_hw
-database["HW"]["unused"] = new_unused_hw
-
-with open(data_base_path, 'w') as data_file:
-    json.dump(database, data_file)
+    computers[serial] = data
+    merge["seen"][serial] = True
+
+# The computers of the database before the merge, in the worker processes
+worker_computers = None
+
+def init_worker(computers, with_metrics):
+    global worker_computers
+    worker_computers = computers
+    if with_metrics:
+        metrics.enable()
+
+def diff_job(source):
+    # Map phase, runs in the worker processes: load a computer and diff it against
+    # the database. Documents that can't be merged are returned as errors, the main process exits on them.
+    source, text = source
+    obj = read_source(source, text)
+    error = computer_error(obj)
+    if error is not None:
+        result = source, None, None, source + ": " + error
+    else:
+        serial = obj["Motherboard"]["Serial Number"]
+        data = hw_records.pack_computer(obj)
+        changes = {"installed": [], "removed": []}
+        diff_computer(serial, data, worker_computers.get(serial), changes)
+        result = serial, data, changes, None
+    return result + (metrics.take() if metrics.enabled else None,)
+
+def add_diffed_computer(database, merge, serial, data, changes):
+    # Reduce phase, in input order. The workers diff against the database as it was
+    # before the merge, which is wrong for a computer that already dumped in this merge,
+    # those are diffed again here against the earlier dump.
+    if serial in merge["seen"]:
+        add_computer(database, merge, serial, data)
+        return
+
+    computers = database["Computers"]
+    computers.pop(serial, None)
+    merge["installed"] += changes["installed"]
+    merge["removed"] += changes["removed"]
+    computers[serial] = data
+    merge["seen"][serial] = True
+
+def merge_parallel(database, merge, inputs, jobs):
+    # Load and diff the computers in worker processes and add them in input order,
+    # so the merge is the same as a serial one
+    with multiprocessing.Pool(jobs, init_worker, (database["Computers"], metrics.enabled)) as pool:
+        for serial, data, changes, error, job_metrics in parse_output.ordered_imap(pool, diff_job, iter_sources(inputs), jobs * 16):
+            if job_metrics is not None:
+                metrics.merge(job_metrics)
+            if error is not None:
+                print(error)
+                sys.exit(1)
+            with metrics.timer("stage/merge"):
+                add_diffed_computer(database, merge, serial, data, changes)
+            metrics.count("files/merged")
+
+def missing_computers(database, merge):
+    # Computers in the database that were not part of this merge
+    return [serial for serial in database["Computers"] if serial not in merge["seen"]]
+
+def finish_merge(database, merge):
+    ledger = merge["ledger"]
+
+    # Removed parts go on the shelf first, so the installs below
+    # can tell the parts that moved to another computer
+    for keyword, entry, serial in merge["removed"]:
+        hw_ledger.shelve(ledger, keyword, entry, serial)
+    for keyword, entry, serial in merge["installed"]:
+        hw_ledger.install(ledger, keyword, entry, serial)
+
+    database["HW"] = hw_ledger.views(ledger)
+    for event in ledger["events"]:
+        metrics.count("ledger/" + event[0])
+
+def print_moves(merge):
+    moves = [event for event in merge["ledger"]["events"] if event[0] == "moved"]
+    if len(moves):
+        print("The following HW moved between computers:")
+        for kind, keyword, key, source, target in moves:
+            print(keyword + " " + str(key) + ": " + source + " -> " + target)
+        print()
+
+def save_merge(db_path, database, merge, previous, history = True, index = True, snapshot = None):
+    # Write a finished merge to the database and update the files kept next to it
+    hw_changes = hw_ledger.changes(merge["ledger"])
+    with metrics.timer("stage/save"):
+        fleet_db.save_database(db_path, database, merge["seen"], hw_changes)
+    metrics.count("bytes/database", os.path.getsize(db_path))
+
+    if history:
+        with metrics.timer("stage/history"):
+            fleet_history.record_merge(fleet_history.history_path(db_path), previous, database, merge["seen"])
+
+    if index:
+        with metrics.timer("stage/index"):
+            fleet_index.sync(fleet_index.index_path(db_path), database, merge["seen"], hw_changes)
+
+    if snapshot is not None:
+        with metrics.timer("stage/snapshot"):
+            fleet_snapshot.write_snapshot(snapshot, database)
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge parsed computer json files into the HW database.")
+    parser.add_argument("--db", default=data_base_path,
+            help="database to update, a .json file or a .db/.sqlite SQLite database (default: %(default)s)")
+    parser.add_argument("inputs", nargs="+",
+            help="json files from parse_output.py, directories, globs or .tar/.tar.gz/.tar.zst archives of them, or - to read json lines from stdin")
+    parser.add_argument("--no-index", action="store_true",
+            help="don't update the lookup index (the database path + .index) used by fleet_index.py")
+    parser.add_argument("--no-history", action="store_true",
+            help="don't record the merge in the history (the database path + .history) used by fleet_history.py")
+    parser.add_argument("--snapshot", metavar="FILE",
+            help="also write a columnar snapshot of the updated database for fleet_snapshot.py queries")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+            help="number of worker processes to load and diff the computers with (default: 1)")
+    metrics.add_arguments(parser)
+
+    args = parser.parse_args()
+    metrics.setup(args)
+
+    with metrics.timer("stage/load database"):
+        database = fleet_db.load_database(args.db)
+    merge = new_merge(database)
+    # The computers as they were before the merge, for the history
+    previous = dict(database["Computers"])
+
+    try:
+        if args.jobs > 1:
+            merge_parallel(database, merge, args.inputs, args.jobs)
+        else:
+            # Computers are merged one at a time as they are read,
+            # so only the database and the current computer are kept in memory.
+            for serial, data in iter_inputs(args.inputs):
+                with metrics.timer("stage/merge"):
+                    add_computer(database, merge, serial, data)
+                metrics.count("files/merged")
+    except dump_archive.ArchiveError as e:
+        # Nothing is saved, the database stays as it was
+        print(e)
+        sys.exit(1)
+
+    # Missing computers
+    missing_serials = missing_computers(database, merge)
+
+    # Computers unaccounted for
+    if len(missing_serials):
+        print("The following computers have not dumped their HW info for this update:")
+        for comp in missing_serials:
+            print("User: " + database["Computers"][comp]["User"])
+            print("Serial: " + comp)
+            print()
+
+    print(missing_serials)
+
+    with metrics.timer("stage/finish merge"):
+        finish_merge(database, merge)
+    print_moves(merge)
+
+    save_merge(args.db, database, merge, previous, not args.no_history, not args.no_index, args.snapshot)
+
+    metrics.finish(args, "process_json_data")
+
+if __name__ == "__main__":
+    main()
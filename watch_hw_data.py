@@ -0,0 +1,335 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import json
+import time
+import select
+import signal
+import struct
+import argparse
+import ctypes
+import ctypes.util
+
+import atomic_file
+import create_bench_rank_list
+import fleet_db
+import hw_records
+import parse_output
+import process_json_data
+
+# Watch mode: keep the HW database up to date while extract.sh drops new
+# dumps into hw_data/, instead of running parse_output.py and
+# process_json_data.py over the whole set by hand.
+#
+# The directory is watched with inotify (through ctypes, no extra packages),
+# or polled every --poll-interval seconds where inotify isn't available.
+# hw_script.sh moves its output in place in one go, but files copied in by
+# hand can be seen half written, so a dump is only picked up after its size
+# and modification time have stayed the same for --settle seconds.
+#
+# The database (and the benchmark lists for --rank) are loaded once. Every
+# batch of new or changed dumps is parsed and merged into it the same way as
+# process_json_data.py does, and only those computers are rewritten in the
+# index, history and SQLite database.
+#
+# The size and modification time of the merged dumps are kept next to the
+# database (the database path + .watch), so changes made while the watcher
+# wasn't running are picked up when it starts.
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_CLOEXEC = 0o2000000
+
+watch_mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF | IN_MOVE_SELF
+
+event_header = struct.Struct("iIII")
+
+def inotify_watch(path):
+    # An inotify fd watching the directory, or None if inotify can't be used here
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        inotify_init1 = libc.inotify_init1
+        inotify_add_watch = libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+
+    fd = inotify_init1(IN_CLOEXEC)
+    if fd < 0:
+        return None
+    if inotify_add_watch(fd, os.fsencode(path), watch_mask) < 0:
+        print("Couldn't watch " + path + ": " + os.strerror(ctypes.get_errno()))
+        os.close(fd)
+        return None
+    return fd
+
+def read_events(fd):
+    # The file names in the waiting inotify events. None in the list means
+    # events were lost (or the directory is gone) and everything has to be checked.
+    data = os.read(fd, 64 * 1024)
+    names = []
+    pos = 0
+    while pos + event_header.size <= len(data):
+        wd, mask, cookie, length = event_header.unpack_from(data, pos)
+        name = data[pos + event_header.size:pos + event_header.size + length].rstrip(b"\0")
+        pos += event_header.size + length
+        if mask & (IN_Q_OVERFLOW | IN_IGNORED | IN_DELETE_SELF | IN_MOVE_SELF):
+            names.append(None)
+        elif len(name) != 0:
+            names.append(os.fsdecode(name))
+    return names
+
+def is_dump(name):
+    # Skip hidden files and the temp files of hw_script.sh and collect.py
+    return not name.startswith(".") and not name.endswith(".tmp")
+
+def signature(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    if not os.path.isfile(path):
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+def state_path(db_path):
+    return db_path + ".watch"
+
+def load_state(path):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return dict()
+
+def save_state(path, merged):
+    with atomic_file.open_atomic(path) as f:
+        json.dump(merged, f, indent=4, sort_keys=True)
+
+def new_watcher(args):
+    watcher = {"args": args,
+            "database": fleet_db.load_database(args.db),
+            # file name -> signature of the dump that was merged last
+            "merged": load_state(state_path(args.db)),
+            # file name -> [signature, time it was first seen like that]
+            "pending": dict(),
+            "stop": False,
+            "rank": None}
+
+    if args.rank is not None:
+        # Load the benchmark lists once and score the computers that are already in the database
+        watcher["bench"] = (create_bench_rank_list.load_bench(create_bench_rank_list.cpu_bench_file),
+                create_bench_rank_list.load_bench(create_bench_rank_list.gpu_bench_file))
+        watcher["rank"] = dict()
+        for serial, data in watcher["database"]["Computers"].items():
+            score(watcher, serial, data)
+    return watcher
+
+def score(watcher, serial, data):
+    cpu_index, gpu_index = watcher["bench"]
+    machine = create_bench_rank_list.machine_summary(data)
+    create_bench_rank_list.score_computer(machine, cpu_index, gpu_index)
+    watcher["rank"][serial] = create_bench_rank_list.report_entry(machine, data["User"])
+
+def write_rank(watcher):
+    args = watcher["args"]
+    comp_list = create_bench_rank_list.rank(watcher["rank"].values(), [create_bench_rank_list.rank_keys["cpu"]])
+    create_bench_rank_list.write_report(comp_list, args.rank, args.rank_format)
+
+def mark_changed(watcher, names):
+    # Start (or restart) the settle time of the dumps that changed
+    now = time.monotonic()
+    for name in names:
+        if not is_dump(name):
+            continue
+        sig = signature(os.path.join(watcher["args"].dir, name))
+        if sig is None:
+            watcher["pending"].pop(name, None)
+        elif sig != watcher["merged"].get(name):
+            pending = watcher["pending"].get(name)
+            if pending is None:
+                # A file that was last written a while ago has already settled
+                age = max(time.time() - sig[0] / 1e9, 0)
+                watcher["pending"][name] = [sig, now - age]
+            elif pending[0] != sig:
+                watcher["pending"][name] = [sig, now]
+
+def scan(watcher):
+    mark_changed(watcher, sorted(os.listdir(watcher["args"].dir)))
+
+def settled(watcher):
+    # The pending dumps that haven't changed for the settle time, in name order
+    args = watcher["args"]
+    now = time.monotonic()
+    # Check again, inotify doesn't report every write
+    mark_changed(watcher, list(watcher["pending"]))
+    ready = [name for name, (sig, since) in watcher["pending"].items() if now - since >= args.settle]
+    return sorted(ready)
+
+def next_timeout(watcher):
+    # Seconds until the next pending dump could be settled
+    if len(watcher["pending"]) == 0:
+        return None
+    now = time.monotonic()
+    return max(min(since + watcher["args"].settle - now for sig, since in watcher["pending"].values()), 0)
+
+def load_dump(watcher, path):
+    # A json dump from hw_script.sh -j / collect.py, or a text dump
+    args = watcher["args"]
+    with open(path, "rb") as f:
+        is_json = f.read(64).lstrip().startswith(b"{")
+    if is_json:
+        with open(path, "r") as f:
+            data = json.load(f)
+        if not isinstance(data, dict):
+            raise ValueError("the json document is not an object")
+        data["User"] = os.path.basename(path)
+        return hw_records.pack_computer(data)
+    data = parse_output.parse_file(path, args.cache)
+    if args.json_dir is not None:
+        parse_output.write_output(os.path.join(args.json_dir, ""), path, data)
+    return data
+
+def process(watcher, names):
+    args = watcher["args"]
+    database = watcher["database"]
+    merge = process_json_data.new_merge(database)
+    # The computers as they were before the merge, for the history
+    previous = dict(database["Computers"])
+
+    for name in names:
+        sig = watcher["pending"].pop(name)[0]
+        path = os.path.join(args.dir, name)
+        try:
+            data = load_dump(watcher, path)
+        except Exception as e:
+            # Not retried until the file changes again
+            print("Couldn't parse " + path + ": " + repr(e))
+            watcher["merged"][name] = sig
+            continue
+
+        # Checked before the database is touched, a dump that can't be merged
+        # is skipped until it changes instead of stopping the watcher
+        error = process_json_data.computer_error(data)
+        if error is not None:
+            print(path + ": " + error)
+            watcher["merged"][name] = sig
+            continue
+
+        serial = data["Motherboard"]["Serial Number"]
+        process_json_data.add_computer(database, merge, serial, data)
+        watcher["merged"][name] = sig
+        print("Merging " + name + " (" + serial + ")")
+
+    if len(merge["seen"]) != 0:
+        process_json_data.finish_merge(database, merge)
+        process_json_data.print_moves(merge)
+        process_json_data.save_merge(args.db, database, merge, previous, not args.no_history, not args.no_index, args.snapshot)
+        print("Merged " + str(len(merge["seen"])) + " computers into " + args.db)
+
+        if watcher["rank"] is not None:
+            for serial in merge["seen"]:
+                score(watcher, serial, database["Computers"][serial])
+            write_rank(watcher)
+
+    save_state(state_path(args.db), watcher["merged"])
+
+def run(watcher):
+    args = watcher["args"]
+    fd = None if args.poll else inotify_watch(args.dir)
+    if fd is None:
+        print("Polling " + args.dir + " every " + str(args.poll_interval) + " seconds")
+    else:
+        print("Watching " + args.dir)
+
+    # What changed while we weren't running
+    scan(watcher)
+    last_scan = time.monotonic()
+
+    while not watcher["stop"]:
+        ready = settled(watcher)
+        if len(ready) != 0:
+            process(watcher, ready)
+            continue
+
+        if args.once and len(watcher["pending"]) == 0:
+            break
+
+        # Wake up at least once a second to see if we have to stop
+        timeout = next_timeout(watcher)
+        if fd is None:
+            timeout = args.poll_interval if timeout is None else min(timeout, args.poll_interval)
+        timeout = 1.0 if timeout is None else min(timeout, 1.0)
+
+        if fd is None:
+            time.sleep(timeout)
+            if time.monotonic() - last_scan >= args.poll_interval:
+                scan(watcher)
+                last_scan = time.monotonic()
+            continue
+
+        try:
+            readable = select.select([fd], [], [], timeout)[0]
+        except InterruptedError:
+            continue
+        if len(readable) == 0:
+            continue
+        names = read_events(fd)
+        if None in names:
+            if not os.path.isdir(args.dir):
+                print(args.dir + " is gone, stopping")
+                break
+            scan(watcher)
+        mark_changed(watcher, set(name for name in names if name is not None))
+
+    if fd is not None:
+        os.close(fd)
+
+def main():
+    parser = argparse.ArgumentParser(description="Watch hw_data/ and merge new or changed dumps into the HW database as they come in.")
+    parser.add_argument("dir", nargs="?", default=os.path.join(process_json_data.data_base_dir, "hw_data"),
+            help="directory extract.sh writes the dumps to (default: %(default)s)")
+    parser.add_argument("--db", default=process_json_data.data_base_path,
+            help="database to merge into, .json or .db/.sqlite (default: %(default)s)")
+    parser.add_argument("--settle", type=float, default=2.0,
+            help="seconds a dump has to stay unchanged before it is merged (default: %(default)s)")
+    parser.add_argument("--poll", action="store_true", help="poll the directory instead of using inotify")
+    parser.add_argument("--poll-interval", type=float, default=5.0,
+            help="seconds between directory scans when polling (default: %(default)s)")
+    parser.add_argument("--once", action="store_true",
+            help="merge the dumps that changed since the last run and exit")
+    parser.add_argument("--cache", metavar="DIR", help="parse_output.py parse cache to use")
+    parser.add_argument("--json-dir", metavar="DIR", help="also write the parsed dumps as json files to DIR, like parse_output.py")
+    parser.add_argument("--rank", metavar="FILE",
+            help="keep a create_bench_rank_list.py CPU ranking of the whole fleet up to date in FILE")
+    parser.add_argument("--rank-format", choices=list(create_bench_rank_list.report_writers), default="text",
+            help="format of the --rank report (default: %(default)s)")
+    parser.add_argument("--no-index", action="store_true", help="don't update the fleet_index.py lookup index")
+    parser.add_argument("--no-history", action="store_true", help="don't record the merges in the fleet_history.py history")
+    parser.add_argument("--snapshot", metavar="FILE", help="rewrite this fleet_snapshot.py snapshot after every merge")
+
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.dir):
+        print("The directory " + args.dir + " doesn't exist")
+        sys.exit(1)
+    if args.json_dir is not None:
+        os.makedirs(args.json_dir, exist_ok=True)
+
+    watcher = new_watcher(args)
+
+    def stop(signum, frame):
+        watcher["stop"] = True
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    run(watcher)
+
+if __name__ == "__main__":
+    main()